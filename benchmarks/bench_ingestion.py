@@ -0,0 +1,112 @@
+"""
+Benchmark of POST /new ingestion: one statement per row (old way) vs single batched transaction.
+
+Usage:
+    DATABASE_URL=postgresql://... python -m benchmarks.bench_ingestion --queries 5000 --repeat 3
+
+Prints ingestion time per 1k queries for both variants. Created tasks are removed at the end.
+"""
+
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+from core.app.main import store_new_task
+from core.db.database import execute_query, execute_transaction
+from core.db.models import InputData
+
+SAMPLE_FILE = "./sample_dataset/questsH.json"
+
+
+def build_workload(n_queries: int) -> InputData:
+    with open(SAMPLE_FILE) as f:
+        sample = json.load(f)
+
+    queries = []
+    for i in range(n_queries):
+        query = dict(sample["queries"][i % len(sample["queries"])])
+        query["queryid"] = str(uuid.uuid4())
+        queries.append(query)
+
+    return InputData(url=sample["url"], ddl=sample["ddl"], queries=queries)
+
+
+def store_row_by_row(task_id: str, data: InputData):
+    """The way /new used to store a task: every insert is a separate connection and commit"""
+    execute_query(
+        "INSERT INTO public.tasks (taskid, url, status) VALUES (:taskid, :url, :status)",
+        {"taskid": task_id, "url": data.url, "status": "RUNNING"},
+    )
+    for ddl in data.ddl:
+        execute_query(
+            "INSERT INTO public.ddls (taskid, statement) VALUES (:taskid, :statement)",
+            {"taskid": task_id, "statement": ddl.statement},
+        )
+    for query in data.queries:
+        execute_query(
+            """
+            INSERT INTO public.queries (queryid, taskid, runquantity, executiontime, query)
+            VALUES (:queryid, :taskid, :runquantity, :executiontime, :query)
+            """,
+            {
+                "queryid": query.queryid,
+                "taskid": task_id,
+                "runquantity": query.runquantity,
+                "executiontime": query.executiontime,
+                "query": query.query,
+            },
+        )
+
+
+def store_batched(task_id: str, data: InputData):
+    """Current /new path: single transaction with batched inserts"""
+    asyncio.run(store_new_task(task_id, data))
+
+
+def cleanup(task_ids):
+    params = [{"taskid": task_id} for task_id in task_ids]
+    execute_transaction(
+        [
+            ("DELETE FROM public.queries WHERE taskid = :taskid", params),
+            ("DELETE FROM public.ddls WHERE taskid = :taskid", params),
+            ("DELETE FROM public.tasks WHERE taskid = :taskid", params),
+        ]
+    )
+
+
+def measure(store_func, data: InputData, repeat: int, created: list) -> float:
+    timings = []
+    for _ in range(repeat):
+        task_id = str(uuid.uuid4())
+        created.append(task_id)
+        start = time.perf_counter()
+        store_func(task_id, data)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--queries", type=int, default=1000, help="Number of queries in the workload")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per variant, the best one is reported")
+    args = parser.parse_args()
+
+    data = build_workload(args.queries)
+    created = []
+    try:
+        before = measure(store_row_by_row, data, args.repeat, created)
+        after = measure(store_batched, data, args.repeat, created)
+    finally:
+        cleanup(created)
+
+    per_1k = 1000 / args.queries
+    print(f"Workload: {len(data.ddl)} DDLs, {args.queries} queries")
+    print(f"row by row:  {before * per_1k * 1000:10.1f} ms per 1k queries")
+    print(f"batched:     {after * per_1k * 1000:10.1f} ms per 1k queries")
+    print(f"speedup:     {before / after:10.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""
+Offline end-to-end benchmark of the optimizer worker: tasks are stored like POST /new does, claimed and processed
+by core/optimizer_service/main.py with a scripted chat model and a stand-in Trino (see benchmarks/standins.py).
+Parsing, the validation loops and the persistence code are the real ones, only the LLM and Trino calls are faked.
+
+Usage:
+    DATABASE_URL=postgresql://... python -m benchmarks.bench_pipeline
+    python -m benchmarks.bench_pipeline --workload flights --tasks 5 --queries 200 --llm-latency 0.5
+    python -m benchmarks.bench_pipeline --trino-error-rate 0.2 --trace-memory
+
+--queries N replicates the queries of a workload up to N with new ids, to make larger workloads.
+Reports tasks per minute, latency of every pipeline stage (from stage_metrics) and memory use.
+The database must have no queued tasks, otherwise the worker would pick them up. Created tasks are removed at the end.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import resource
+import statistics
+import time
+import tracemalloc
+import uuid
+from typing import Dict, List
+
+from benchmarks.standins import FakeTrinoConnection, ScriptedChatModel
+from core.app.main import store_new_task
+from core.db.database import execute_query, execute_transaction
+from core.db.models import InputData
+from core.optimizer_service import main as worker
+from core.optimizer_service import run
+from core.optimizer_service.router import HedgedModelRouter
+from core.optimizer_service.trino_manager import TrinoConnectionPool, register_local_pool
+from core.optimizer_service.utils import raw_input_to_model
+
+WORKLOADS = {
+    "flights": "./sample_dataset/flights.json",
+    "questsH": "./sample_dataset/questsH.json",
+}
+TASK_TABLES = (
+    "queries",
+    "ddls",
+    "result_ddls",
+    "result_migrations",
+    "result_queries",
+    "task_workload_profiles",
+    "benchmark_results",
+    "stage_metrics",
+    "tasks",
+)
+
+
+def load_workload(name: str, n_queries: int) -> dict:
+    with open(WORKLOADS.get(name, name)) as f:
+        sample = json.load(f)
+    if not n_queries:
+        return sample
+
+    queries = []
+    for i in range(n_queries):
+        query = dict(sample["queries"][i % len(sample["queries"])])
+        query["queryid"] = str(uuid.uuid4())
+        queries.append(query)
+    return {**sample, "queries": queries}
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def stage_report(task_ids: List[str]) -> str:
+    rows = execute_query(
+        "SELECT stage, duration_ms FROM public.stage_metrics WHERE taskid = ANY(:ids)", {"ids": task_ids}
+    )
+    durations: Dict[str, List[float]] = {}
+    for stage, duration_ms in rows or []:
+        durations.setdefault(stage, []).append(duration_ms / 1000)
+
+    lines = [f"{'stage':<20}{'count':>8}{'p50, s':>10}{'p95, s':>10}{'total, s':>10}"]
+    for stage, values in sorted(durations.items(), key=lambda item: -sum(item[1])):
+        lines.append(
+            f"{stage:<20}{len(values):>8}{statistics.median(values):>10.3f}"
+            f"{percentile(values, 0.95):>10.3f}{sum(values):>10.2f}"
+        )
+    return "\n".join(lines)
+
+
+def cleanup(task_ids: List[str]):
+    params = [{"taskid": task_id} for task_id in task_ids]
+    execute_transaction([(f"DELETE FROM public.{table} WHERE taskid = :taskid", params) for table in TASK_TABLES])
+
+
+def run_workload(name: str, args) -> List[str]:
+    raw = load_workload(name, args.queries)
+    data_input = raw_input_to_model(raw)
+    model = ScriptedChatModel(
+        data_input=data_input, first_token_latency=args.llm_latency, tokens_per_second=args.llm_tps
+    )
+    router = HedgedModelRouter({"scripted": model})
+    run.get_model_router = lambda: router
+
+    task_ids, timings, peaks = [], [], []
+    for _ in range(args.tasks):
+        task_id = str(uuid.uuid4())
+        asyncio.run(store_new_task(task_id, InputData(**raw)))
+        task_ids.append(task_id)
+
+        if args.trace_memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        claimed = worker.claim_next_task()
+        if claimed != task_id:
+            raise RuntimeError(f"Claimed {claimed} instead of {task_id}. Is the task queue empty?")
+        worker.process_task(task_id)
+        timings.append(time.perf_counter() - start)
+        if args.trace_memory:
+            peaks.append(tracemalloc.get_traced_memory()[1])
+
+    statuses = execute_query("SELECT status FROM public.tasks WHERE taskid = ANY(:ids)", {"ids": task_ids})
+    done = sum(1 for (status,) in statuses if status == "DONE")
+    total = sum(timings)
+    print(f"{name}: {len(data_input.sqls)} queries, {done}/{args.tasks} tasks DONE")
+    print(f"  {args.tasks / total * 60:.1f} tasks/min, median task {statistics.median(timings):.2f}s")
+    if peaks:
+        print(f"  peak traced memory per task: {max(peaks) / 2**20:.1f} MiB")
+    return task_ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workload", action="append", help=f"One of {list(WORKLOADS)} or a path to a task JSON")
+    parser.add_argument("--tasks", type=int, default=3, help="Tasks per workload")
+    parser.add_argument("--queries", type=int, default=0, help="Replicate the workload queries up to this number")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="Seconds before the first token")
+    parser.add_argument("--llm-tps", type=float, default=500.0, help="Generated tokens per second")
+    parser.add_argument("--trino-latency", type=float, default=0.01, help="Seconds per statement")
+    parser.add_argument("--trino-error-rate", type=float, default=0.0, help="Probability that EXPLAIN fails")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--trace-memory", action="store_true", help="Measure Python allocations (slows the run)")
+    parser.add_argument("--verbose", action="store_true", help="Keep the pipeline logs")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    queued = execute_query("SELECT count(*) FROM public.tasks WHERE status = 'RUNNING'")[0][0]
+    if queued:
+        raise SystemExit(f"There are {queued} queued tasks in the database, the benchmark would process them")
+
+    connection = FakeTrinoConnection(args.trino_latency, args.trino_error_rate, args.seed)
+    register_local_pool(run.LOCAL_CATALOG_NAME, TrinoConnectionPool(lambda: connection, 16, 30))
+    if args.trace_memory:
+        tracemalloc.start()
+
+    task_ids = []
+    try:
+        for name in args.workload or list(WORKLOADS):
+            task_ids += run_workload(name, args)
+        print()
+        print(stage_report(task_ids))
+        print(f"\n{connection.executed} Trino statements")
+        # ru_maxrss is in KiB on Linux
+        print(f"Peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MiB")
+    finally:
+        cleanup(task_ids)
+
+
+if __name__ == "__main__":
+    main()
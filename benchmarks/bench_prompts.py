@@ -0,0 +1,42 @@
+"""
+Token count of the schema design prompt input with and without compaction.
+
+Usage:
+    python -m benchmarks.bench_prompts
+    python -m benchmarks.bench_prompts --workload ./my_task.json
+
+Set TOKEN_ENCODING to use another tiktoken encoding (default cl100k_base).
+"""
+
+import argparse
+import json
+
+from core.optimizer_service.compaction import compact_source_ddls, render_data_input, token_report
+from core.optimizer_service.fingerprint import group_queries_by_shape
+from core.optimizer_service.utils import raw_input_to_model
+
+WORKLOADS = {
+    "flights": "./sample_dataset/flights.json",
+    "questsH": "./sample_dataset/questsH.json",
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workload", action="append", help=f"One of {list(WORKLOADS)} or a path to a task JSON")
+    args = parser.parse_args()
+
+    for name in args.workload or list(WORKLOADS):
+        with open(WORKLOADS.get(name, name)) as f:
+            data_input = raw_input_to_model(json.load(f))
+
+        representatives = [group.representative for group in group_queries_by_shape(data_input.sqls)]
+        ddls = compact_source_ddls(data_input.ddls, representatives)
+        before = str(data_input.model_copy(update={"sqls": representatives}))
+        after = render_data_input(ddls, representatives)
+        print(f"{name}: {len(data_input.ddls)} -> {len(ddls)} tables")
+        print(token_report(name, before, after))
+
+
+if __name__ == "__main__":
+    main()
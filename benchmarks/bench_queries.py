@@ -0,0 +1,97 @@
+"""
+Benchmark of original queries vs their rewrites on synthetic data in the local Trino.
+
+Usage:
+    TRINO_HOST=localhost TRINO_PORT=8081 python -m benchmarks.bench_queries --workload flights --scale 1
+    python -m benchmarks.bench_queries --workload questsH --result result.json --runs 5
+
+Standard workloads are the samples from sample_dataset. --result is a JSON in the format of GET /getresult
+(ddl, migrations, queries). Without it only the original queries are timed, which gives a baseline.
+Source tables get scale * BENCHMARK_ROWS_PER_SCALE generated rows. Created schemas are dropped at the end.
+"""
+
+import argparse
+import json
+import uuid
+
+from core.optimizer_service.benchmark import BENCHMARK_RUNS, format_speedup, run_benchmark, speedup
+from core.optimizer_service.pydantic_models import DDL, SQL, Migration
+from core.optimizer_service.run import LOCAL_CATALOG_NAME, drop_task_schemas, get_task_schema_mapping
+from core.optimizer_service.trino_manager import execute_statement_in_trino, get_trino
+from core.optimizer_service.utils import get_catalog_and_schema_from_ddl, raw_input_to_model
+
+WORKLOADS = {
+    "flights": "./sample_dataset/flights.json",
+    "questsH": "./sample_dataset/questsH.json",
+}
+
+
+def load_result(path: str):
+    with open(path) as f:
+        result = json.load(f)
+    ddls = [DDL(ddl_script=row["statement"]) for row in result["ddl"]]
+    migrations = [Migration(statement=row["statement"]) for row in result["migrations"]]
+    sqls = [SQL(query_id=row["queryid"], query=row["query"]) for row in result["queries"]]
+    return ddls, migrations, sqls
+
+
+def create_tables(trino, ddls, catalog: str, schema: str):
+    statements = ([f"CREATE SCHEMA {catalog}.{schema}"] if schema else []) + [ddl.ddl_script for ddl in ddls]
+    for statement in statements:
+        status, error = execute_statement_in_trino(trino, statement)
+        if status == -1:
+            raise RuntimeError(f"Could not run {statement}: {error}")
+
+
+def run_workload(name: str, args):
+    with open(WORKLOADS.get(name, name)) as f:
+        data_input = raw_input_to_model(json.load(f))
+
+    server = get_catalog_and_schema_from_ddl(data_input.ddls[0].ddl_script)
+    mapping = get_task_schema_mapping(uuid.uuid4().hex, server["schema"])
+    trino = get_trino(server["catalog"], LOCAL_CATALOG_NAME, mapping)
+
+    new_ddls, migrations, sqls = load_result(args.result) if args.result else ([], [], [])
+    try:
+        create_tables(trino, data_input.ddls, server["catalog"], server["schema"])
+        # the first DDL of a result creates the new schema itself
+        create_tables(trino, new_ddls, server["catalog"], None)
+        results = run_benchmark(trino, data_input, migrations, sqls, args.scale, args.runs)
+    finally:
+        drop_task_schemas(trino)
+
+    print(f"\nworkload: {name}, scale: {args.scale}, queries: {len(results)}")
+    for result in results:
+        print(f"{result.query_id}: {format_speedup(result)}")
+
+    speedups = [speedup(result) for result in results]
+    speedups = [value for value in speedups if value is not None]
+    if speedups:
+        total = sum(speedups) / len(speedups)
+        print(f"measured rewrites: {len(speedups)}, mean speedup: {total:.2f}x")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--workload", action="append", help=f"One of {list(WORKLOADS)} or a path to a task JSON. Default: all"
+    )
+    parser.add_argument("--scale", type=float, default=1.0, help="Scale factor of the synthetic data")
+    parser.add_argument("--runs", type=int, default=BENCHMARK_RUNS, help="Runs of every query, the median is kept")
+    parser.add_argument("--result", default=None, help="Optimization result of the workload (GET /getresult JSON)")
+    parser.add_argument("--output", default=None, help="Write all measurements to this JSON file")
+    args = parser.parse_args()
+
+    workloads = args.workload or list(WORKLOADS)
+    if args.result and len(workloads) != 1:
+        parser.error("--result needs exactly one --workload")
+
+    report = {name: [result.model_dump() for result in run_workload(name, args)] for name in workloads}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
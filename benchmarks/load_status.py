@@ -0,0 +1,81 @@
+"""
+Load test of GET /status with many concurrent polling clients.
+
+Usage:
+    python -m benchmarks.load_status --url http://localhost:8000 --clients 500 --duration 30
+
+If --task-id is not given, a task is created from sample_dataset/flights.json first.
+Prints throughput and p50/p90/p99 latency of /status.
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+import httpx
+
+SAMPLE_FILE = "./sample_dataset/flights.json"
+
+
+def percentile(values, q: float) -> float:
+    values = sorted(values)
+    idx = min(len(values) - 1, max(0, int(round(q / 100 * len(values))) - 1))
+    return values[idx]
+
+
+async def create_task(client: httpx.AsyncClient) -> str:
+    with open(SAMPLE_FILE) as f:
+        payload = json.load(f)
+    response = await client.post("/new", json=payload)
+    response.raise_for_status()
+    return response.json()["taskid"]
+
+
+async def poll(client: httpx.AsyncClient, task_id: str, stop_at: float, latencies: list, errors: list):
+    while time.perf_counter() < stop_at:
+        start = time.perf_counter()
+        try:
+            response = await client.get("/status", params={"task_id": task_id})
+            if response.status_code != 200:
+                errors.append(response.status_code)
+                continue
+        except httpx.HTTPError as e:
+            errors.append(type(e).__name__)
+            continue
+        latencies.append(time.perf_counter() - start)
+
+
+async def run(args):
+    limits = httpx.Limits(max_connections=args.clients, max_keepalive_connections=args.clients)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=60) as client:
+        task_id = args.task_id or await create_task(client)
+
+        latencies, errors = [], []
+        stop_at = time.perf_counter() + args.duration
+        await asyncio.gather(*(poll(client, task_id, stop_at, latencies, errors) for _ in range(args.clients)))
+
+    if not latencies:
+        print(f"No successful requests, errors: {len(errors)}")
+        return
+
+    print(f"clients: {args.clients}, duration: {args.duration}s, task: {task_id}")
+    print(f"requests: {len(latencies)} ok, {len(errors)} errors, {len(latencies) / args.duration:.1f} req/s")
+    print(f"p50: {percentile(latencies, 50) * 1000:.1f} ms")
+    print(f"p90: {percentile(latencies, 90) * 1000:.1f} ms")
+    print(f"p99: {percentile(latencies, 99) * 1000:.1f} ms")
+    print(f"mean: {statistics.mean(latencies) * 1000:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8000", help="Base URL of the API")
+    parser.add_argument("--clients", type=int, default=500, help="Number of concurrent clients")
+    parser.add_argument("--duration", type=int, default=30, help="Test duration in seconds")
+    parser.add_argument("--task-id", default=None, help="Existing task id to poll")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""
+Local stand-ins for the LLM provider and the Trino cluster, so the pipeline can be run offline.
+Both have configurable latency. Answers of the chat model are scripted from the task input:
+the new schema is a copy of the source tables, every query is rewritten to read from the copies.
+"""
+
+import json
+import random
+import re
+import threading
+import time
+from typing import Any, Iterator, List, Optional
+
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from core.optimizer_service.compaction import render_table
+from core.optimizer_service.pydantic_models import DataInput
+from core.optimizer_service.run import LOCAL_SCHEMA_NAME
+from core.optimizer_service.utils import get_catalog_and_schema_from_ddl
+from core.optimizer_service.workload import parse_table_ddl
+
+QUERY_MARKER = "Here is the query I want to rewrite using new schema:"
+DDL_MARKER = "MIGRATIONS:"
+# characters per token of the generated text, used to pace the stream
+CHARS_PER_TOKEN = 4
+STREAM_CHUNK_CHARS = 64
+
+
+def scripted_schema_answer(data_input: DataInput) -> str:
+    """Answer to the schema design prompt: a copy of every source table and a migration that fills it"""
+    catalog = get_catalog_and_schema_from_ddl(data_input.ddls[0].ddl_script)["catalog"]
+    ddls = [f"CREATE SCHEMA {catalog}.{LOCAL_SCHEMA_NAME};"]
+    migrations = []
+    for ddl in data_input.ddls:
+        table = parse_table_ddl(ddl.ddl_script)
+        if table is None:
+            continue
+        new_name = f"{catalog}.{LOCAL_SCHEMA_NAME}.{table.name.split('.')[-1]}"
+        ddls.append(render_table(table._replace(name=new_name)) + ";")
+        migrations.append(f"INSERT INTO {new_name} SELECT * FROM {table.name};")
+
+    lines = ["DDLS:"] + [f"{i}. {ddl}" for i, ddl in enumerate(ddls, start=1)]
+    lines += ["", "MIGRATIONS:"] + [f"{i}. {migration}" for i, migration in enumerate(migrations, start=1)]
+    return "\n".join(lines) + "\n#END#"
+
+
+def scripted_query_answer(data_input: DataInput, query: str) -> str:
+    """Answer to the query rewrite prompt: the same query reading from the copied tables"""
+    server = get_catalog_and_schema_from_ddl(data_input.ddls[0].ddl_script)
+    source = re.escape(f"{server['catalog']}.{server['schema']}.")
+    return re.sub(source, f"{server['catalog']}.{LOCAL_SCHEMA_NAME}.", " ".join(query.split()), flags=re.IGNORECASE)
+
+
+class ScriptedChatModel(BaseChatModel):
+    """
+    Chat model that answers the prompts of the pipeline from the task input.
+    Waits first_token_latency seconds before the answer and then produces tokens_per_second.
+    """
+
+    data_input: DataInput
+    first_token_latency: float = 1.0
+    tokens_per_second: float = 50.0
+    cache: Any = False
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted"
+
+    def answer(self, messages: List[BaseMessage]) -> str:
+        for message in messages:
+            content = str(message.content)
+            if QUERY_MARKER in content:
+                return scripted_query_answer(self.data_input, content.split(QUERY_MARKER, 1)[1])
+        if any(DDL_MARKER in str(message.content) for message in messages):
+            return scripted_schema_answer(self.data_input)
+        return "IMPOSSIBLE"
+
+    def _chunks(self, text: str) -> Iterator[str]:
+        time.sleep(self.first_token_latency)
+        for start in range(0, len(text), STREAM_CHUNK_CHARS):
+            chunk = text[start : start + STREAM_CHUNK_CHARS]
+            time.sleep(len(chunk) / CHARS_PER_TOKEN / self.tokens_per_second)
+            yield chunk
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        text = "".join(self._chunks(self.answer(messages)))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        for chunk in self._chunks(self.answer(messages)):
+            yield ChatGenerationChunk(message=AIMessageChunk(content=chunk))
+
+
+class FakeTrinoCursor:
+    def __init__(self, connection: "FakeTrinoConnection"):
+        self.connection = connection
+        self.stats = {}
+        self._rows = []
+
+    def execute(self, statement: str):
+        self.connection.count_statement()
+        time.sleep(self.connection.latency)
+        # only validation by EXPLAIN fails, so the task input itself is always accepted
+        if statement.lstrip().upper().startswith("EXPLAIN") and self.connection.should_fail():
+            raise RuntimeError(f"Injected error for statement: {statement[:100]}")
+        if statement.lstrip().upper().startswith("EXPLAIN (TYPE IO"):
+            self._rows = [[json.dumps({"inputTableColumnInfos": []})]]
+        else:
+            self._rows = []
+
+    def fetchall(self):
+        return self._rows
+
+
+class FakeTrinoConnection:
+    """Accepts every statement after latency seconds. EXPLAIN fails with the probability error_rate"""
+
+    def __init__(self, latency: float = 0.05, error_rate: float = 0.0, seed: Optional[int] = None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.executed = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def count_statement(self):
+        with self._lock:
+            self.executed += 1
+
+    def should_fail(self) -> bool:
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def cursor(self) -> FakeTrinoCursor:
+        return FakeTrinoCursor(self)
+
+    def close(self):
+        pass
@@ -0,0 +1,67 @@
+import asyncio
+import logging
+import os
+import threading
+from typing import Dict, Set
+
+from core.db.database import NotificationListener, TASK_EVENTS_CHANNEL
+
+# a subscriber re-reads the task at least this often, in case a notification was lost
+STREAM_POLL_INTERVAL = float(os.getenv("STREAM_POLL_INTERVAL", "15"))
+# longest time a long-poll request is held
+STATUS_MAX_WAIT = float(os.getenv("STATUS_MAX_WAIT", "60"))
+
+logger = logging.getLogger(__name__)
+
+
+class TaskEventHub:
+    """
+    Fans out task change notifications (NOTIFY on TASK_EVENTS_CHANNEL, payload is the task id)
+    to the streams of the API process. One background thread holds the LISTEN connection for all subscribers.
+    """
+
+    def __init__(self):
+        self._subscribers: Dict[str, Set[asyncio.Event]] = {}
+        self._loop = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscribe(self, *task_ids: str) -> asyncio.Event:
+        """Event that is set whenever any of the tasks changes. Must be called from the event loop"""
+        event = asyncio.Event()
+        with self._lock:
+            self._loop = asyncio.get_running_loop()
+            for task_id in task_ids:
+                self._subscribers.setdefault(task_id, set()).add(event)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="task-events", daemon=True)
+                self._thread.start()
+        return event
+
+    def unsubscribe(self, event: asyncio.Event, *task_ids: str):
+        with self._lock:
+            for task_id in task_ids:
+                events = self._subscribers.get(task_id, set())
+                events.discard(event)
+                if not events:
+                    self._subscribers.pop(task_id, None)
+
+    def _run(self):
+        listener = NotificationListener(TASK_EVENTS_CHANNEL)
+        while True:
+            payloads = listener.wait(STREAM_POLL_INTERVAL)
+            with self._lock:
+                events = {event for task_id in set(payloads) for event in self._subscribers.get(task_id, ())}
+                loop = self._loop
+            for event in events:
+                loop.call_soon_threadsafe(event.set)
+
+
+async def wait_for_change(event: asyncio.Event, timeout: float = STREAM_POLL_INTERVAL) -> bool:
+    """Wait until the task changes. Returns False on timeout"""
+    try:
+        await asyncio.wait_for(event.wait(), timeout)
+    except asyncio.TimeoutError:
+        return False
+    event.clear()
+    return True
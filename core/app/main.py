@@ -1,9 +1,24 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Header, Response
+from fastapi.responses import StreamingResponse
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+import asyncio
+import json
 import uuid
 import logging
 
-from core.db.models import InputData, NewTaskResponse, StatusResponse, TaskResultResponse
-from core.db.database import execute_query
+from core.db.models import (
+    BatchStatusRequest,
+    BatchStatusResponse,
+    InputData,
+    NewTaskResponse,
+    StatusResponse,
+    TaskResultResponse,
+)
+from core.db.database import execute_query_async, execute_transaction_async, NEW_TASK_CHANNEL
+from core.app.priority import task_priority
+from core.app.cache import ResultCache, CachedResult, make_etag, etag_matches
+from core.app.events import STATUS_MAX_WAIT, STREAM_POLL_INTERVAL, TaskEventHub, wait_for_change
+from core.app.metrics import LLM_CALLS_QUERY, QUEUE_DEPTH_QUERY, STAGE_LATENCY_QUERY, render_metrics
 
 app = FastAPI(title="TLC Project API", description="FastAPI service for TLC project")
 
@@ -11,6 +26,60 @@ app = FastAPI(title="TLC Project API", description="FastAPI service for TLC proj
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+result_cache = ResultCache()
+task_events = TaskEventHub()
+
+# internal task statuses that are not shown to API clients
+PUBLIC_STATUSES = {"CLAIMED": "RUNNING"}
+# statuses after which the result of a task does not change
+FINAL_STATUSES = {"DONE", "FAILED"}
+
+
+def public_status(status: str) -> str:
+    return PUBLIC_STATUSES.get(status, status)
+
+
+async def store_new_task(task_id: str, data: InputData):
+    """
+    Store the task, its DDLs and its queries in a single transaction.
+    DDLs and queries are written with one batched insert each.
+    Optimizer workers are woken up with NOTIFY on commit.
+    Tasks are dequeued in the order of dequeue_at, see task_priority.
+    """
+    task_query = """
+        INSERT INTO public.tasks (taskid, url, status, submitted_at, priority, dequeue_at)
+        VALUES (:taskid, :url, :status, now(), :priority, now() + make_interval(secs => :priority))
+    """
+    ddl_query = """
+        INSERT INTO public.ddls (taskid, statement) 
+        VALUES (:taskid, :statement)
+    """
+    query_insert = """
+        INSERT INTO public.queries (queryid, taskid, runquantity, executiontime, query) 
+        VALUES (:queryid, :taskid, :runquantity, :executiontime, :query)
+    """
+    ddl_params = [{"taskid": task_id, "statement": ddl.statement} for ddl in data.ddl]
+    query_params = [
+        {
+            "queryid": query.queryid,
+            "taskid": task_id,
+            "runquantity": query.runquantity,
+            "executiontime": query.executiontime,
+            "query": query.query,
+        }
+        for query in data.queries
+    ]
+
+    await execute_transaction_async(
+        [
+            (task_query, {"taskid": task_id, "url": data.url, "status": "RUNNING", "priority": task_priority(data)}),
+            (ddl_query, ddl_params),
+            (query_insert, query_params),
+            # delivered to optimizer workers only when the transaction commits
+            ("SELECT pg_notify(:channel, :taskid)", {"channel": NEW_TASK_CHANNEL, "taskid": task_id}),
+        ]
+    )
+
 
 @app.post("/new", response_model=NewTaskResponse)
 async def create_new_task(data: InputData):
@@ -22,37 +91,7 @@ async def create_new_task(data: InputData):
         # Generate UUID4 for taskid
         task_id = str(uuid.uuid4())
 
-        # Insert into tasks table
-        task_query = """
-            INSERT INTO public.tasks (taskid, url, status) 
-            VALUES (:taskid, :url, :status)
-        """
-        execute_query(task_query, {"taskid": task_id, "url": data.url, "status": "RUNNING"})
-
-        # Insert into ddls table
-        for ddl in data.ddl:
-            ddl_query = """
-                INSERT INTO public.ddls (taskid, statement) 
-                VALUES (:taskid, :statement)
-            """
-            execute_query(ddl_query, {"taskid": task_id, "statement": ddl.statement})
-
-        # Insert into queries table
-        for query in data.queries:
-            query_insert = """
-                INSERT INTO public.queries (queryid, taskid, runquantity, executiontime, query) 
-                VALUES (:queryid, :taskid, :runquantity, :executiontime, :query)
-            """
-            execute_query(
-                query_insert,
-                {
-                    "queryid": query.queryid,
-                    "taskid": task_id,
-                    "runquantity": query.runquantity,
-                    "executiontime": query.executiontime,
-                    "query": query.query,
-                },
-            )
+        await store_new_task(task_id, data)
 
         logger.info(f"Created new task with ID: {task_id}")
         return NewTaskResponse(taskid=task_id)
@@ -62,22 +101,56 @@ async def create_new_task(data: InputData):
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
 
+async def fetch_statuses(task_ids: List[str]) -> Dict[str, str]:
+    """Public statuses of the tasks with a single primary key lookup. Unknown tasks are not included"""
+    status_query = """
+        SELECT taskid, status FROM public.tasks WHERE taskid = ANY(:taskids)
+    """
+    rows = await execute_query_async(status_query, {"taskids": list(task_ids)})
+    return {taskid: public_status(status) for taskid, status in rows or []}
+
+
+async def wait_for_statuses(task_ids: List[str], wait: float) -> Dict[str, str]:
+    """
+    Statuses of the tasks. With wait > 0 the call returns when the status of any task changes,
+    but not later than wait seconds (at most STATUS_MAX_WAIT). It returns at once if all tasks are DONE or FAILED.
+    Changes are signalled by the optimizer notifications, the statuses are re-read periodically in case one is lost.
+    """
+    if wait <= 0:
+        return await fetch_statuses(task_ids)
+
+    # subscribe before the first read, so a change right after it is not missed
+    event = task_events.subscribe(*task_ids)
+    try:
+        statuses = await fetch_statuses(task_ids)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + min(wait, STATUS_MAX_WAIT)
+        while any(status not in FINAL_STATUSES for status in statuses.values()):
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            await wait_for_change(event, min(remaining, STREAM_POLL_INTERVAL))
+            current = await fetch_statuses(task_ids)
+            if current != statuses:
+                return current
+        return statuses
+    finally:
+        task_events.unsubscribe(event, *task_ids)
+
+
 @app.get("/status", response_model=StatusResponse)
-async def get_task_status(task_id: str):
+async def get_task_status(task_id: str, wait: float = 0):
     """
     Get the status of a given task.
+    With wait (seconds) the request is held until the status changes or the timeout passes (long polling).
     """
     try:
-        status_query = """
-            SELECT taskid, status FROM public.tasks WHERE taskid = :taskid
-        """
-        result = execute_query(status_query, {"taskid": task_id})
+        statuses = await wait_for_statuses([task_id], wait)
 
-        if not result:
+        if task_id not in statuses:
             raise HTTPException(status_code=404, detail="Task not found")
 
-        task_data = result[0]
-        return StatusResponse(status=task_data[1])
+        return StatusResponse(status=statuses[task_id])
 
     except HTTPException:
         raise
@@ -86,45 +159,80 @@ async def get_task_status(task_id: str):
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
 
+@app.post("/status/batch", response_model=BatchStatusResponse)
+async def get_task_statuses(request: BatchStatusRequest, wait: float = 0):
+    """
+    Get the statuses of many tasks with one query. Unknown task ids are not included in the response.
+    With wait (seconds) the request is held until the status of any of the tasks changes or the timeout passes.
+    """
+    try:
+        return BatchStatusResponse(statuses=await wait_for_statuses(request.task_ids, wait))
+    except Exception as e:
+        logger.error(f"Error retrieving task statuses: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+
+
+async def fetch_task_result(task_id: str) -> Tuple[Optional[str], Optional[TaskResultResponse]]:
+    """
+    Fetch task status and all its result rows with a single query.
+    Returns (None, None) if the task does not exist.
+    """
+    result_query = """
+        SELECT t.status, r.kind, r.queryid, r.statement
+        FROM public.tasks t
+        LEFT JOIN (
+            SELECT taskid, 'ddl' AS kind, NULL AS queryid, statement
+            FROM public.result_ddls WHERE taskid = :taskid
+            UNION ALL
+            SELECT taskid, 'migration' AS kind, NULL AS queryid, statement
+            FROM public.result_migrations WHERE taskid = :taskid
+            UNION ALL
+            SELECT taskid, 'query' AS kind, queryid, query AS statement
+            FROM public.result_queries WHERE taskid = :taskid
+        ) r ON r.taskid = t.taskid
+        WHERE t.taskid = :taskid
+    """
+    rows = await execute_query_async(result_query, {"taskid": task_id})
+    if not rows:
+        return None, None
+
+    ddl_list, migration_list, query_list = [], [], []
+    for status, kind, queryid, statement in rows:
+        if kind == "ddl":
+            ddl_list.append({"statement": statement})
+        elif kind == "migration":
+            migration_list.append({"statement": statement})
+        elif kind == "query":
+            query_list.append({"queryid": queryid, "query": statement})
+
+    return rows[0][0], TaskResultResponse(ddl=ddl_list, migrations=migration_list, queries=query_list)
+
+
 @app.get("/getresult", response_model=TaskResultResponse)
-async def get_task_result(task_id: str):
+async def get_task_result(task_id: str, if_none_match: Optional[str] = Header(default=None)):
     """
     Get the result of a given task.
     Collects DDL statements, migration statements, and queries from the database.
+    Results of DONE tasks never change, so they are served from the in-process cache.
+    Supports conditional requests with ETag / If-None-Match.
     """
     try:
-        # Check if task exists
-        task_query = """
-            SELECT taskid, status FROM public.tasks WHERE taskid = :taskid
-        """
-        task_result = execute_query(task_query, {"taskid": task_id})
+        cached = result_cache.get(task_id)
+        if cached is None:
+            status, result = await fetch_task_result(task_id)
 
-        if not task_result:
-            raise HTTPException(status_code=404, detail="Task not found")
+            if status is None:
+                raise HTTPException(status_code=404, detail="Task not found")
+
+            body = result.model_dump_json().encode()
+            cached = CachedResult(body=body, etag=make_etag(body))
+            if status == "DONE":
+                result_cache.put(task_id, cached)
+
+        if etag_matches(if_none_match, cached.etag):
+            return Response(status_code=304, headers={"ETag": cached.etag})
 
-        # Get DDL statements
-        ddl_query = """
-            SELECT statement FROM public.result_ddls WHERE taskid = :taskid
-        """
-        ddl_results = execute_query(ddl_query, {"taskid": task_id}) or []
-        ddl_list = [{"statement": row[0]} for row in ddl_results]
-
-        # Get migration statements
-        migration_query = """
-            SELECT statement FROM public.result_migrations WHERE taskid = :taskid
-        """
-        migration_results = execute_query(migration_query, {"taskid": task_id}) or []
-        migration_list = [{"statement": row[0]} for row in migration_results]
-
-        # Get queries
-        query_result_query = """
-            SELECT queryid, query FROM public.result_queries WHERE taskid = :taskid
-        """
-        query_results = execute_query(query_result_query, {"taskid": task_id}) or []
-        query_list = [{"queryid": row[0], "query": row[1]} for row in query_results]
-
-        # Return the structured response
-        return TaskResultResponse(ddl=ddl_list, migrations=migration_list, queries=query_list)
+        return Response(content=cached.body, media_type="application/json", headers={"ETag": cached.etag})
 
     except HTTPException:
         raise
@@ -133,6 +241,78 @@ async def get_task_result(task_id: str):
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
 
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def task_result_events(task_id: str) -> AsyncIterator[str]:
+    """
+    Server-Sent Events with the result rows of a task as they are saved, then the final status.
+    The task is re-read on every change notification from the optimizer (and periodically, if one is lost),
+    and only rows that were not sent yet are streamed. A query is sent again if its rewrite was replaced.
+    """
+    event = task_events.subscribe(task_id)
+    try:
+        sent = set()
+        while True:
+            status, result = await fetch_task_result(task_id)
+            if status is None:
+                yield sse_event("error", {"detail": "Task not found"})
+                return
+
+            rows = [("ddl", ddl.model_dump()) for ddl in result.ddl]
+            rows += [("migration", migration.model_dump()) for migration in result.migrations]
+            rows += [("query", query.model_dump()) for query in result.queries]
+            for kind, row in rows:
+                key = (kind, json.dumps(row, sort_keys=True))
+                if key not in sent:
+                    sent.add(key)
+                    yield sse_event(kind, row)
+
+            if status in FINAL_STATUSES:
+                yield sse_event("status", {"status": public_status(status)})
+                return
+            if not await wait_for_change(event):
+                # keeps the connection open through proxies
+                yield ": keepalive\n\n"
+    finally:
+        task_events.unsubscribe(event, task_id)
+
+
+@app.get("/stream")
+async def stream_task_result(task_id: str):
+    """
+    Stream the result of a task while it is being optimized (Server-Sent Events).
+    Events: ddl, migration and query with the same objects as in /getresult, then status with the final status.
+    """
+    status, _ = await fetch_task_result(task_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Task not found")
+
+    return StreamingResponse(
+        task_result_events(task_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Prometheus metrics: optimizer stage latency histograms, queue depth by status,
+    LLM error, retry and token counters. Computed from the stage spans saved by optimizer workers.
+    """
+    try:
+        latency_rows = await execute_query_async(STAGE_LATENCY_QUERY)
+        llm_rows = await execute_query_async(LLM_CALLS_QUERY)
+        queue_rows = await execute_query_async(QUEUE_DEPTH_QUERY)
+    except Exception as e:
+        logger.error(f"Error collecting metrics: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+
+    return Response(content=render_metrics(latency_rows, llm_rows, queue_rows), media_type="text/plain; version=0.0.4")
+
+
 @app.get("/")
 async def root():
     return {"message": "TLC Project API"}
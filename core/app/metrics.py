@@ -0,0 +1,76 @@
+from typing import Dict, List, Tuple
+
+from core.db.stage_metrics import LATENCY_BUCKETS
+
+# stages that call the LLM
+LLM_STAGES = ("llm", "ddl_generation")
+
+STAGE_LATENCY_QUERY = """
+    SELECT stage, spans, duration_ms, buckets FROM public.stage_metric_totals
+"""
+LLM_CALLS_QUERY = f"""
+    SELECT stage, errors, retries, prompt_tokens, completion_tokens, throttled
+    FROM public.stage_metric_totals
+    WHERE stage IN ({", ".join(f"'{stage}'" for stage in LLM_STAGES)})
+"""
+QUEUE_DEPTH_QUERY = """
+    SELECT status, count(*) FROM public.tasks GROUP BY status
+"""
+
+
+def _labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    values = ",".join(f'{name}="{value}"' for name, value in labels.items())
+    return "{" + values + "}"
+
+
+class MetricsWriter:
+    """Prometheus text exposition format"""
+
+    def __init__(self):
+        self._lines: List[str] = []
+
+    def family(self, name: str, kind: str, description: str):
+        self._lines += [f"# HELP {name} {description}", f"# TYPE {name} {kind}"]
+
+    def sample(self, name: str, value: float, **labels: str):
+        self._lines.append(f"{name}{_labels(labels)} {value:g}")
+
+    def histogram(self, name: str, labels: Dict[str, str], buckets: List[Tuple[str, int]], count: int, total: float):
+        for bound, cumulative in buckets:
+            self.sample(f"{name}_bucket", cumulative, **labels, le=bound)
+        self.sample(f"{name}_bucket", count, **labels, le="+Inf")
+        self.sample(f"{name}_count", count, **labels)
+        self.sample(f"{name}_sum", total, **labels)
+
+    def render(self) -> str:
+        return "\n".join(self._lines) + "\n"
+
+
+def render_metrics(latency_rows, llm_rows, queue_rows) -> str:
+    """Metrics page from the rows of STAGE_LATENCY_QUERY, LLM_CALLS_QUERY and QUEUE_DEPTH_QUERY"""
+    writer = MetricsWriter()
+
+    writer.family("tlc_stage_duration_seconds", "histogram", "Duration of optimizer pipeline stages")
+    for stage, count, total_ms, cumulative in latency_rows:
+        buckets = [(f"{bound:g}", value) for bound, value in zip(LATENCY_BUCKETS, cumulative)]
+        writer.histogram("tlc_stage_duration_seconds", {"stage": stage}, buckets, count, total_ms / 1000)
+
+    writer.family("tlc_tasks", "gauge", "Number of tasks by status")
+    for status, count in queue_rows:
+        writer.sample("tlc_tasks", count, status=status)
+
+    counters = [
+        ("tlc_llm_errors_total", "LLM calls that raised an error", 1),
+        ("tlc_llm_retries_total", "LLM calls made by a retry iteration", 2),
+        ("tlc_llm_prompt_tokens_total", "Prompt tokens sent to the LLM", 3),
+        ("tlc_llm_completion_tokens_total", "Completion tokens generated by the LLM", 4),
+        ("tlc_llm_throttled_total", "LLM calls that stayed throttled by the provider after all retries", 5),
+    ]
+    for name, description, column in counters:
+        writer.family(name, "counter", description)
+        for row in llm_rows:
+            writer.sample(name, row[column], stage=row[0])
+
+    return writer.render()
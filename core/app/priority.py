@@ -0,0 +1,23 @@
+import math
+import os
+
+from core.db.models import InputData
+
+# queue delay per query of a task. Tasks with more queries occupy a worker longer, so they wait more
+QUEUE_DELAY_PER_QUERY = float(os.getenv("QUEUE_DELAY_PER_QUERY", "30"))
+# the longest a task can be overtaken by tasks submitted after it (aging)
+QUEUE_MAX_DELAY = float(os.getenv("QUEUE_MAX_DELAY", "1800"))
+
+
+def task_priority(data: InputData) -> float:
+    """
+    Queue delay of a task in seconds, smaller is served first.
+    Grows with the number of queries (a proxy for optimization time) and shrinks slowly with the total
+    workload time (runquantity * executiontime) that the optimization can save.
+
+    A task is dequeued in the order of submitted_at + priority. Tasks submitted later than that are always
+    served after it, so the wait of a large task is bounded by QUEUE_MAX_DELAY and it can not starve.
+    """
+    workload_time = sum(query.runquantity * query.executiontime for query in data.queries)
+    importance = math.log10(10 + max(workload_time, 0))
+    return min(QUEUE_MAX_DELAY, QUEUE_DELAY_PER_QUERY * len(data.queries) / importance)
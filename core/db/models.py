@@ -1,5 +1,5 @@
-from pydantic import BaseModel
-from typing import List
+from pydantic import BaseModel, Field
+from typing import Dict, List
 
 
 # Pydantic models for JSON payload validation
@@ -24,7 +24,7 @@ class InputData(BaseModel):
 class TaskDB(BaseModel):
     taskid: str
     url: str
-    status: str  # 'RUNNING', 'DONE', 'FAILED'
+    status: str  # 'RUNNING', 'CLAIMED', 'DONE', 'FAILED'
 
     class Config:
         from_attributes = True
@@ -58,6 +58,15 @@ class StatusResponse(BaseModel):
     status: str
 
 
+class BatchStatusRequest(BaseModel):
+    task_ids: List[str] = Field(min_length=1, max_length=1000)
+
+
+class BatchStatusResponse(BaseModel):
+    # unknown task ids are not included
+    statuses: Dict[str, str]
+
+
 # Response model for task result
 class DDLResult(BaseModel):
     statement: str
@@ -0,0 +1,63 @@
+from typing import Dict, List
+
+# upper bounds of the stage latency histogram buckets, seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+# exception type of LLM calls that stayed throttled, they are counted apart from the errors
+THROTTLED_ERROR = "LLMThrottled"
+
+# running totals per stage, so a scrape reads one row per stage instead of all spans.
+# Bucket arrays are added element-wise, LATENCY_BUCKETS must not change without resetting the table
+STAGE_TOTALS_QUERY = """
+    INSERT INTO public.stage_metric_totals AS t (
+        stage, spans, duration_ms, buckets, errors, retries, prompt_tokens, completion_tokens, throttled
+    )
+    VALUES (
+        :stage, :spans, :duration_ms, CAST(:buckets AS int8[]), :errors, :retries,
+        :prompt_tokens, :completion_tokens, :throttled
+    )
+    ON CONFLICT (stage) DO UPDATE
+    SET spans = t.spans + EXCLUDED.spans,
+        duration_ms = t.duration_ms + EXCLUDED.duration_ms,
+        buckets = ARRAY(
+            SELECT a + b FROM unnest(t.buckets, EXCLUDED.buckets) WITH ORDINALITY AS u(a, b, i) ORDER BY i
+        ),
+        errors = t.errors + EXCLUDED.errors,
+        retries = t.retries + EXCLUDED.retries,
+        prompt_tokens = t.prompt_tokens + EXCLUDED.prompt_tokens,
+        completion_tokens = t.completion_tokens + EXCLUDED.completion_tokens,
+        throttled = t.throttled + EXCLUDED.throttled
+"""
+
+def stage_totals(spans) -> List[dict]:
+    """Parameters of STAGE_TOTALS_QUERY for a batch of stage spans, one row per stage"""
+    totals: Dict[str, dict] = {}
+    for span in spans:
+        row = totals.setdefault(
+            span.stage,
+            {
+                "stage": span.stage,
+                "spans": 0,
+                "duration_ms": 0.0,
+                "buckets": [0] * len(LATENCY_BUCKETS),
+                "errors": 0,
+                "retries": 0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "throttled": 0,
+            },
+        )
+        row["spans"] += 1
+        row["duration_ms"] += span.duration_ms
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if span.duration_ms <= bound * 1000:
+                row["buckets"][i] += 1
+        if span.error == THROTTLED_ERROR:
+            row["throttled"] += 1
+        elif span.error is not None:
+            row["errors"] += 1
+        if span.iteration is not None and span.iteration > 1:
+            row["retries"] += 1
+        row["prompt_tokens"] += span.prompt_tokens or 0
+        row["completion_tokens"] += span.completion_tokens or 0
+    # rows are upserted in the same order by every worker, so concurrent transactions do not deadlock
+    return sorted(totals.values(), key=lambda row: row["stage"])
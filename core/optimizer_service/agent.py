@@ -1,12 +1,18 @@
 import os
+import threading
 from dotenv import load_dotenv
 from langchain.chat_models import BaseChatModel
 from langchain_qwq import ChatQwQ
 from langchain_deepseek import ChatDeepSeek
 from langchain.agents import create_agent
+from core.optimizer_service.llm_cache import get_llm_cache
+from core.optimizer_service.router import HedgedModelRouter
 
 load_dotenv()
 
+# send hedged requests to DeepSeek when Qwen is slow. With 0 only Qwen is used
+LLM_HEDGING = os.getenv("LLM_HEDGING", "1") == "1"
+
 
 def get_base_url():
     return os.getenv("API_BASE_URL")
@@ -17,12 +23,33 @@ def get_api_key():
 
 
 def get_qwen3_8b():
-    return ChatQwQ(model="qwen/qwen3-8b", base_url=get_base_url(), api_key=get_api_key())
+    return ChatQwQ(model="qwen/qwen3-8b", base_url=get_base_url(), api_key=get_api_key(), cache=get_llm_cache())
 
 
 def get_deepseek_r1():
-    return ChatDeepSeek(model="deepseek/deepseek-r1-0528-qwen3-8b:free", base_url=get_base_url(), api_key=get_api_key())
+    return ChatDeepSeek(
+        model="deepseek/deepseek-r1-0528-qwen3-8b:free",
+        base_url=get_base_url(),
+        api_key=get_api_key(),
+        cache=get_llm_cache(),
+    )
 
 
 def get_agent(model: BaseChatModel):
     return create_agent(model, tools=[])
+
+
+_model_router = None
+_model_router_lock = threading.Lock()
+
+
+def get_model_router() -> HedgedModelRouter:
+    """Process-wide model router, so latency statistics are collected across tasks"""
+    global _model_router
+    with _model_router_lock:
+        if _model_router is None:
+            models = {"qwen3-8b": get_qwen3_8b()}
+            if LLM_HEDGING:
+                models["deepseek-r1"] = get_deepseek_r1()
+            _model_router = HedgedModelRouter(models)
+    return _model_router
@@ -0,0 +1,222 @@
+import logging
+import os
+import re
+import statistics
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+
+from core.optimizer_service.pydantic_models import (
+    DDL,
+    SQL,
+    DataInput,
+    ExceptionDuringQuery,
+    Migration,
+    QueryBenchmark,
+    QueryRun,
+)
+from core.optimizer_service.trino_manager import (
+    TrinoClustersManager,
+    benchmark_statement_in_trino,
+    execute_statement_in_trino,
+    to_validation_error,
+)
+from core.optimizer_service.workload import TableDefinition, parse_table_ddl
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# 0 disables the benchmark stage. Every source table gets BENCHMARK_SCALE_FACTOR * BENCHMARK_ROWS_PER_SCALE rows
+BENCHMARK_SCALE_FACTOR = float(os.getenv("BENCHMARK_SCALE_FACTOR", "0"))
+BENCHMARK_ROWS_PER_SCALE = int(os.getenv("BENCHMARK_ROWS_PER_SCALE", "100000"))
+# every query is run this many times, the median run is kept
+BENCHMARK_RUNS = int(os.getenv("BENCHMARK_RUNS", "3"))
+
+# Trino sequence() returns at most 10000 elements, bigger ranges are built as a cross join of two sequences
+SEQUENCE_BLOCK = 10000
+# multiplier coprime with the row count spreads values over the whole range instead of following row order
+SPREAD = 7919
+# number of distinct values of non-key columns, so they can be grouped and filtered by
+LOW_CARDINALITY = 100
+
+DECIMAL_PATTERN = re.compile(r"DECIMAL\((\d+),\s*(\d+)\)", re.IGNORECASE)
+LENGTH_PATTERN = re.compile(r"\((\d+)\)")
+INTEGER_LIMITS = {"TINYINT": 100, "SMALLINT": 30000}
+
+
+def is_key_column(column: str) -> bool:
+    """id, client_id, originairportid... Keys take values from the same range in all tables, so joins match"""
+    return column.lower().endswith("id")
+
+
+def column_generator(column: str, data_type: str, rows: int) -> str:
+    """SQL expression of the row number i that produces values of a column"""
+    data_type = data_type.upper()
+    base_type = data_type.split("(")[0].strip()
+
+    if base_type in ("TINYINT", "SMALLINT", "INTEGER", "INT", "BIGINT"):
+        cardinality = rows if is_key_column(column) else LOW_CARDINALITY
+        cardinality = min(cardinality, INTEGER_LIMITS.get(base_type, cardinality))
+        return f"CAST((i * {SPREAD}) % {cardinality} AS {data_type})"
+
+    if base_type in ("VARCHAR", "CHAR"):
+        if is_key_column(column):
+            value = f"CAST((i * {SPREAD}) % {rows} AS varchar)"
+        else:
+            value = f"concat('{column}_', CAST((i * {SPREAD}) % {LOW_CARDINALITY} AS varchar))"
+        length = LENGTH_PATTERN.search(data_type)
+        if length:
+            value = f"substr({value}, 1, {length.group(1)})"
+        return f"CAST({value} AS {data_type})"
+
+    if base_type in ("DOUBLE", "REAL"):
+        return f"CAST(((i * {SPREAD}) % 100000) / 100.0 AS {data_type})"
+
+    if base_type == "DECIMAL":
+        match = DECIMAL_PATTERN.search(data_type)
+        precision, scale = (int(match.group(1)), int(match.group(2))) if match else (18, 0)
+        return f"CAST(((i * {SPREAD}) % {min(10 ** precision, 100000)}) / {10 ** scale}e0 AS {data_type})"
+
+    if base_type == "BOOLEAN":
+        return "i % 2 = 0"
+
+    if base_type == "DATE":
+        # ~10 years of days
+        return f"date_add('day', (i * {SPREAD}) % 3650, DATE '2015-01-01')"
+
+    if base_type == "TIMESTAMP":
+        value = f"date_add('second', (i * {SPREAD}) % 315360000, TIMESTAMP '2015-01-01 00:00:00')"
+        return f"CAST({value} AS {data_type})"
+
+    # arrays, maps, rows and other types are left empty
+    return f"CAST(NULL AS {data_type})"
+
+
+def synthetic_data_statement(table: TableDefinition, rows: int) -> str:
+    """INSERT that fills a table with rows generated from its column types"""
+    columns = ",\n    ".join(
+        f"{column_generator(column, data_type, rows)} AS \"{column}\"" for column, data_type in table.columns
+    )
+    blocks = max(1, -(-rows // SEQUENCE_BLOCK))
+    return f"""
+INSERT INTO {table.name}
+SELECT
+    {columns}
+FROM (
+    SELECT block * {SEQUENCE_BLOCK} + pos AS i
+    FROM UNNEST(sequence(0, {blocks - 1})) AS b(block)
+    CROSS JOIN UNNEST(sequence(0, {SEQUENCE_BLOCK - 1})) AS p(pos)
+)
+WHERE i < {rows}
+"""
+
+
+def load_synthetic_data(trino: TrinoClustersManager, ddls: List[DDL], rows: int) -> List[ExceptionDuringQuery]:
+    """Fill all tables of the DDLs with synthetic data. Returns errors of tables that were not filled"""
+    errors = []
+    for ddl in ddls:
+        table = parse_table_ddl(ddl.ddl_script)
+        if table is None or not table.columns:
+            continue
+        statement = synthetic_data_statement(table, rows)
+        status, error = execute_statement_in_trino(trino, statement)
+        if status == -1:
+            errors.append(to_validation_error(statement, error))
+        else:
+            logger.info(f"Loaded {rows} rows into {table.name}")
+    return errors
+
+
+def run_migrations(trino: TrinoClustersManager, migrations: List[Migration]) -> Optional[ExceptionDuringQuery]:
+    """Really run migrations in their order. Returns the first error"""
+    for migration in migrations:
+        status, error = execute_statement_in_trino(trino, migration.statement)
+        if status == -1:
+            return to_validation_error(migration.statement, error)
+    return None
+
+
+def median_run(runs: List[QueryRun]) -> QueryRun:
+    """Run with the median elapsed time. A failed run is returned as is, the query fails every time"""
+    failed = [run for run in runs if run.error is not None]
+    if failed:
+        return failed[0]
+    median = statistics.median_low(run.elapsed_ms for run in runs)
+    return next(run for run in runs if run.elapsed_ms == median)
+
+
+def benchmark_queries(
+    trino: TrinoClustersManager, originals: List[SQL], rewrites: Dict[str, SQL], runs: int = BENCHMARK_RUNS
+) -> List[QueryBenchmark]:
+    """
+    Time every original query against its rewrite. Runs of the two alternate, so a slow period of the cluster
+    affects both of them. Queries are run one by one, concurrent runs would distort timings.
+    """
+    results = []
+    for original in originals:
+        rewrite = rewrites.get(original.query_id)
+        original_runs, optimized_runs = [], []
+        for _ in range(max(1, runs)):
+            original_runs.append(benchmark_statement_in_trino(trino, original.query))
+            if rewrite is not None:
+                optimized_runs.append(benchmark_statement_in_trino(trino, rewrite.query))
+
+        result = QueryBenchmark(
+            query_id=original.query_id,
+            original=median_run(original_runs),
+            optimized=median_run(optimized_runs) if optimized_runs else None,
+        )
+        logger.info(f"Benchmark of query {original.query_id}: {format_speedup(result)}")
+        results.append(result)
+    return results
+
+
+def speedup(result: QueryBenchmark) -> Optional[float]:
+    """How many times the rewrite is faster than the original query. None if any of them failed"""
+    if result.optimized is None or result.original.error is not None or result.optimized.error is not None:
+        return None
+    if not result.optimized.elapsed_ms:
+        return None
+    return result.original.elapsed_ms / result.optimized.elapsed_ms
+
+
+def format_speedup(result: QueryBenchmark) -> str:
+    for name, run in (("original", result.original), ("rewrite", result.optimized)):
+        if run is not None and run.error is not None:
+            return f"{name} failed: {run.error[:200]}"
+    if result.optimized is None:
+        return f"original {result.original.elapsed_ms:.0f} ms, no rewrite"
+    return (
+        f"original {result.original.elapsed_ms:.0f} ms, rewrite {result.optimized.elapsed_ms:.0f} ms, "
+        f"speedup {speedup(result):.2f}x"
+    )
+
+
+def run_benchmark(
+    trino: TrinoClustersManager,
+    data_input: DataInput,
+    migrations: List[Migration],
+    sqls: List[SQL],
+    scale_factor: float = BENCHMARK_SCALE_FACTOR,
+    runs: int = BENCHMARK_RUNS,
+) -> List[QueryBenchmark]:
+    """
+    Measure rewrites on synthetic data. Source tables must exist in the local cluster, and new tables
+    must be created (and empty). Source tables are filled with generated data, migrations are run,
+    then every original query is timed against its rewrite.
+    If migrations fail, only the original queries are measured.
+    """
+    rows = max(1, int(scale_factor * BENCHMARK_ROWS_PER_SCALE))
+    logger.info(f"Benchmark: loading {rows} rows into every source table")
+    errors = load_synthetic_data(trino, data_input.ddls, rows)
+    if errors:
+        logger.error(f"Benchmark: could not load synthetic data: {[str(e) for e in errors]}")
+
+    rewrites = {sql.query_id: sql for sql in sqls}
+    error = run_migrations(trino, migrations)
+    if error is not None:
+        logger.error(f"Benchmark: migration failed, rewrites are not measured: {error}")
+        rewrites = {}
+
+    return benchmark_queries(trino, data_input.sqls, rewrites, runs)
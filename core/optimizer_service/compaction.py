@@ -0,0 +1,137 @@
+import logging
+import os
+import re
+import threading
+from typing import Dict, List, Optional, Set
+
+import sqlglot
+from sqlglot import exp
+from sqlglot.optimizer.scope import traverse_scope
+
+from core.optimizer_service.pydantic_models import DDL, SQL
+from core.optimizer_service.workload import (
+    DIALECT,
+    TableDefinition,
+    get_schema,
+    parse_and_qualify,
+    parse_table_ddl,
+    resolve_column,
+    table_name,
+)
+
+logger = logging.getLogger(__name__)
+
+PROMPT_COMPACTION = os.getenv("PROMPT_COMPACTION", "1") == "1"
+# tiktoken encoding used to count prompt tokens. Qwen has its own tokenizer, so the counts are an estimate
+TOKEN_ENCODING = os.getenv("TOKEN_ENCODING", "cl100k_base")
+# properties that do not help to optimize queries
+IGNORED_PROPERTIES = re.compile(r"^\s*format(_version)?\s*=", re.IGNORECASE)
+
+_encoding = None
+_encoding_lock = threading.Lock()
+
+
+def _get_encoding():
+    global _encoding
+    with _encoding_lock:
+        if _encoding is None:
+            try:
+                import tiktoken
+
+                _encoding = tiktoken.get_encoding(TOKEN_ENCODING)
+            except Exception as e:
+                # the encoding is downloaded on first use, which fails without internet access
+                logger.warning(f"Could not load tiktoken encoding {TOKEN_ENCODING}, token counts are estimated: {e}")
+                _encoding = False
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    """Number of tokens in a text. Estimated as 4 characters per token if tiktoken is not available"""
+    encoding = _get_encoding()
+    if not encoding:
+        return len(text) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def token_report(name: str, before: str, after: str) -> str:
+    before_tokens, after_tokens = count_tokens(before), count_tokens(after)
+    saved = 1 - after_tokens / before_tokens if before_tokens else 0.0
+    return f"{name}: {before_tokens} -> {after_tokens} tokens ({saved:.0%} less)"
+
+
+def referenced_columns(sqls: List[SQL], schema: Dict[str, Dict[str, str]]) -> Dict[str, Set[str]]:
+    """
+    Columns of the source tables that the queries reference, by table.
+    If a column can not be traced to a table, it is kept in every table of its scope that has such a column.
+    If a query can not be parsed, all columns of the tables it mentions are kept.
+    """
+    used = {}
+    for sql in sqls:
+        tree = parse_and_qualify(sql.query, schema)
+        if tree is None:
+            for table, columns in schema.items():
+                if re.search(rf"\b{re.escape(table.split('.')[-1])}\b", sql.query, re.IGNORECASE):
+                    used.setdefault(table, set()).update(columns)
+            continue
+
+        for scope in traverse_scope(tree):
+            tables = [table_name(source) for source in scope.sources.values() if isinstance(source, exp.Table)]
+            for table in tables:
+                used.setdefault(table, set())
+            for column in scope.columns:
+                source = resolve_column(scope, column)
+                if source is not None:
+                    used.setdefault(source[0], set()).add(source[1])
+                    continue
+                for table in tables:
+                    if column.name.lower() in schema.get(table, {}):
+                        used[table].add(column.name.lower())
+    return used
+
+
+def render_table(table: TableDefinition) -> str:
+    """Compact canonical form of a table: one line, types in lower case, no storage format properties"""
+    columns = ", ".join(f"{column} {data_type.lower()}" for column, data_type in table.columns)
+    properties = [p for p in table.properties if not IGNORED_PROPERTIES.match(p)]
+    with_clause = f" WITH ({', '.join(properties)})" if properties else ""
+    return f"CREATE TABLE {table.name} ({columns}){with_clause}"
+
+
+def compact_source_ddls(ddls: List[DDL], sqls: List[SQL]) -> List[str]:
+    """
+    Source DDLs pruned to the tables and columns that the queries reference, in compact form.
+    A table read without any column (e.g. by COUNT(*)) keeps its first column, so the DDL stays valid.
+    """
+    schema = get_schema(ddls)
+    used = referenced_columns(sqls, schema)
+    result = []
+    for ddl in ddls:
+        table = parse_table_ddl(ddl.ddl_script)
+        if table is None or not table.columns:
+            result.append(compact_statement(ddl.ddl_script))
+            continue
+        if table.name not in used:
+            continue
+        columns = [column for column in table.columns if column[0] in used[table.name]] or table.columns[:1]
+        result.append(render_table(table._replace(columns=columns)))
+    return result
+
+
+def compact_statement(statement: str) -> str:
+    """Statement on a single line with normalized whitespace. Returned as is if it can not be parsed"""
+    try:
+        return sqlglot.parse_one(statement, read=DIALECT).sql(dialect=DIALECT)
+    except Exception:
+        return " ".join(statement.split())
+
+
+def render_data_input(ddls: List[str], sqls: List[SQL]) -> str:
+    """DDLs and queries for the schema design prompt"""
+    queries = "\n".join(f"{i}. {' '.join(sql.query.split())}" for i, sql in enumerate(sqls, start=1))
+    return "DDLS:\n" + "\n".join(ddls) + "\n\nQUERIES:\n" + queries
+
+
+def render_new_ddls(ddls: List[DDL]) -> str:
+    """New tables for the query rewrite prompt, one compact statement per line"""
+    return "\n".join(compact_statement(ddl.ddl_script) for ddl in ddls)
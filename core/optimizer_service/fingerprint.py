@@ -0,0 +1,216 @@
+import hashlib
+import logging
+from collections import Counter
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import sqlglot
+from sqlglot import exp
+from pydantic import BaseModel, Field
+
+from core.optimizer_service.pydantic_models import SQL
+
+logger = logging.getLogger(__name__)
+
+DIALECT = "trino"
+
+# literals that are operands of these predicates are parameters of the query.
+# Other literals (select list, function arguments like date_trunc('month', ...), LIMIT) define its shape
+PREDICATES = (exp.EQ, exp.NEQ, exp.GT, exp.GTE, exp.LT, exp.LTE, exp.Like, exp.ILike, exp.Between, exp.In)
+# nodes that may wrap a parameter literal, e.g. -1 or DATE '2024-01-01'
+LITERAL_WRAPPERS = (exp.Neg, exp.Cast, exp.Paren)
+
+
+class QueryGroup(BaseModel):
+    """Queries that differ only in literals of their predicates"""
+
+    fingerprint: Optional[str] = Field(description="Hash of the normalized query. None if the query was not parsed")
+    representative: SQL = Field(description="The query that is optimized for the whole group")
+    members: List[SQL] = Field(default_factory=list, description="Other queries of the group")
+
+
+class _Parameter(NamedTuple):
+    key: str  # canonical text of the value. IN-lists are sorted
+    node: exp.Expression  # node that holds the value in the tree
+    values: List[exp.Expression]  # several values for IN-lists, one otherwise
+
+
+def _parse(query: str) -> Optional[exp.Expression]:
+    try:
+        return sqlglot.parse_one(query, read=DIALECT)
+    except Exception as e:
+        logger.info(f"Could not parse query for fingerprinting: {e}")
+        return None
+
+
+def _literal_root(literal: exp.Literal) -> Optional[exp.Expression]:
+    """Outermost node of a literal value if that value is an operand of a predicate"""
+    root = literal
+    while isinstance(root.parent, LITERAL_WRAPPERS):
+        root = root.parent
+    if isinstance(root.parent, PREDICATES):
+        return root
+    return None
+
+
+def _is_value(node: exp.Expression) -> bool:
+    """Literal, possibly wrapped into negation / cast / parentheses"""
+    while isinstance(node, LITERAL_WRAPPERS):
+        node = node.this
+    return isinstance(node, exp.Literal)
+
+
+def _collect_parameters(tree: exp.Expression) -> List[_Parameter]:
+    parameters = []
+    seen = set()
+    for node in tree.walk():
+        if isinstance(node, exp.In) and node.expressions and all(_is_value(e) for e in node.expressions):
+            values = sorted(node.expressions, key=lambda e: e.sql(dialect=DIALECT))
+            key = "IN(" + ", ".join(e.sql(dialect=DIALECT) for e in values) + ")"
+            parameters.append(_Parameter(key, node, values))
+            seen.update(id(e) for e in node.expressions)
+        elif isinstance(node, exp.Literal):
+            root = _literal_root(node)
+            if root is None or id(root) in seen:
+                continue
+            seen.add(id(root))
+            parameters.append(_Parameter(root.sql(dialect=DIALECT), root, [root]))
+    return parameters
+
+
+def _normalize(query: str) -> Optional[Tuple[str, List[_Parameter]]]:
+    """
+    Replace predicate literals with placeholders, lowercase unquoted identifiers,
+    and render the query in canonical form (whitespace, keyword case).
+    Returns the template and the parameters of the query.
+    """
+    tree = _parse(query)
+    if tree is None:
+        return None
+
+    parameters = _collect_parameters(tree)
+    template = tree.copy()
+    for parameter in _collect_parameters(template):
+        if isinstance(parameter.node, exp.In):
+            parameter.node.set("expressions", [exp.Placeholder()])
+        else:
+            parameter.node.replace(exp.Placeholder())
+
+    for identifier in template.find_all(exp.Identifier):
+        if not identifier.quoted:
+            identifier.set("this", identifier.this.lower())
+
+    return template.sql(dialect=DIALECT), parameters
+
+
+def fingerprint_query(query: str) -> Optional[str]:
+    """Hash of the query shape. Queries that differ only in predicate literals get the same fingerprint"""
+    normalized = _normalize(query)
+    if normalized is None:
+        return None
+    return hashlib.sha1(normalized[0].encode()).hexdigest()[:16]
+
+
+def group_queries_by_shape(sqls: List[SQL]) -> List[QueryGroup]:
+    """
+    Group queries by fingerprint. The first query of a group becomes its representative,
+    so with input ordered by weight it is the heaviest one. Groups keep the input order.
+    """
+    groups: Dict[str, QueryGroup] = {}
+    result = []
+    for sql in sqls:
+        fingerprint = fingerprint_query(sql.query)
+        if fingerprint is not None and fingerprint in groups:
+            groups[fingerprint].members.append(sql)
+            continue
+
+        group = QueryGroup(fingerprint=fingerprint, representative=sql)
+        if fingerprint is not None:
+            groups[fingerprint] = group
+        result.append(group)
+
+    return result
+
+
+def _canonical(node: exp.Expression) -> str:
+    """Text of an expression without column qualifiers, with lowercase identifiers"""
+    node = node.copy()
+    for column in list(node.find_all(exp.Column)):
+        for part in ("table", "db", "catalog"):
+            column.set(part, None)
+    for identifier in node.find_all(exp.Identifier):
+        identifier.set("this", identifier.this.lower())
+    return node.sql(dialect=DIALECT)
+
+
+def _context(parameter: _Parameter) -> str:
+    """
+    Position of a parameter in its predicate: the predicate type, the operand the value is, and the other
+    operands with their values replaced by placeholders, e.g. "GTE:expression:departure_date"
+    """
+    node = parameter.node
+    if isinstance(node, exp.In):
+        return f"In:{_canonical(node.this)}"
+    predicate = node.parent
+    operands = sorted(
+        "?" if _is_value(value) else _canonical(value)
+        for key, value in predicate.args.items()
+        if isinstance(value, exp.Expression) and value is not node
+    )
+    return f"{type(predicate).__name__}:{node.arg_key}:{','.join(operands)}"
+
+
+def _literal_texts(tree: exp.Expression) -> Counter:
+    """How many times every literal occurs in the tree, in any position (predicates, LIMIT, select list)"""
+    return Counter(literal.sql(dialect=DIALECT) for literal in tree.find_all(exp.Literal))
+
+
+def apply_rewrite(representative: str, rewrite: str, member: str) -> Optional[str]:
+    """
+    Build the rewrite of a group member from the rewrite of the representative,
+    by substituting literals of the member into it.
+    Every literal of the representative that differs in the member must occur exactly once in the rewrite
+    (and once in the representative), in the same predicate position. Otherwise the value may have been
+    reused elsewhere in the rewrite or baked into the new schema, so None is returned and the member
+    is optimized on its own.
+    """
+    representative_normalized, member_normalized = _normalize(representative), _normalize(member)
+    representative_tree, rewrite_tree = _parse(representative), _parse(rewrite)
+    if representative_normalized is None or member_normalized is None or rewrite_tree is None:
+        return None
+    if representative_normalized[0] != member_normalized[0]:
+        return None
+
+    changed = {}
+    for old, new in zip(representative_normalized[1], member_normalized[1]):
+        if old.key == new.key:
+            continue
+        if old.key in changed:
+            # the value occurs more than once in the representative
+            return None
+        changed[old.key] = (old, new)
+    if not changed:
+        return rewrite_tree.sql(dialect=DIALECT)
+
+    representative_texts, rewrite_texts = _literal_texts(representative_tree), _literal_texts(rewrite_tree)
+    for old, _ in changed.values():
+        for text in {literal.sql(dialect=DIALECT) for value in old.values for literal in value.find_all(exp.Literal)}:
+            if representative_texts[text] != 1 or rewrite_texts[text] != 1:
+                return None
+
+    found = set()
+    for parameter in _collect_parameters(rewrite_tree):
+        if parameter.key not in changed:
+            continue
+        old, new = changed[parameter.key]
+        if _context(parameter) != _context(old) or isinstance(parameter.node, exp.In) != isinstance(new.node, exp.In):
+            return None
+        if isinstance(parameter.node, exp.In):
+            parameter.node.set("expressions", [value.copy() for value in new.values])
+        else:
+            parameter.node.replace(new.node.copy())
+        found.add(parameter.key)
+
+    if found != set(changed):
+        return None
+
+    return rewrite_tree.sql(dialect=DIALECT)
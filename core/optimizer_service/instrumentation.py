@@ -0,0 +1,97 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Iterator, List, Optional
+
+from langchain_core.messages import BaseMessage
+
+from core.optimizer_service.compaction import count_tokens
+from core.optimizer_service.pydantic_models import StageSpan
+
+logger = logging.getLogger(__name__)
+
+
+class SpanBuilder:
+    """Attributes of a span that become known while the stage is running"""
+
+    def __init__(self):
+        self.prompt_tokens: Optional[int] = None
+        self.completion_tokens: Optional[int] = None
+
+    def set_tokens(self, prompt: List[BaseMessage], completion: BaseMessage):
+        """Token usage reported by the provider, or estimated from the text if it is not reported"""
+        usage = getattr(completion, "usage_metadata", None)
+        if usage:
+            self.prompt_tokens, self.completion_tokens = usage["input_tokens"], usage["output_tokens"]
+            return
+        self.prompt_tokens = sum(count_tokens(str(message.content)) for message in prompt)
+        self.completion_tokens = count_tokens(str(completion.content))
+
+
+class StageRecorder:
+    """Thread-safe collection of the stage spans of one task"""
+
+    def __init__(self, task_id: str):
+        self.task_id = task_id
+        self._spans: List[StageSpan] = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(
+        self, stage: str, iteration: Optional[int] = None, query_id: Optional[str] = None
+    ) -> Iterator[SpanBuilder]:
+        builder = SpanBuilder()
+        started_at = datetime.now(timezone.utc)
+        start = time.monotonic()
+        error = None
+        try:
+            yield builder
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            span = StageSpan(
+                stage=stage,
+                started_at=started_at,
+                duration_ms=(time.monotonic() - start) * 1000,
+                iteration=iteration,
+                query_id=query_id,
+                prompt_tokens=builder.prompt_tokens,
+                completion_tokens=builder.completion_tokens,
+                error=error,
+            )
+            with self._lock:
+                self._spans.append(span)
+
+    def spans(self) -> List[StageSpan]:
+        with self._lock:
+            return list(self._spans)
+
+
+# a worker runs one task at a time, so spans of the whole process go to the recorder of the current task
+_recorder: Optional[StageRecorder] = None
+
+
+@contextmanager
+def recording(task_id: str) -> Iterator[StageRecorder]:
+    """Record the spans of all stages run inside the block"""
+    global _recorder
+    _recorder = StageRecorder(task_id)
+    try:
+        yield _recorder
+    finally:
+        _recorder = None
+
+
+@contextmanager
+def stage(name: str, iteration: Optional[int] = None, query_id: Optional[str] = None) -> Iterator[SpanBuilder]:
+    """Span of a stage for the current task. Only measured if there is no current task"""
+    recorder = _recorder
+    if recorder is None:
+        yield SpanBuilder()
+        return
+    with recorder.span(name, iteration, query_id) as builder:
+        yield builder
+
@@ -1,11 +1,29 @@
 import logging
-import json
-import time
+import os
+import socket
+import threading
+from typing import Callable, List, Optional
 
-from core.db.database import execute_query
-from core.optimizer_service.run import run_pipeline, DataOutput
+from core.db.database import (
+    execute_query,
+    execute_transaction,
+    NotificationListener,
+    NEW_TASK_CHANNEL,
+    TASK_EVENTS_CHANNEL,
+)
+from core.db.stage_metrics import STAGE_TOTALS_QUERY, stage_totals
+from core.optimizer_service.instrumentation import recording, stage
+from core.optimizer_service.pydantic_models import DDL, SQL, Migration, StageSpan
+from core.optimizer_service.run import TASK_DEADLINE_SECONDS, run_pipeline, DataOutput
+from core.optimizer_service.scheduling import Deadline
 
-SLEEP_TIME = 5
+# workers are woken up by NOTIFY from /new. Polling is only a fallback for lost notifications and expired leases
+FALLBACK_POLL_TIME = int(os.getenv("FALLBACK_POLL_TIME", "30"))
+# identifier of this optimizer process. Claimed tasks are leased to it
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+# a claimed task goes back to the queue if the lease is not renewed in time
+LEASE_SECONDS = int(os.getenv("TASK_LEASE_SECONDS", "120"))
+HEARTBEAT_INTERVAL = LEASE_SECONDS / 4
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
@@ -13,19 +31,94 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(level
 logger = logging.getLogger(__name__)
 
 
-def get_next_task():
+def claim_next_task():
+    """
+    Atomically claim one queued task for this worker, the one with the earliest dequeue_at.
+    Concurrent workers skip rows locked by each other, so a task is never claimed twice.
+    """
     query = """
-        SELECT taskid
-        FROM public.tasks
-        WHERE status = 'RUNNING'
-        LIMIT 1
+        UPDATE public.tasks
+        SET status = 'CLAIMED',
+            worker_id = :worker_id,
+            lease_expires_at = now() + make_interval(secs => :lease_seconds)
+        WHERE taskid = (
+            SELECT taskid
+            FROM public.tasks
+            WHERE status = 'RUNNING'
+            ORDER BY dequeue_at
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING taskid
     """
-    result = execute_query(query)
+    result = execute_query(query, {"worker_id": WORKER_ID, "lease_seconds": LEASE_SECONDS})
     if result:
-        return result[0][0]  # Return the first task ID
+        return result[0][0]  # Return the claimed task ID
     return None
 
 
+def renew_lease(task_id: str) -> bool:
+    """Extend the lease of a claimed task. Returns False if the task is not owned by this worker anymore"""
+    query = """
+        UPDATE public.tasks
+        SET lease_expires_at = now() + make_interval(secs => :lease_seconds)
+        WHERE taskid = :taskid AND worker_id = :worker_id AND status = 'CLAIMED'
+        RETURNING taskid
+    """
+    result = execute_query(query, {"taskid": task_id, "worker_id": WORKER_ID, "lease_seconds": LEASE_SECONDS})
+    return bool(result)
+
+
+def requeue_expired_tasks():
+    """Put tasks of crashed workers (expired lease) back to the queue"""
+    query = """
+        UPDATE public.tasks
+        SET status = 'RUNNING', worker_id = NULL, lease_expires_at = NULL
+        WHERE status = 'CLAIMED' AND lease_expires_at < now()
+        RETURNING taskid
+    """
+    result = execute_query(query) or []
+    for row in result:
+        logger.warning(f"Lease of task {row[0]} expired. Task is returned to the queue")
+
+
+class LeaseHeartbeat:
+    """
+    Background thread that renews the lease of a task while the pipeline is running.
+    on_lost is called once if the task was taken away from this worker (the lease expired and it was requeued)
+    """
+
+    def __init__(
+        self, task_id: str, interval: float = HEARTBEAT_INTERVAL, on_lost: Optional[Callable[[], None]] = None
+    ):
+        self.task_id = task_id
+        self.interval = interval
+        self.on_lost = on_lost
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"heartbeat-{task_id}", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                if not renew_lease(self.task_id):
+                    logger.warning(f"Lost the lease of task {self.task_id}")
+                    self.lost = True
+                    if self.on_lost is not None:
+                        self.on_lost()
+                    return
+            except Exception as e:
+                logger.error(f"Failed to renew lease of task {self.task_id}: {e}")
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
 def get_json_by_task(task_id: str):
     # Get task information (URL)
     task_query = """
@@ -74,73 +167,261 @@ def get_json_by_task(task_id: str):
     return data
 
 
+def task_event(task_id: str):
+    """Statement that tells API streams the task changed. Delivered only when the transaction commits"""
+    return "SELECT pg_notify(:channel, :taskid)", {"channel": TASK_EVENTS_CHANNEL, "taskid": task_id}
+
+
 def save_result(task_id: str, data: DataOutput):
-    # Insert into result ddls table
-    for ddl in data.ddls:
-        task_query = """
-                INSERT INTO public.result_ddls (taskid, statement) 
-                VALUES (:taskid, :statement)
-            """
-        execute_query(task_query, {"taskid": task_id, "statement": ddl.ddl_script})
-
-    # Insert into result migrations table
-    for mig in data.migrations:
-        task_query = """
-                INSERT INTO public.result_migrations (taskid, statement) 
-                VALUES (:taskid, :statement)
-            """
-        execute_query(task_query, {"taskid": task_id, "statement": mig.statement})
-
-    # Insert into result sqls table
-    for sql in data.sqls:
-        task_query = """
-                INSERT INTO public.result_queries (taskid, queryid, query) 
-                VALUES (:taskid, :queryid, :query)
-            """
-        execute_query(task_query, {"taskid": task_id, "queryid": sql.query_id, "query": sql.query})
+    """
+    Save results and mark the task DONE in a single transaction.
+    Nothing is written if the task is not owned by this worker anymore.
+    """
+    owner = {"taskid": task_id, "worker_id": WORKER_ID}
 
     # make task status DONE
-    task_query = """
-            UPDATE public.tasks
-            SET status = 'DONE'
-            WHERE taskid = :taskid
+    status_query = """
+        UPDATE public.tasks
+        SET status = 'DONE', lease_expires_at = NULL
+        WHERE taskid = :taskid AND worker_id = :worker_id AND status = 'CLAIMED'
+    """
+    # result rows are written only if the status update above went through
+    owned = owned_condition("DONE")
+    # partial results saved while the pipeline was running are replaced by the final ones
+    delete_queries = [
+        f"DELETE FROM public.{table} WHERE taskid = :taskid AND {owned}"
+        for table in ("result_ddls", "result_migrations", "result_queries")
+    ]
+    ddl_query = f"""
+        INSERT INTO public.result_ddls (taskid, statement)
+        SELECT :taskid, :statement WHERE {owned}
+    """
+    migration_query = f"""
+        INSERT INTO public.result_migrations (taskid, statement)
+        SELECT :taskid, :statement WHERE {owned}
+    """
+    sql_query = f"""
+        INSERT INTO public.result_queries (taskid, queryid, query, original_cost, estimated_cost)
+        SELECT :taskid, :queryid, :query, :original_cost, :estimated_cost WHERE {owned}
+    """
+    profile_query = f"""
+        INSERT INTO public.task_workload_profiles (taskid, profile)
+        SELECT :taskid, CAST(:profile AS jsonb) WHERE {owned}
+    """
+    profiles = [{**owner, "profile": data.workload_profile.model_dump_json()}] if data.workload_profile else []
+    benchmark_query = f"""
+        INSERT INTO public.benchmark_results (
+            taskid, queryid, variant, elapsed_ms, wall_time_ms, cpu_time_ms, processed_rows,
+            processed_bytes, physical_input_bytes, peak_memory_bytes, output_rows, error
+        )
+        SELECT
+            :taskid, :queryid, :variant, :elapsed_ms, :wall_time_ms, :cpu_time_ms, :processed_rows,
+            :processed_bytes, :physical_input_bytes, :peak_memory_bytes, :output_rows, :error
+        WHERE {owned}
+    """
+    benchmark_runs = [
+        {**owner, "queryid": result.query_id, "variant": variant, **run.model_dump()}
+        for result in data.benchmark
+        for variant, run in (("original", result.original), ("optimized", result.optimized))
+        if run is not None
+    ]
+
+    execute_transaction(
+        [
+            (status_query, owner),
+            *[(delete_query, owner) for delete_query in delete_queries],
+            (ddl_query, [{**owner, "statement": ddl.ddl_script} for ddl in data.ddls]),
+            (migration_query, [{**owner, "statement": mig.statement} for mig in data.migrations]),
+            (
+                sql_query,
+                [
+                    {
+                        **owner,
+                        "queryid": sql.query_id,
+                        "query": sql.query,
+                        "original_cost": sql.original_cost,
+                        "estimated_cost": sql.estimated_cost,
+                    }
+                    for sql in data.sqls
+                ],
+            ),
+            (profile_query, profiles),
+            (benchmark_query, benchmark_runs),
+            task_event(task_id),
+        ]
+    )
+
+
+def owned_condition(status: str) -> str:
+    """SQL condition that the task has the given status and is owned by this worker"""
+    return f"""
+        EXISTS (
+            SELECT 1 FROM public.tasks
+            WHERE taskid = :taskid AND worker_id = :worker_id AND status = '{status}'
+        )
+    """
+
+
+class ResultSink:
+    """
+    Saves validated artifacts while the pipeline is still running, so a partial result survives
+    a crash or the deadline. Nothing is written if the task is not claimed by this worker anymore.
+    Errors are logged and do not stop the pipeline: the final result is saved by save_result anyway.
+    """
+
+    def __init__(self, task_id: str):
+        self.task_id = task_id
+        self.saved = False
+        self._owner = {"taskid": task_id, "worker_id": WORKER_ID}
+
+    def save_schema(self, ddls: List[DDL], migrations: List[Migration]):
+        owned = owned_condition("CLAIMED")
+        queries = [
+            (f"DELETE FROM public.{table} WHERE taskid = :taskid AND {owned}", self._owner)
+            for table in ("result_ddls", "result_migrations", "result_queries")
+        ]
+        queries += [
+            (
+                f"INSERT INTO public.result_ddls (taskid, statement) SELECT :taskid, :statement WHERE {owned}",
+                [{**self._owner, "statement": ddl.ddl_script} for ddl in ddls],
+            ),
+            (
+                f"INSERT INTO public.result_migrations (taskid, statement) SELECT :taskid, :statement WHERE {owned}",
+                [{**self._owner, "statement": mig.statement} for mig in migrations],
+            ),
+            task_event(self.task_id),
+        ]
+        try:
+            with stage("saving"):
+                execute_transaction(queries)
+            self.saved = True
+            logger.info(f"Saved schema of task {self.task_id}: {len(ddls)} DDLs, {len(migrations)} migrations")
+        except Exception as e:
+            logger.error(f"Failed to save schema of task {self.task_id}: {e}")
+
+    def save_query(self, sql: SQL):
+        query = f"""
+            INSERT INTO public.result_queries (taskid, queryid, query, original_cost, estimated_cost)
+            SELECT :taskid, :queryid, :query, :original_cost, :estimated_cost WHERE {owned_condition("CLAIMED")}
+            ON CONFLICT (taskid, queryid) DO UPDATE
+            SET query = EXCLUDED.query,
+                original_cost = EXCLUDED.original_cost,
+                estimated_cost = EXCLUDED.estimated_cost
         """
-    execute_query(task_query, {"taskid": task_id})
+        params = {
+            **self._owner,
+            "queryid": sql.query_id,
+            "query": sql.query,
+            "original_cost": sql.original_cost,
+            "estimated_cost": sql.estimated_cost,
+        }
+        try:
+            with stage("saving", query_id=sql.query_id):
+                execute_transaction([(query, params), task_event(self.task_id)])
+        except Exception as e:
+            logger.error(f"Failed to save query {sql.query_id} of task {self.task_id}: {e}")
+
+
+def complete_task(task_id: str):
+    """Mark the task DONE keeping the partial result saved by ResultSink"""
+    task_query = """
+        UPDATE public.tasks
+        SET status = 'DONE', lease_expires_at = NULL
+        WHERE taskid = :taskid AND worker_id = :worker_id AND status = 'CLAIMED'
+    """
+    execute_transaction([(task_query, {"taskid": task_id, "worker_id": WORKER_ID}), task_event(task_id)])
 
 
 def fail_task(task_id: str):
     task_query = """
         UPDATE public.tasks
-        SET status = 'FAILED'
-        WHERE taskid = :taskid
+        SET status = 'FAILED', lease_expires_at = NULL
+        WHERE taskid = :taskid AND worker_id = :worker_id
     """
-    execute_query(task_query, {"taskid": task_id})
+    execute_transaction([(task_query, {"taskid": task_id, "worker_id": WORKER_ID}), task_event(task_id)])
 
 
-def main():
-    while True:
-        logger.info("Choosing next task...")
-        task_id = get_next_task()
-        if not task_id:
-            logger.info(f"No new tasks in DB. Sleeping for {SLEEP_TIME}")
-            time.sleep(SLEEP_TIME)
-            continue
+def save_stage_metrics(task_id: str, spans: List[StageSpan]):
+    """
+    Store timing spans of the pipeline stages and add them to the per-stage totals served by /metrics.
+    Failures are only logged, metrics are not worth failing a task
+    """
+    query = """
+        INSERT INTO public.stage_metrics (
+            taskid, stage, iteration, queryid, started_at, duration_ms, prompt_tokens, completion_tokens, error
+        )
+        VALUES (
+            :taskid, :stage, :iteration, :query_id, :started_at, :duration_ms,
+            :prompt_tokens, :completion_tokens, :error
+        )
+    """
+    try:
+        execute_transaction(
+            [
+                (query, [{"taskid": task_id, **span.model_dump()} for span in spans]),
+                (STAGE_TOTALS_QUERY, stage_totals(spans)),
+            ]
+        )
+    except Exception as e:
+        logger.error(f"Failed to save stage metrics of task {task_id}: {e}")
 
-        logger.info(f"Next task id {task_id}")
-        logger.info(f"Getting JSON for task {task_id}")
 
-        input_json = get_json_by_task(task_id)
-        logger.info("Running pipeline...")
+def process_task(task_id: str):
+    """
+    Run the pipeline while renewing the lease of the task. If the lease is lost, the pipeline stops
+    at the next stage and nothing is saved: the task belongs to another worker now
+    """
+    logger.info(f"Getting JSON for task {task_id}")
 
-        is_success, data_output = run_pipeline(task_id, input_json)
-        if is_success:
+    input_json = get_json_by_task(task_id)
+    logger.info("Running pipeline...")
+
+    sink = ResultSink(task_id)
+    deadline = Deadline(TASK_DEADLINE_SECONDS)
+    with LeaseHeartbeat(task_id, on_lost=deadline.cancel) as heartbeat, recording(task_id) as recorder:
+        try:
+            with stage("pipeline"):
+                is_success, data_output = run_pipeline(task_id, input_json, sink, deadline)
+        except Exception as e:
+            logger.error(f"Pipeline crashed on task {task_id}: {e}")
+            is_success, data_output = False, None
+
+        if heartbeat.lost:
+            logger.warning(f"Task {task_id} was taken away from this worker. Dropping its result")
+        elif is_success:
             logger.info(f"Successful optimization of task {task_id}")
             logger.info("Saving the results")
-            save_result(task_id, data_output)
+            with stage("saving"):
+                save_result(task_id, data_output)
+        elif sink.saved:
+            logger.info(f"Optimization of task {task_id} did not finish. Keeping the partial result")
+            complete_task(task_id)
         else:
             logger.info("Optimization failed. Skipping the task")
             fail_task(task_id)
 
+    save_stage_metrics(task_id, recorder.spans())
+
+
+def main():
+    logger.info(f"Starting optimizer worker {WORKER_ID}")
+    listener = NotificationListener(NEW_TASK_CHANNEL)
+    # subscribe before the first claim, so tasks created in between are not missed
+    listener.listen()
+
+    while True:
+        requeue_expired_tasks()
+
+        logger.info("Choosing next task...")
+        task_id = claim_next_task()
+        if not task_id:
+            logger.info(f"No new tasks in DB. Waiting for notification (at most {FALLBACK_POLL_TIME}s)")
+            listener.wait(FALLBACK_POLL_TIME)
+            continue
+
+        logger.info(f"Claimed task id {task_id}")
+        process_task(task_id)
+
 
 if __name__ == "__main__":
     main()
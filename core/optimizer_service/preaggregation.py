@@ -0,0 +1,312 @@
+import logging
+import os
+from collections import Counter
+from typing import Callable, Dict, FrozenSet, List, NamedTuple, Optional, Tuple
+
+import sqlglot
+from sqlglot import exp
+
+from core.optimizer_service.pydantic_models import DDL, Migration
+from core.optimizer_service.workload import get_schema, table_name
+
+logger = logging.getLogger(__name__)
+
+DIALECT = "trino"
+# rewrite queries onto pre-aggregated and projected tables of the new schema without the LLM
+RULE_REWRITES = os.getenv("RULE_REWRITES", "1") == "1"
+
+# aggregates of a pre-aggregated table that can be aggregated again over coarser groups
+REAGGREGATED = (exp.Sum, exp.Count, exp.Min, exp.Max)
+# source column types whose AVG is a DOUBLE, so it can be computed as SUM / COUNT
+AVG_AS_DOUBLE_TYPES = ("tinyint", "smallint", "integer", "int", "bigint", "double")
+
+
+class TableView(NamedTuple):
+    """What a table of the new schema holds, in terms of a single source table"""
+
+    table: str  # new table: catalog.schema.table
+    source: str  # source table: catalog.schema.table
+    source_columns: Dict[str, str]  # column -> type of the source table
+    filters: FrozenSet[str]  # canonical conjuncts of the WHERE of the migration
+    columns: Dict[str, str]  # canonical source expression -> new column. Only GROUP BY keys for aggregated tables
+    aggregates: Dict[str, str]  # canonical aggregate of the source -> new column
+    grouped: bool  # one row per group of the source, not per source row
+
+
+class _NotRewritable(Exception):
+    pass
+
+
+def _parse(statement: str) -> Optional[exp.Expression]:
+    try:
+        return sqlglot.parse_one(statement, read=DIALECT)
+    except Exception as e:
+        logger.info(f"Could not parse statement for rule rewrites: {e}")
+        return None
+
+
+def _canonical(node: exp.Expression) -> str:
+    """
+    Text of an expression over the columns of a single table: without column qualifiers,
+    with lowercase identifiers and COUNT(1) written as COUNT(*)
+    """
+    node = node.copy()
+    for column in list(node.find_all(exp.Column)):
+        for part in ("table", "db", "catalog"):
+            column.set(part, None)
+    for identifier in node.find_all(exp.Identifier):
+        identifier.set("this", identifier.this.lower())
+        identifier.set("quoted", False)
+    for count in node.find_all(exp.Count):
+        if isinstance(count.this, exp.Literal):
+            count.set("this", exp.Star())
+    return node.sql(dialect=DIALECT)
+
+
+def _conjuncts(node: Optional[exp.Expression]) -> List[exp.Expression]:
+    if node is None:
+        return []
+    if isinstance(node, exp.Paren):
+        return _conjuncts(node.this) if isinstance(node.this, exp.And) else [node]
+    if isinstance(node, exp.And):
+        return _conjuncts(node.left) + _conjuncts(node.right)
+    return [node]
+
+
+def _single_table(select: exp.Expression) -> Optional[exp.Table]:
+    """The table a SELECT reads, if it reads one table without joins and has no subqueries"""
+    if not isinstance(select, exp.Select) or select.args.get("joins") or select.args.get("with_"):
+        return None
+    if any(node is not select for node in select.find_all(exp.Select)):
+        return None
+    from_ = select.args.get("from_")
+    if from_ is None or not isinstance(from_.this, exp.Table):
+        return None
+    return from_.this
+
+
+def _migration_select(statement: exp.Expression) -> Optional[Tuple[str, Optional[List[str]], exp.Select]]:
+    """(new table, its column list if given, SELECT) of INSERT ... SELECT and CREATE TABLE ... AS SELECT"""
+    if isinstance(statement, exp.Insert) and not statement.args.get("overwrite"):
+        target = statement.this
+        if isinstance(target, exp.Schema):
+            columns = [identifier.name.lower() for identifier in target.expressions]
+            return table_name(target.this), columns, statement.expression
+        if isinstance(target, exp.Table):
+            return table_name(target), None, statement.expression
+    if isinstance(statement, exp.Create) and statement.kind == "TABLE" and isinstance(statement.this, exp.Table):
+        if isinstance(statement.expression, exp.Select):
+            return table_name(statement.this), None, statement.expression
+    return None
+
+
+def _table_view(
+    table: str, names: Optional[List[str]], select: exp.Select, source_schema: Dict[str, Dict[str, str]]
+) -> Optional[TableView]:
+    source = _single_table(select)
+    if source is None or table_name(source) not in source_schema:
+        return None
+    if select.args.get("having") or select.args.get("limit") or select.find(exp.Window):
+        return None
+
+    source_columns = source_schema[table_name(source)]
+    projections = list(select.expressions)
+    if len(projections) == 1 and isinstance(projections[0], exp.Star):
+        projections = [exp.column(column) for column in source_columns]
+    if names is None:
+        names = [projection.alias_or_name.lower() for projection in projections]
+    if len(names) != len(projections):
+        return None
+
+    group = select.args.get("group")
+    keys = []
+    for key in group.expressions if group else []:
+        if isinstance(key, exp.Literal) and key.is_int and 0 < int(key.this) <= len(projections):
+            # GROUP BY 1, 2
+            key = projections[int(key.this) - 1]
+        keys.append(_canonical(key.unalias()))
+    if select.args.get("distinct"):
+        keys += [_canonical(projection.unalias()) for projection in projections]
+    grouped = bool(keys) or any(projection.find(exp.AggFunc) for projection in projections)
+
+    columns, aggregates = {}, {}
+    for projection, name in zip(projections, names):
+        expression = projection.unalias()
+        key = _canonical(expression)
+        if not grouped:
+            if expression.find(exp.Column):
+                columns[key] = name
+        elif isinstance(expression, REAGGREGATED) and not isinstance(expression.this, exp.Distinct):
+            aggregates[key] = name
+        elif key in keys:
+            columns[key] = name
+
+    where = select.args.get("where")
+    filters = frozenset(_canonical(conjunct) for conjunct in _conjuncts(where.this if where else None))
+    return TableView(table, table_name(source), source_columns, filters, columns, aggregates, grouped)
+
+
+def extract_table_views(source_ddls: List[DDL], ddls: List[DDL], migrations: List[Migration]) -> List[TableView]:
+    """
+    Learn from the migrations (and CREATE TABLE AS SELECT) which new tables are projections or
+    pre-aggregations of a single source table. Tables filled by more than one statement are skipped,
+    since their content is a union.
+    """
+    source_schema = get_schema(source_ddls)
+    new_schema = get_schema(ddls)
+
+    selects = []
+    for statement in [ddl.ddl_script for ddl in ddls] + [migration.statement for migration in migrations]:
+        tree = _parse(statement)
+        parsed = _migration_select(tree) if tree is not None else None
+        if parsed is not None:
+            selects.append(parsed)
+
+    filled = Counter(table for table, _, _ in selects)
+    views = []
+    for table, names, select in selects:
+        if filled[table] > 1:
+            continue
+        if names is None and new_schema.get(table):
+            names = list(new_schema[table])
+        view = _table_view(table, names, select, source_schema)
+        if view is not None:
+            views.append(view)
+
+    logger.info(f"New tables usable for rule rewrites: {[view.table for view in views]}")
+    return views
+
+
+def _rewrite_arguments(node: exp.Expression, replace: Callable) -> exp.Expression:
+    """Copy of the node with its arguments rewritten"""
+    root = node.copy()
+    return root.transform(lambda child: child if child is root else replace(child), copy=False)
+
+
+def _reaggregate(
+    node: exp.AggFunc, view: TableView, replace: Callable, global_aggregate: bool
+) -> exp.Expression:
+    """Aggregate over the source rows, computed from the rows of a pre-aggregated table"""
+    argument = node.this
+    if isinstance(argument, exp.Distinct):
+        # COUNT(DISTINCT key), MIN / MAX of keys do not depend on how many rows a group had
+        if isinstance(node, (exp.Count, exp.Min, exp.Max)):
+            return _rewrite_arguments(node, replace)
+        raise _NotRewritable()
+
+    stored = view.aggregates.get(_canonical(node))
+    if isinstance(node, exp.Count) and stored is not None:
+        total = exp.Sum(this=exp.column(stored))
+        # COUNT over no rows is 0, SUM is NULL
+        return exp.Coalesce(this=total, expressions=[exp.Literal.number(0)]) if global_aggregate else total
+    if isinstance(node, exp.Sum) and stored is not None:
+        return exp.Sum(this=exp.column(stored))
+    if isinstance(node, (exp.Min, exp.Max)):
+        if stored is not None:
+            return node.__class__(this=exp.column(stored))
+        return _rewrite_arguments(node, replace)
+    if isinstance(node, exp.Avg) and isinstance(argument, exp.Column):
+        column_type = view.source_columns.get(argument.name.lower(), "").lower()
+        total = view.aggregates.get(_canonical(exp.Sum(this=argument.copy())))
+        count = view.aggregates.get(_canonical(exp.Count(this=argument.copy())))
+        if total is not None and count is not None and column_type.startswith(AVG_AS_DOUBLE_TYPES):
+            return exp.paren(
+                exp.Div(
+                    this=exp.cast(exp.Sum(this=exp.column(total)), "DOUBLE"),
+                    expression=exp.Nullif(this=exp.Sum(this=exp.column(count)), expression=exp.Literal.number(0)),
+                )
+            )
+    raise _NotRewritable()
+
+
+def _rewrite_select(select: exp.Select, view: TableView) -> exp.Select:
+    """The same SELECT reading the new table of the view. Raises _NotRewritable if the view does not fit"""
+    select = select.copy()
+    global_aggregate = not select.args.get("group")
+    aggregating = not global_aggregate or select.args.get("distinct") or select.find(exp.AggFunc)
+    if view.grouped and not aggregating:
+        raise _NotRewritable()
+
+    where = select.args.get("where")
+    conjuncts = {_canonical(conjunct): conjunct for conjunct in _conjuncts(where.this if where else None)}
+    if not view.filters <= set(conjuncts):
+        raise _NotRewritable()
+    residual = [conjunct for key, conjunct in conjuncts.items() if key not in view.filters]
+
+    aliases = {projection.alias.lower() for projection in select.expressions if projection.alias}
+    in_order_by = False
+
+    def replace(node: exp.Expression) -> exp.Expression:
+        if isinstance(node, exp.Column) and not node.table and isinstance(node.this, exp.Identifier):
+            name = node.name.lower()
+            # output column reference. ORDER BY resolves output columns before the source ones
+            if name in aliases and (in_order_by or name not in view.source_columns):
+                return node
+        if isinstance(node, exp.Window) and view.grouped:
+            raise _NotRewritable()
+        if isinstance(node, exp.Star) and not isinstance(node.parent, exp.Count):
+            raise _NotRewritable()
+        if not isinstance(node, (exp.Identifier, exp.Literal, exp.DataType, exp.Star, exp.Alias)):
+            target = view.columns.get(_canonical(node))
+            if target is not None:
+                return exp.column(target)
+        if isinstance(node, exp.AggFunc) and view.grouped:
+            return _reaggregate(node, view, replace, global_aggregate)
+        if isinstance(node, exp.Column):
+            raise _NotRewritable()
+        return node
+
+    projections = []
+    for projection in select.expressions:
+        rewritten = projection.transform(replace)
+        if isinstance(projection, exp.Column) and rewritten.alias_or_name.lower() != projection.name.lower():
+            # keep the output column names
+            rewritten = exp.alias_(rewritten, projection.name)
+        projections.append(rewritten)
+    select.set("expressions", projections)
+    select.set("where", exp.Where(this=exp.and_(*[c.transform(replace) for c in residual])) if residual else None)
+    for clause in ("group", "having", "order"):
+        in_order_by = clause == "order"
+        if select.args.get(clause):
+            select.set(clause, select.args[clause].transform(replace))
+    select.args["from_"].set("this", exp.to_table(view.table))
+    return select
+
+
+def rewrite_onto_views(query: str, views: List[TableView]) -> Optional[str]:
+    """
+    Rewrite a query onto the new tables without the LLM. Every SELECT (including CTEs) that reads
+    a single source table is moved to a projection or pre-aggregation of it. Aggregates are computed
+    again from the stored ones: COUNT -> SUM of counts, SUM -> SUM of sums, MIN / MAX of mins / maxes,
+    AVG -> SUM / COUNT. Filters of the query must contain the filters of the migration, and for
+    pre-aggregated tables the other filters and GROUP BY may use only its keys.
+    Returns None if some part of the query still reads a source table.
+    """
+    tree = _parse(query)
+    if tree is None or not views:
+        return None
+
+    by_source: Dict[str, List[TableView]] = {}
+    # the most aggregated tables have the least rows to read
+    for view in sorted(views, key=lambda view: (not view.grouped, len(view.columns), len(view.aggregates))):
+        by_source.setdefault(view.source, []).append(view)
+
+    for select in list(tree.find_all(exp.Select)):
+        table = _single_table(select)
+        if table is None or table_name(table) not in by_source:
+            continue
+        for view in by_source[table_name(table)]:
+            try:
+                rewritten = _rewrite_select(select, view)
+            except _NotRewritable:
+                continue
+            if select is tree:
+                tree = rewritten
+            else:
+                select.replace(rewritten)
+            break
+
+    allowed = {view.table for view in views} | {cte.alias_or_name.lower() for cte in tree.find_all(exp.CTE)}
+    if any(table_name(table) not in allowed for table in tree.find_all(exp.Table)):
+        return None
+    return tree.sql(dialect=DIALECT)
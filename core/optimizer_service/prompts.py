@@ -42,6 +42,11 @@ WITH (
     sorted_by = ARRAY['c3'],
 );
 
+Here is what the analysis of my workload suggests. Scores show which part of the total workload time benefits from it.
+Use these hints to choose partitioning, sorted_by and pre-aggregated tables. Partition only by low-cardinality
+columns or their transforms (month(), day()), too many small partitions make queries slower:
+{layout_hints}
+
 Write down your answer in a following format, without any additional notes (do not forget to add token #END# at the end of the message
 if you have finished):
 DDLS:
@@ -80,6 +85,14 @@ Here is the query I want to rewrite using new schema:
 """
 )
 
+HUMAN_SQL_QUERY_CANDIDATE_TEMPLATE = HumanMessagePromptTemplate.from_template(
+    """
+This is variant number {variant} of the rewrite. Propose a different rewrite than the most obvious one:
+for example use other new tables, another join order, or filter and aggregate data earlier.
+All requirements above still apply.
+"""
+)
+
 VALIDATOR_MESSAGE_ERROR_TEMPLATE = HumanMessagePromptTemplate.from_template(
     """
 I tried to run your query, and failed with errors.
@@ -1,5 +1,7 @@
+from datetime import datetime
+
 from pydantic import BaseModel, Field
-from typing import List
+from typing import List, Optional
 
 
 class DDL(BaseModel):
@@ -13,6 +15,13 @@ class SQL(BaseModel):
 
     query_id: str = Field(description="Unique identifier of the query. Is needed to map to a new optimized query")
     query: str = Field(description="A single user's query that user wants to be optimized")
+    original_cost: Optional[float] = Field(
+        default=None, repr=False, description="Trino plan cost estimate of the original query"
+    )
+    estimated_cost: Optional[float] = Field(
+        default=None, repr=False, description="Trino plan cost estimate of this query"
+    )
+    weight: float = Field(default=0.0, repr=False, description="Importance of the query: runquantity * executiontime")
 
 
 class DataInput(BaseModel):
@@ -22,6 +31,69 @@ class DataInput(BaseModel):
     sqls: List[SQL] = Field(description="All SQL queries of user. Ordered by importance. From the most important to the least")
 
 
+class ColumnUsage(BaseModel):
+    """How a column of a source table is used by the workload. Values are sums of query weights"""
+
+    table: str = Field(description="Full table name: catalog.schema.table")
+    column: str
+    data_type: Optional[str] = None
+    filtered: float = 0.0
+    range_filtered: float = 0.0
+    joined: float = 0.0
+    grouped: float = 0.0
+    ordered: float = 0.0
+
+
+class LayoutCandidate(BaseModel):
+    """Physical layout suggestion derived from the workload"""
+
+    kind: str = Field(description="partition, sort or preaggregation")
+    table: str = Field(description="Full table name, several names for pre-aggregations over joins")
+    columns: List[str] = Field(description="Partition / sort columns (with transforms) or GROUP BY expressions")
+    score: float = Field(description="Share of the total workload weight that benefits from this candidate")
+    queries: int = Field(description="Number of queries that benefit from this candidate")
+
+
+class WorkloadProfile(BaseModel):
+    columns: List[ColumnUsage] = Field(default_factory=list)
+    candidates: List[LayoutCandidate] = Field(default_factory=list)
+
+
+class QueryRun(BaseModel):
+    """Timings and scan statistics of a single run of a query in the local Trino"""
+
+    elapsed_ms: Optional[float] = Field(default=None, description="Wall clock time measured by the client")
+    wall_time_ms: Optional[int] = Field(default=None, description="Wall time of all query tasks reported by Trino")
+    cpu_time_ms: Optional[int] = None
+    processed_rows: Optional[int] = None
+    processed_bytes: Optional[int] = None
+    physical_input_bytes: Optional[int] = None
+    peak_memory_bytes: Optional[int] = None
+    output_rows: Optional[int] = None
+    error: Optional[str] = Field(default=None, description="Error message if the query failed")
+
+
+class QueryBenchmark(BaseModel):
+    """Original query and its rewrite run on the same synthetic data"""
+
+    query_id: str
+    original: QueryRun
+    optimized: Optional[QueryRun] = Field(default=None, description="None if there is no rewrite of the query")
+
+
+class StageSpan(BaseModel):
+    """Timing of one pipeline stage run"""
+
+    stage: str
+    started_at: datetime
+    duration_ms: float
+    iteration: Optional[int] = Field(default=None, description="Retry loop iteration the stage belongs to")
+    query_id: Optional[str] = None
+    prompt_tokens: Optional[int] = Field(default=None, description="For LLM calls")
+    completion_tokens: Optional[int] = Field(default=None, description="For LLM calls")
+    error: Optional[str] = Field(default=None, description="Exception type if the stage failed")
+
+
 class Migration(BaseModel):
     statement: str = Field(description="An SQL statement that inserts data to the table")
 
@@ -32,6 +104,12 @@ class DataOutput(BaseModel):
         description="Set of SQL statements that migrate data from old schema to a new optimized one"
     )
     sqls: List[SQL] = Field(description="All new optimized variants of the user queries")
+    workload_profile: Optional[WorkloadProfile] = Field(
+        default=None, description="Column usage and layout candidates found in the input queries"
+    )
+    benchmark: List[QueryBenchmark] = Field(
+        default_factory=list, description="Original vs optimized query runs on synthetic data. Empty if disabled"
+    )
 
 
 class ExceptionDuringQuery(BaseModel):
@@ -39,6 +117,14 @@ class ExceptionDuringQuery(BaseModel):
 
     statement: str = Field(description="What statement raised an error")
     msg: str = Field(description="Message that describes error")
+    error_name: Optional[str] = Field(default=None, description="Trino error name, e.g. COLUMN_NOT_FOUND")
+    line: Optional[int] = Field(default=None, description="Line of the statement where the error is located")
+    column: Optional[int] = Field(default=None, description="Column of the statement where the error is located")
+
+    def __str__(self):
+        location = f" (line {self.line}, column {self.column})" if self.line is not None else ""
+        name = f"{self.error_name}: " if self.error_name else ""
+        return f"{name}{self.msg}{location}"
 
 
 class ExceptionsFromCheck(BaseModel):
@@ -0,0 +1,214 @@
+import email.utils
+import logging
+import os
+import random
+import threading
+import time
+from typing import Iterator, List, Optional
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import BaseMessage
+
+from core.db.database import execute_query
+from core.optimizer_service.compaction import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# limits of the LLM provider shared by all pipeline threads and worker processes. 0 means no limit
+LLM_RPM = float(os.getenv("LLM_RPM", "0"))
+LLM_TPM = float(os.getenv("LLM_TPM", "0"))
+# completion tokens reserved for a request before its real size is known
+LLM_EXPECTED_COMPLETION_TOKENS = int(os.getenv("LLM_EXPECTED_COMPLETION_TOKENS", "1000"))
+# retries of a throttled request (HTTP 429 or an empty completion)
+LLM_THROTTLE_RETRIES = int(os.getenv("LLM_THROTTLE_RETRIES", "6"))
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 60.0
+
+# bucket state is kept in Postgres, so all worker processes share it
+ACQUIRE_QUERY = """
+    WITH current AS (
+        SELECT name, least(:capacity, tokens + :rate * extract(epoch FROM clock_timestamp() - updated_at)) AS refilled
+        FROM public.llm_rate_limits
+        WHERE name = :name
+        FOR UPDATE
+    )
+    UPDATE public.llm_rate_limits b
+    SET tokens = CASE WHEN c.refilled >= :cost THEN c.refilled - :cost ELSE c.refilled END,
+        updated_at = clock_timestamp()
+    FROM current c
+    WHERE b.name = c.name
+    RETURNING c.refilled >= :cost, (:cost - c.refilled) / :rate
+"""
+CREATE_BUCKET_QUERY = """
+    INSERT INTO public.llm_rate_limits (name, tokens, updated_at)
+    VALUES (:name, :capacity, clock_timestamp())
+    ON CONFLICT (name) DO NOTHING
+"""
+ADJUST_QUERY = """
+    UPDATE public.llm_rate_limits SET tokens = least(:capacity, greatest(0, tokens - :delta)) WHERE name = :name
+"""
+
+
+class LLMThrottled(Exception):
+    """The provider kept throttling the request after all retries. This is not a failure of the model"""
+
+
+def backoff_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    """Jittered exponential backoff (full jitter). Never shorter than Retry-After of the provider"""
+    delay = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2**attempt))
+    return max(delay, retry_after or 0.0)
+
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """Value of the Retry-After header of a provider error, in seconds"""
+    response = getattr(error, "response", None)
+    value = getattr(response, "headers", {}).get("retry-after") if response is not None else None
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        parsed = email.utils.parsedate_to_datetime(value)
+        return max(0.0, parsed.timestamp() - time.time()) if parsed else None
+
+
+def is_throttling(error: Exception) -> bool:
+    return getattr(error, "status_code", None) == 429 or "RateLimit" in type(error).__name__
+
+
+class TokenBucket:
+    """
+    Token bucket of the given capacity that is refilled at rate units per second. It starts full.
+    The state is kept in Postgres, or in the process if the database is not available.
+    """
+
+    def __init__(self, name: str, per_minute: float):
+        self.name = name
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self._created = False
+        self._local_tokens = float(per_minute)
+        self._local_updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, cost: float):
+        """Block until the bucket has cost units and take them"""
+        cost = min(cost, self.capacity)
+        while True:
+            admitted, wait_seconds = self._try_acquire(cost)
+            if admitted:
+                return
+            time.sleep(wait_seconds + random.uniform(0, 0.1))
+
+    def adjust(self, delta: float):
+        """Correct an earlier reservation by the real cost: delta more units are taken, or -delta are returned"""
+        try:
+            execute_query(ADJUST_QUERY, {"name": self.name, "delta": delta, "capacity": self.capacity})
+        except Exception:
+            with self._lock:
+                self._local_tokens = min(self.capacity, max(0.0, self._local_tokens - delta))
+
+    def empty(self):
+        """The provider throttled us: other callers wait until the bucket is refilled"""
+        self.adjust(self.capacity)
+
+    def _try_acquire(self, cost: float):
+        params = {"name": self.name, "rate": self.rate, "capacity": self.capacity, "cost": cost}
+        try:
+            if not self._created:
+                execute_query(CREATE_BUCKET_QUERY, {"name": self.name, "capacity": self.capacity})
+                self._created = True
+            return execute_query(ACQUIRE_QUERY, params)[0]
+        except Exception as e:
+            logger.warning(f"Shared rate limit {self.name} is not available, using a local one: {e}")
+            return self._try_acquire_local(cost)
+
+    def _try_acquire_local(self, cost: float):
+        with self._lock:
+            now = time.monotonic()
+            self._local_tokens = min(self.capacity, self._local_tokens + self.rate * (now - self._local_updated))
+            self._local_updated = now
+            if self._local_tokens >= cost:
+                self._local_tokens -= cost
+                return True, 0.0
+            return False, (cost - self._local_tokens) / self.rate
+
+
+class RateLimiter:
+    """Requests per minute and tokens per minute limits of the LLM provider"""
+
+    def __init__(self, rpm: float = LLM_RPM, tpm: float = LLM_TPM):
+        self.requests = TokenBucket("llm_requests", rpm) if rpm > 0 else None
+        self.tokens = TokenBucket("llm_tokens", tpm) if tpm > 0 else None
+
+    def acquire(self, prompt_tokens: int) -> int:
+        """Wait for a request slot. Returns the number of reserved tokens"""
+        reserved = prompt_tokens + LLM_EXPECTED_COMPLETION_TOKENS
+        if self.tokens is not None:
+            self.tokens.acquire(reserved)
+        if self.requests is not None:
+            self.requests.acquire(1)
+        return reserved
+
+    def release(self, reserved: int, used: int):
+        if self.tokens is not None and used != reserved:
+            self.tokens.adjust(used - reserved)
+
+    def throttled(self):
+        for bucket in (self.requests, self.tokens):
+            if bucket is not None:
+                bucket.empty()
+
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter() -> RateLimiter:
+    global _rate_limiter
+    with _rate_limiter_lock:
+        if _rate_limiter is None:
+            _rate_limiter = RateLimiter()
+    return _rate_limiter
+
+
+def rate_limited_stream(model: BaseChatModel, messages: List[BaseMessage]) -> Iterator[str]:
+    """
+    Stream the completion text within the provider limits.
+    Throttling (HTTP 429 or an empty completion, which the provider returns when overloaded) is retried
+    with jittered exponential backoff that honours Retry-After. Raises LLMThrottled if it does not stop.
+    Other errors are raised at once. Nothing is retried after the first chunk was yielded.
+    """
+    limiter = get_rate_limiter()
+    prompt_tokens = sum(count_tokens(str(message.content)) for message in messages)
+    for attempt in range(LLM_THROTTLE_RETRIES + 1):
+        reserved = limiter.acquire(prompt_tokens)
+        completion = []
+        retry_after = None
+        used = prompt_tokens  # the provider got the prompt, unless it throttled the request
+        try:
+            for chunk in model.stream(messages):
+                if isinstance(chunk.content, str) and chunk.content:
+                    completion.append(chunk.content)
+                    yield chunk.content
+            if not completion:
+                used = 0
+        except Exception as e:
+            if completion or not is_throttling(e):
+                raise
+            used = 0
+            retry_after = retry_after_seconds(e)
+        finally:
+            # also on GeneratorExit, when the router closes the stream of a cancelled request
+            limiter.release(reserved, used + count_tokens("".join(completion)))
+
+        if completion:
+            return
+
+        # throttled, nothing was generated
+        limiter.throttled()
+        delay = backoff_delay(attempt, retry_after)
+        logger.warning(f"LLM request is throttled, retrying in {delay:.1f}s (attempt {attempt + 1})")
+        time.sleep(delay)
+
+    raise LLMThrottled(f"LLM request is still throttled after {LLM_THROTTLE_RETRIES} retries")
@@ -0,0 +1,211 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+
+from core.optimizer_service.rate_limit import LLMThrottled
+from core.optimizer_service.scheduling import Deadline
+from core.optimizer_service.streaming import stream_text
+
+logger = logging.getLogger(__name__)
+
+# a hedged request to the next model is sent when the first one is slower than this percentile of its latency
+HEDGE_LATENCY_PERCENTILE = float(os.getenv("HEDGE_LATENCY_PERCENTILE", "0.9"))
+# hedge delay while a model has less than HEDGE_MIN_SAMPLES latency samples
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", "30"))
+HEDGE_MIN_SAMPLES = 5
+# latency samples kept per model
+LATENCY_WINDOW = 100
+ROUTER_THREADS = int(os.getenv("LLM_ROUTER_THREADS", "16"))
+
+
+class ModelStats:
+    """Sliding window of completion latencies and counts of accepted and rejected answers of a model"""
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self.latencies = deque(maxlen=window)
+        self.successes = 0
+        self.failures = 0
+
+    def percentile(self, q: float) -> Optional[float]:
+        if len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+    def success_rate(self) -> float:
+        # an unseen model is assumed to be good, so it gets traffic and its statistics
+        return (self.successes + 1) / (self.successes + self.failures + 1)
+
+    def score(self) -> Optional[float]:
+        """Accepted answers per second of latency, higher is better. None until there are enough samples"""
+        median = self.percentile(0.5)
+        if median is None:
+            return None
+        return self.success_rate() / max(median, 1e-3)
+
+    def describe(self) -> str:
+        median, tail = self.percentile(0.5), self.percentile(HEDGE_LATENCY_PERCENTILE)
+        latency = f"p50 {median:.1f}s, p{HEDGE_LATENCY_PERCENTILE * 100:.0f} {tail:.1f}s" if median else "no latency"
+        return f"{latency}, {self.successes} accepted, {self.failures} rejected"
+
+
+class LegResult(NamedTuple):
+    model: str
+    message: Optional[AIMessage]
+    error: Any  # validation error of the answer, or the exception of the request
+    cancelled: bool = False
+    declined: bool = False  # the model answered that it cannot do the task
+
+    @property
+    def accepted(self) -> bool:
+        return (
+            self.message is not None and bool(self.message.content.strip()) and self.error is None and not self.declined
+        )
+
+
+class RoutedResult(NamedTuple):
+    message: AIMessage
+    model: str
+    error: Any  # validation error of the answer, None if it is valid
+
+
+class HedgedModelRouter:
+    """
+    Sends a request to the best model so far, and a hedged request to the next one if the first answer
+    is not ready by the HEDGE_LATENCY_PERCENTILE of the first model latency (or is rejected).
+    The first answer that is not empty and passes validation is returned, the other request is cancelled.
+    A declined answer (the model says the task is impossible) is returned only if no model gives a valid one.
+    Models are ranked by accepted answers per second of median latency, so routing follows
+    the observed latency and quality. Statistics are kept for the lifetime of the process.
+    """
+
+    def __init__(self, models: Dict[str, BaseChatModel]):
+        self.models = models
+        self.stats = {name: ModelStats() for name in models}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=ROUTER_THREADS, thread_name_prefix="llm")
+
+    def ranked(self) -> List[str]:
+        """Model names, the preferred one first. The given order is kept until every model has enough samples"""
+        with self._lock:
+            scores = {name: stats.score() for name, stats in self.stats.items()}
+        if any(score is None for score in scores.values()):
+            return list(self.models)
+        return sorted(self.models, key=lambda name: -scores[name])
+
+    def primary(self) -> BaseChatModel:
+        return self.models[self.ranked()[0]]
+
+    def hedge_delay(self, name: str) -> float:
+        with self._lock:
+            delay = self.stats[name].percentile(HEDGE_LATENCY_PERCENTILE)
+        return HEDGE_DEFAULT_DELAY if delay is None else delay
+
+    def generate(
+        self,
+        messages: List[BaseMessage],
+        validate: Optional[Callable[[str], Any]] = None,
+        declines: Optional[Callable[[str], bool]] = None,
+        deadline: Optional[Deadline] = None,
+    ) -> RoutedResult:
+        """
+        :param validate: returns an error for an invalid answer, None for a valid one.
+        :param declines: tells if an answer declines the task. Such an answer is not validated, it does not win
+        the hedge and does not count as accepted or rejected in the model statistics.
+        If no answer is accepted, the first declined one is returned, otherwise the first one that was received
+        with its error.
+        Raises the exception of the first request if no model answered at all,
+        and TimeoutError if no answer is accepted before the deadline. Requests in flight are cancelled then.
+        """
+        names = self.ranked()
+        cancel = threading.Event()
+        start = time.monotonic()
+        pending = {self._submit(names[0], messages, validate, declines, cancel)}
+        hedges = names[1:]
+        results = []
+        while pending:
+            timeout = max(0.0, self.hedge_delay(names[0]) - (time.monotonic() - start)) if hedges else None
+            remaining = deadline.timeout() if deadline is not None else None
+            if remaining is not None:
+                timeout = remaining if timeout is None else min(timeout, remaining)
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            results += [future.result() for future in done]
+            winner = next((result for result in results if result.accepted), None)
+            if winner is not None:
+                cancel.set()
+                if len(results) > 1 or pending:
+                    logger.info(f"Hedged LLM request is won by {winner.model}")
+                return RoutedResult(winner.message, winner.model, None)
+            if deadline is not None and deadline.expired():
+                # no hedges after the deadline, only the answers received so far are left
+                cancel.set()
+                if pending:
+                    raise TimeoutError("No LLM answer is accepted before the task deadline")
+                break
+            # the first request is slow or its answer was rejected
+            if hedges and (not done or not pending):
+                logger.info(f"Sending hedged LLM request to {hedges[0]}")
+                pending.add(self._submit(hedges.pop(0), messages, validate, declines, cancel))
+
+        answered = [result for result in results if result.message is not None]
+        if not answered:
+            raise results[0].error
+        answered.sort(key=lambda result: not result.declined)
+        return RoutedResult(answered[0].message, answered[0].model, answered[0].error)
+
+    def describe(self) -> str:
+        with self._lock:
+            return "; ".join(f"{name}: {stats.describe()}" for name, stats in self.stats.items())
+
+    def _submit(self, name: str, messages: List[BaseMessage], validate, declines, cancel: threading.Event) -> Future:
+        return self._executor.submit(self._request, name, messages, validate, declines, cancel)
+
+    def _request(
+        self, name: str, messages: List[BaseMessage], validate, declines, cancel: threading.Event
+    ) -> LegResult:
+        start = time.monotonic()
+        stream = stream_text(self.models[name], messages)
+        chunks = []
+        try:
+            for chunk in stream:
+                if cancel.is_set():
+                    # closing the stream closes the connection, so the provider stops generating.
+                    # The time so far is only a lower bound of the latency, so it is not a sample
+                    return LegResult(name, None, None, cancelled=True)
+                chunks.append(chunk)
+        except Exception as e:
+            # throttling says nothing about the model, only real failures lower its rank
+            self._observe(name, None, None if isinstance(e, LLMThrottled) else False)
+            return LegResult(name, None, e)
+        finally:
+            stream.close()
+
+        elapsed = time.monotonic() - start
+        message = AIMessage(content="".join(chunks))
+        declined = declines is not None and declines(message.content)
+        if validate is not None and message.content.strip() and not declined:
+            error = validate(message.content)
+        else:
+            error = None
+        result = LegResult(name, message, error, declined=declined)
+        # a cached answer comes at once and was already counted when it was generated
+        if not stream.cached:
+            self._observe(name, elapsed, None if declined else result.accepted)
+        return result
+
+    def _observe(self, name: str, latency: Optional[float], accepted: Optional[bool]):
+        with self._lock:
+            stats = self.stats[name]
+            if latency is not None:
+                stats.latencies.append(latency)
+            if accepted is True:
+                stats.successes += 1
+            elif accepted is False:
+                stats.failures += 1
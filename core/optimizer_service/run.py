@@ -1,21 +1,49 @@
 import logging
+import os
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
-from typing import Tuple
-from core.optimizer_service.agent import get_qwen3_8b, get_agent
+from langchain_core.messages import AIMessage
+from typing import Callable, Dict, List, Optional, Tuple
+from core.optimizer_service.agent import get_model_router
+from core.optimizer_service.instrumentation import stage
+from core.optimizer_service.rate_limit import backoff_delay
+from core.optimizer_service.router import HedgedModelRouter
+from core.optimizer_service.llm_cache import get_llm_cache
 from core.optimizer_service.prompts import (
     ARCHITECT_AI_AGENT_SYSTEM_MESSAGE,
     HUMAN_DDL_AND_MIGRATION_TEMPLATE,
     HUMAN_SQL_QUERY_TEMPLATE,
+    HUMAN_SQL_QUERY_CANDIDATE_TEMPLATE,
     VALIDATOR_MESSAGE_ERROR_TEMPLATE,
 )
-from core.optimizer_service.trino_manager import get_trino, execute_statement_in_trino
+from core.optimizer_service.trino_manager import (
+    get_trino,
+    execute_statement_in_trino,
+    validate_statement_in_trino,
+    check_batch_in_trino,
+    estimate_cost_in_trino,
+    qualified_name,
+)
+from core.optimizer_service.fingerprint import QueryGroup, group_queries_by_shape, apply_rewrite
+from core.optimizer_service.workload import extract_workload_profile, render_layout_hints
+from core.optimizer_service.preaggregation import RULE_REWRITES, TableView, extract_table_views, rewrite_onto_views
+from core.optimizer_service.benchmark import BENCHMARK_SCALE_FACTOR, run_benchmark
+from core.optimizer_service.streaming import generate_ddls_and_migrations
+from core.optimizer_service.schema_validator import SchemaValidator
+from core.optimizer_service.scheduling import Deadline, Scheduler
+from core.optimizer_service.compaction import (
+    PROMPT_COMPACTION,
+    compact_source_ddls,
+    render_data_input,
+    render_new_ddls,
+    token_report,
+)
 from core.optimizer_service.utils import (
     get_catalog_and_schema_from_ddl,
     raw_input_to_model,
-    get_ddls_and_migrations_from_raw_output,
 )
-from core.optimizer_service.pydantic_models import DataOutput, SQL
+from core.optimizer_service.pydantic_models import DataInput, DataOutput, DDL, SQL, ExceptionDuringQuery
 
 load_dotenv()
 
@@ -28,168 +56,468 @@ LOCAL_SCHEMA_NAME = "team320"
 LOCAL_CATALOG_NAME = "iceberg"
 MAX_CREATED_TABLES = 10
 MAX_TABLES_IN_SCHEMA = 7
+# how many queries are rewritten at the same time in Part 2
+QUERY_CONCURRENCY = int(os.getenv("QUERY_CONCURRENCY", "4"))
+# how many candidate rewrites are generated per query. The cheapest one by Trino plan cost is kept
+QUERY_CANDIDATES = int(os.getenv("QUERY_CANDIDATES", "1"))
+# time budget of a task. When it runs out, the result produced so far is returned. 0 disables the deadline
+TASK_DEADLINE_SECONDS = int(os.getenv("TASK_DEADLINE_SECONDS", "1200"))
 
 
-def drop_schema(trino, catalog: str, schema: str):
+def drop_schema(trino, catalog: Optional[str], schema: str):
     drop_statement = (
-        f"DROP SCHEMA IF EXISTS {catalog}.{schema} CASCADE;"  # catalog is replaced to local one inside execute_statement_in_trino
+        f"DROP SCHEMA IF EXISTS {qualified_name(catalog, schema)} CASCADE;"  # catalog is replaced to local one inside execute_statement_in_trino
     )
     execute_statement_in_trino(trino, drop_statement)
 
 
-def run_pipeline(task_id: str, input_json: dict) -> Tuple[bool, DataOutput]:
+def validation_error_message(errors: List[ExceptionDuringQuery]):
+    """Message for the LLM with all statements that failed validation"""
+    statements = "\n".join(error.statement for error in errors)
+    descriptions = "\n".join(f"{error.statement}\n{error}" if len(errors) > 1 else str(error) for error in errors)
+    return VALIDATOR_MESSAGE_ERROR_TEMPLATE.format(statement=statements, errors=descriptions)
+
+
+def rewrite_query(
+    router: HedgedModelRouter,
+    trino,
+    system_msg,
+    ddls: List[DDL],
+    q: SQL,
+    variant: int = 0,
+    deadline: Optional[Deadline] = None,
+) -> Optional[SQL]:
+    """
+    Rewrite a single query for the new schema. Returns None if no valid rewrite was found.
+    Answers are validated inside the router, so a hedged request can win over an invalid answer.
+    A request that is still running at the deadline is cancelled.
+    """
+    logger.info(f"Optimizing Query with id {q.query_id}" + (f", variant {variant}" if variant else ""))
+    new_ddls = render_new_ddls(ddls) if PROMPT_COMPACTION else ddls
+    human_msg = HUMAN_SQL_QUERY_TEMPLATE.format(new_ddls=new_ddls, query=q.query)
+    init_messages = [system_msg, human_msg]
+    if variant:
+        init_messages.append(HUMAN_SQL_QUERY_CANDIDATE_TEMPLATE.format(variant=variant + 1))
+    messages = init_messages
+    _it = 0
+
+    def validate(content: str) -> Optional[ExceptionDuringQuery]:
+        return validate_statement_in_trino(trino, content)
+
+    def declines(content: str) -> bool:
+        return content.strip() == "IMPOSSIBLE"
+
+    while _it < QUERY_ITERATIONS_LIMIT:
+        if deadline is not None and deadline.expired():
+            logger.info(f"Stopping query {q.query_id}: the task deadline has passed")
+            break
+        _it += 1
+        logger.info(f"Starting iteration {_it} for Query Generating {q.query_id}")
+
+        try:
+            with stage("llm", iteration=_it, query_id=q.query_id) as span:
+                result = router.generate(messages, validate, declines, deadline)
+                span.set_tokens(messages, result.message)
+        except TimeoutError as e:
+            logger.warning(f"Stopping query {q.query_id}: {e}")
+            break
+        except Exception as e:
+            logger.error(f"Exception during invoke {e}\n Skip iteration")
+            time.sleep(backoff_delay(_it))
+            continue
+
+        messages = init_messages + [result.message]
+        logger.info(f"AI Message from {result.model}:\n {result.message.content}")
+
+        if result.message.content.strip() == "":
+            # throttling is already retried with backoff inside the rate limiter
+            messages = init_messages
+            continue
+
+        if result.message.content.strip() == "IMPOSSIBLE":
+            break
+
+        sql = SQL(query_id=q.query_id, query=result.message.content)
+        logger.info(sql.query)
+
+        error = result.error
+        if error is not None:
+            messages.append(validation_error_message([error]))
+            logger.info(f"Validation error for query {q.query_id}. Error: {error}")
+            continue
+
+        logger.info(f"Validated SQL {q.query_id}")
+        return sql
+
+    return None
+
+
+def optimize_query(
+    router: HedgedModelRouter, trino, system_msg, ddls: List[DDL], q: SQL, deadline: Optional[Deadline] = None
+) -> Optional[SQL]:
+    """
+    Rewrite a single query. With QUERY_CANDIDATES > 1 several candidate rewrites are generated
+    and scored with the Trino plan cost. The cheapest one is kept, or the original query
+    if no candidate is estimated to be cheaper than it.
+    Only estimates of the same kind as the one of the original query are compared. If the cost of the original
+    query is not known (e.g. the empty local cluster), a single rewrite is generated as without scoring.
+    """
+    if QUERY_CANDIDATES <= 1:
+        return rewrite_query(router, trino, system_msg, ddls, q, deadline=deadline)
+
+    original_cost = estimate_cost_in_trino(trino, q.query)
+    if original_cost is None:
+        logger.info(f"Cost of query {q.query_id} is not known, generating a single rewrite")
+        return rewrite_query(router, trino, system_msg, ddls, q, deadline=deadline)
+
+    candidates = [
+        rewrite_query(router, trino, system_msg, ddls, q, variant, deadline) for variant in range(QUERY_CANDIDATES)
+    ]
+    candidates = [candidate for candidate in candidates if candidate is not None]
+    if not candidates:
+        return None
+
+    costs = [estimate_cost_in_trino(trino, candidate.query) for candidate in candidates]
+    logger.info(f"Query {q.query_id} cost: original {original_cost}, candidates {costs}")
+    for candidate, cost in zip(candidates, costs):
+        candidate.estimated_cost = cost.value if cost is not None else None
+        # the costs are shown side by side, so the original one only in the same units
+        candidate.original_cost = original_cost.value if cost is not None and cost.comparable(original_cost) else None
+
+    comparable = [(candidate, cost) for candidate, cost in zip(candidates, costs) if original_cost.comparable(cost)]
+    if not comparable:
+        # nothing to compare, the first valid rewrite is kept as without scoring
+        return candidates[0]
+
+    best, best_cost = min(comparable, key=lambda pair: pair[1].value)
+    if best_cost.value >= original_cost.value:
+        logger.info(f"No candidate is cheaper than the original query {q.query_id}. Keeping the original")
+        return SQL(
+            query_id=q.query_id, query=q.query, original_cost=original_cost.value, estimated_cost=original_cost.value
+        )
+    return best
+
+
+def optimize_queries(
+    router: HedgedModelRouter,
+    trino,
+    system_msg,
+    ddls: List[DDL],
+    sqls: List[SQL],
+    scheduler: Optional[Scheduler] = None,
+    on_result: Optional[Callable[[SQL], None]] = None,
+) -> List[SQL]:
+    """
+    Rewrite queries concurrently, at most QUERY_CONCURRENCY at a time.
+    Queries are independent once the DDLs are fixed. Output keeps the input order,
+    and a failure of one query does not affect the others.
+    Queries are started in the input order while the scheduler estimates that one more query fits
+    before the deadline, the rest are skipped. on_result is called with every rewrite as soon as it is ready.
+    """
+    scheduler = scheduler or Scheduler(Deadline(None))
+
+    def optimize(q: SQL) -> Optional[SQL]:
+        if not scheduler.can_start("query"):
+            logger.info(f"Skipping query {q.query_id}: {scheduler.describe('query')}")
+            return None
+        with scheduler.measure("query"):
+            sql = optimize_query(router, trino, system_msg, ddls, q, scheduler.deadline)
+        if sql is not None and on_result is not None:
+            on_result(sql)
+        return sql
+
+    results = [None] * len(sqls)
+    with ThreadPoolExecutor(max_workers=QUERY_CONCURRENCY, thread_name_prefix="query") as executor:
+        futures = {executor.submit(optimize, q): i for i, q in enumerate(sqls)}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except Exception as e:
+                logger.error(f"Failed to optimize query {sqls[i].query_id}: {e}")
+
+    return [sql for sql in results if sql is not None]
+
+
+def optimize_workload(
+    router: HedgedModelRouter,
+    trino,
+    system_msg,
+    ddls: List[DDL],
+    sqls: List[SQL],
+    groups: List[QueryGroup],
+    scheduler: Optional[Scheduler] = None,
+    on_result: Optional[Callable[[SQL], None]] = None,
+) -> List[SQL]:
+    """
+    Optimize one representative per group of same-shaped queries with the LLM, and apply its rewrite
+    to the other members of the group by substituting their literals. Members for which substitution
+    is not safe or does not validate are optimized on their own. Members of a group whose
+    representative could not be optimized are skipped.
+    Groups with the biggest total weight go first, so they are done if the deadline comes.
+    Output keeps the input order.
+    """
+    groups_by_weight = sorted(groups, key=lambda g: -sum(sql.weight for sql in [g.representative, *g.members]))
+    representatives = [group.representative for group in groups_by_weight]
+    rewrites = {
+        sql.query_id: sql
+        for sql in optimize_queries(router, trino, system_msg, ddls, representatives, scheduler, on_result)
+    }
+
+    substituted, leftovers = [], []
+    for group in groups:
+        rewrite = rewrites.get(group.representative.query_id)
+        if rewrite is None:
+            continue
+        for member in group.members:
+            query = apply_rewrite(group.representative.query, rewrite.query, member.query)
+            if query is None:
+                leftovers.append(member)
+            else:
+                substituted.append(SQL(query_id=member.query_id, query=query))
+
+    members = {member.query_id: member for group in groups for member in group.members}
+    errors = check_batch_in_trino(trino, [sql.query for sql in substituted])
+    for sql, error in zip(substituted, errors):
+        if error is None:
+            rewrites[sql.query_id] = sql
+            if on_result is not None:
+                on_result(sql)
+        else:
+            leftovers.append(members[sql.query_id])
+
+    logger.info(f"Rewrites of {errors.count(None)} queries are derived from their groups")
+    if leftovers:
+        logger.info(f"Optimizing {len(leftovers)} group members on their own")
+        leftovers = sorted(leftovers, key=lambda sql: -sql.weight)
+        rewrites.update(
+            {
+                sql.query_id: sql
+                for sql in optimize_queries(router, trino, system_msg, ddls, leftovers, scheduler, on_result)
+            }
+        )
+
+    return [rewrites[q.query_id] for q in sqls if q.query_id in rewrites]
+
+
+def apply_rule_rewrites(
+    trino, views: List[TableView], sqls: List[SQL], on_result: Optional[Callable[[SQL], None]] = None
+) -> Dict[str, SQL]:
+    """
+    Rewrite queries onto projections and pre-aggregations of the new schema without the LLM,
+    see preaggregation.py. Rewrites are validated in Trino as one batch, queries whose rewrite
+    fails are left to the LLM. Returns rewrites by query id.
+    """
+    rewritten = []
+    for q in sqls:
+        query = rewrite_onto_views(q.query, views)
+        if query is not None:
+            rewritten.append(SQL(query_id=q.query_id, query=query, weight=q.weight))
+
+    rewrites = {}
+    errors = check_batch_in_trino(trino, [sql.query for sql in rewritten])
+    for sql, error in zip(rewritten, errors):
+        if error is not None:
+            logger.info(f"Rule rewrite of query {sql.query_id} is not valid, leaving it to the LLM. Error: {error}")
+            continue
+        rewrites[sql.query_id] = sql
+        if on_result is not None:
+            on_result(sql)
+
+    logger.info(f"{len(rewrites)} of {len(sqls)} queries are rewritten by rules without the LLM")
+    return rewrites
+
+
+def get_task_schema_mapping(task_id: str, server_schema_name: str) -> Dict[str, str]:
+    """
+    Every task works in its own pair of schemas in the local Trino, so concurrent pipelines do not
+    touch each other's tables. Statements keep the server names, they are mapped in trino_manager.
+    """
+    suffix = task_id.replace("-", "")[:16].lower()
+    return {server_schema_name: f"src_{suffix}", LOCAL_SCHEMA_NAME: f"opt_{suffix}"}
+
+
+def drop_task_schemas(trino):
+    for server_schema in trino.schema_mapping:
+        drop_schema(trino, trino.server_catalog_name, server_schema)
+
+
+def run_pipeline(
+    task_id: str, input_json: dict, sink=None, deadline: Optional[Deadline] = None
+) -> Tuple[bool, DataOutput]:
+    """
+    :param deadline: time budget of the task, TASK_DEADLINE_SECONDS by default.
+    The caller may cancel it to stop the pipeline early, the result produced so far is returned.
+    :param sink: optional object with save_schema(ddls, migrations) and save_query(sql) methods.
+    Every validated artifact is passed to it as soon as it is produced, so a partial result survives
+    a crash or the deadline
+    """
+    scheduler = Scheduler(deadline or Deadline(TASK_DEADLINE_SECONDS))
     # parse input
     data_input = raw_input_to_model(input_json)
     logger.info("Parsed input")
     # get server catalog
     server_additional_data = get_catalog_and_schema_from_ddl(data_input.ddls[0].ddl_script)
     server_catalog_name, server_schema_name = server_additional_data["catalog"], server_additional_data["schema"]
-    # recreate data model in local trino
-    logger.info("Recreating current tables in local Trino...")
-    trino = get_trino(server_catalog_name, LOCAL_CATALOG_NAME)
-    # drop schema if exists
-    drop_schema(trino, server_catalog_name, server_schema_name)
-    # create schema where server ddl will be run
-    create_statement = f"CREATE SCHEMA {trino.server_catalog_name}.{server_schema_name};"
+    if server_schema_name is None:
+        # tables of the task could not be moved to its own schemas, so it would share them with other pipelines
+        raise ValueError(f"Source DDL of task {task_id} does not name the schema of its tables")
+    trino = get_trino(server_catalog_name, LOCAL_CATALOG_NAME, get_task_schema_mapping(task_id, server_schema_name))
     try:
-        execute_statement_in_trino(trino, create_statement)
-    except Exception as e:
-        logger.error(f"Error while processing task {task_id}\n {e}")
-        return (False, None)
+        return optimize_data_model(task_id, trino, data_input, server_schema_name, scheduler, sink)
+    finally:
+        logger.info(f"Dropping schemas of task {task_id} in local Trino")
+        drop_task_schemas(trino)
 
-    # create same tables
-    for ddl in data_input.ddls:
+
+def optimize_data_model(
+    task_id: str, trino, data_input: DataInput, server_schema_name: str, scheduler: Scheduler, sink=None
+) -> Tuple[bool, DataOutput]:
+    server_catalog_name = trino.server_catalog_name
+    # recreate data model in local trino
+    logger.info("Recreating current tables in local Trino...")
+    with stage("schema_recreation"):
+        # drop schema if exists
+        drop_schema(trino, server_catalog_name, server_schema_name)
+        # create schema where server ddl will be run
+        create_statement = f"CREATE SCHEMA {qualified_name(server_catalog_name, server_schema_name)};"
         try:
-            execute_statement_in_trino(trino, ddl.ddl_script)
+            execute_statement_in_trino(trino, create_statement)
         except Exception as e:
-            logger.error(f"Bad input in task {task_id}\n {e}")
+            logger.error(f"Error while processing task {task_id}\n {e}")
             return (False, None)
 
+        # create same tables
+        for ddl in data_input.ddls:
+            try:
+                execute_statement_in_trino(trino, ddl.ddl_script)
+            except Exception as e:
+                logger.error(f"Bad input in task {task_id}\n {e}")
+                return (False, None)
+
     # we recreated tables in local in order to check migration queries
 
     # prepare agent
     logger.info("Preparing AI Agent...")
-    agent = get_agent(get_qwen3_8b())
+    router = get_model_router()
+    # DDLs are validated into the shared schema while they are streamed, so this stage is not hedged
+    model = router.primary()
 
     system_msg = ARCHITECT_AI_AGENT_SYSTEM_MESSAGE
 
+    with stage("parsing"):
+        # queries that differ only in literals are optimized once
+        groups = group_queries_by_shape(data_input.sqls)
+        # which columns the workload filters, joins, groups and orders by
+        workload_profile = extract_workload_profile(data_input)
+    logger.info(f"{len(data_input.sqls)} queries are grouped into {len(groups)} query shapes")
+    layout_hints = render_layout_hints(workload_profile)
+    logger.info(f"Layout hints:\n{layout_hints}")
+
     # Part 1: generating ddls and migrations:
+    representatives = [group.representative for group in groups]
+    prompt_input = data_input.model_copy(update={"sqls": representatives})
+    if PROMPT_COMPACTION:
+        # only tables and columns that the queries use, one line per DDL
+        compact_input = render_data_input(compact_source_ddls(data_input.ddls, representatives), representatives)
+        logger.info(token_report("Schema design prompt input", str(prompt_input), compact_input))
+        prompt_input = compact_input
+
     human_msg = HUMAN_DDL_AND_MIGRATION_TEMPLATE.format(
         max_tables=MAX_TABLES_IN_SCHEMA,
         local_schema=LOCAL_SCHEMA_NAME,
         server_schema=server_schema_name,
         catalog=server_catalog_name,
-        data_input=data_input,
+        layout_hints=layout_hints,
+        data_input=prompt_input,
     )
     init_messages = [system_msg, human_msg]
     messages = init_messages
     ddls = []
     migrations = []
 
+    # the new schema is kept between iterations, only changed statements are run again
+    drop_schema(trino, server_catalog_name, LOCAL_SCHEMA_NAME)
+    schema = SchemaValidator(trino)
+
     # leeeets go
     _it = 0
     while _it < DDL_CHECK_ITERATIONS_LIMIT:
+        if not scheduler.can_start("ddl_iteration"):
+            logger.warning(f"Stopping DDL iterations: {scheduler.describe('ddl_iteration')}")
+            break
         _it += 1
         logger.info(f"Starting iteration {_it} for DDL and Migrations")
 
+        # statements are validated while the model is still generating the rest of the answer
+        schema.begin_iteration()
         try:
-            invoke_result = agent.invoke({"messages": messages})
+            with scheduler.measure("ddl_iteration"), stage("ddl_generation", iteration=_it) as span:
+                result = generate_ddls_and_migrations(model, schema, messages, scheduler.deadline)
+                span.set_tokens(messages, AIMessage(content=result.content))
         except Exception as e:
             logger.error(f"Exception during invoke {e}\n Skip iteration")
+            time.sleep(backoff_delay(_it))
             continue
 
-        messages = init_messages + [invoke_result["messages"][-1]]
-        raw_content = invoke_result["messages"][-1].content
+        messages = init_messages + [AIMessage(content=result.content)]
+        raw_content = result.content
 
         if raw_content.strip() == "":
-            time.sleep(10)
             messages = init_messages
             continue
 
         logger.info(f"AI Message:\n {raw_content}")
-        if "#END#" not in raw_content:
-            continue
+        logger.info(f"Iteration {_it}: {schema.validated} statements run in Trino, {schema.reused} unchanged")
 
-        ddls, migrations = get_ddls_and_migrations_from_raw_output(raw_content)
-
-        error_msg = None
-        # validate ddls
-        logger.info("Start validating ddls")
-        drop_schema(trino, server_catalog_name, LOCAL_SCHEMA_NAME)
-        for i, ddl in enumerate(ddls):
-            validate_check, error = execute_statement_in_trino(trino, ddl.ddl_script)
-            if validate_check == -1:
-                error_msg = VALIDATOR_MESSAGE_ERROR_TEMPLATE.format(statement=ddl.ddl_script, errors=str(error))
-                messages.append(error_msg)
-                logger.info(f"Validation error for DDL {i}. Error: {error}")
-                break
-
-            logger.info(f"Validated DDL {i}")
-
-        if error_msg:
+        if result.errors:
+            messages.append(validation_error_message(result.errors))
+            logger.info(f"Validation errors: {[str(e) for e in result.errors]}")
             continue
+        if not result.finished:
+            continue
+        # only a complete answer that passed validation is kept
+        ddls, migrations = result.ddls, result.migrations
+        logger.info(f"Validated {len(ddls)} DDLs and {len(migrations)} Migrations")
 
-        # validate migrations
-        logger.info("Start validating migrations")
-
-        for i, mig in enumerate(migrations):
-            validate_check, error = execute_statement_in_trino(trino, mig.statement)
-            if validate_check == -1:
-                error_msg = VALIDATOR_MESSAGE_ERROR_TEMPLATE.format(statement=mig.statement, errors=str(error))
-                messages.append(error_msg)
-                logger.info(f"Validation error for DDL {i}. Error: {error}")
-                break
-
-            logger.info(f"Validated Migration {i}")
+        logger.info("All DDLs and Migrations are validated!")
+        break
 
-        if not error_msg:
-            logger.info("All DDLs and Migrations are validated!")
-            break
+    if not ddls:
+        logger.error(f"No valid DDLs and Migrations for task {task_id}")
+        return (False, None)
+    if sink is not None:
+        sink.save_schema(ddls, migrations)
 
     # Part 2: generating queries
-    sqls = []
-    for q in data_input.sqls:
-        logger.info(f"Optimizing Query with id {q.query_id}")
-        human_msg = HUMAN_SQL_QUERY_TEMPLATE.format(new_ddls=ddls, query=q.query)
-        init_messages = [system_msg, human_msg]
-        messages = init_messages
-        _it = 0
-
-        while _it < QUERY_ITERATIONS_LIMIT:
-            _it += 1
-            logger.info(f"Starting iteration {_it} for Query Generating")
-
-            try:
-                invoke_result = agent.invoke({"messages": messages})
-            except Exception as e:
-                logger.error(f"Exception during invoke {e}\n Skip iteration")
-                _it += 1
-                continue
-
-            messages = init_messages + [invoke_result["messages"][-1]]
-            logger.info(f"AI Message:\n {invoke_result['messages'][-1].content}")
-
-            if invoke_result["messages"][-1].content.strip() == "":
-                time.sleep(10)
-                messages = init_messages
-                continue
-
-            if invoke_result["messages"][-1].content.strip() == "IMPOSSIBLE":
-                break
-
-            sql = SQL(query_id=q.query_id, query=invoke_result["messages"][-1].content)
-            logger.info(sql.query)
-            # validating
-
-            validate_check, error = execute_statement_in_trino(trino, sql.query)
-            if validate_check == -1:
-                error_msg = VALIDATOR_MESSAGE_ERROR_TEMPLATE.format(statement=sql.query, errors=str(error))
-                messages.append(error_msg)
-                logger.info(f"Validation error for DDL {i}. Error: {error}")
-                continue
-
-            logger.info(f"Validated SQL {q.query_id}")
-            sqls.append(sql)
-            break
-
-    return True, DataOutput(ddls=ddls, migrations=migrations, sqls=sqls)
+    if PROMPT_COMPACTION:
+        logger.info(token_report("New DDLs in every query prompt", str(ddls), render_new_ddls(ddls)))
+    on_result = sink.save_query if sink is not None else None
+    # queries that read projections or pre-aggregations of a source table are rewritten mechanically
+    rewrites = {}
+    if RULE_REWRITES and ddls:
+        with stage("rule_rewrite"):
+            views = extract_table_views(data_input.ddls, ddls, migrations)
+            rewrites = apply_rule_rewrites(trino, views, data_input.sqls, on_result)
+    remaining = [q for q in data_input.sqls if q.query_id not in rewrites]
+    if rewrites:
+        groups = group_queries_by_shape(remaining)
+    for sql in optimize_workload(router, trino, system_msg, ddls, remaining, groups, scheduler, on_result):
+        rewrites[sql.query_id] = sql
+    sqls = [rewrites[q.query_id] for q in data_input.sqls if q.query_id in rewrites]
+    logger.info(f"Optimized {len(sqls)} of {len(data_input.sqls)} queries, {scheduler.deadline.remaining():.0f}s left")
+
+    # Part 3: measuring rewrites on synthetic data
+    benchmark = []
+    if BENCHMARK_SCALE_FACTOR > 0 and not scheduler.deadline.expired():
+        with stage("benchmark"):
+            benchmark = run_benchmark(trino, data_input, migrations, sqls, BENCHMARK_SCALE_FACTOR)
+
+    llm_cache = get_llm_cache()
+    if llm_cache is not None:
+        logger.info(f"LLM cache stats: {llm_cache.stats()}")
+    logger.info(f"LLM router stats: {router.describe()}")
+
+    return True, DataOutput(
+        ddls=ddls, migrations=migrations, sqls=sqls, workload_profile=workload_profile, benchmark=benchmark
+    )
@@ -0,0 +1,86 @@
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+# weight of the last observation in the running latency estimate
+LATENCY_EWMA_ALPHA = 0.3
+# a stage is started only if the time left is at least its estimate multiplied by this margin
+DEADLINE_SAFETY_MARGIN = 1.2
+
+
+class Deadline:
+    """Point in time by which a task must be finished. None means no deadline"""
+
+    def __init__(self, seconds: Optional[float]):
+        self.expires_at = time.monotonic() + seconds if seconds else math.inf
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def timeout(self) -> Optional[float]:
+        """Seconds left as a timeout argument, None if there is no deadline"""
+        remaining = self.remaining()
+        return None if math.isinf(remaining) else remaining
+
+    def cancel(self):
+        """Expire now, e.g. when the task was taken away from this worker. No new stages are started"""
+        self.expires_at = time.monotonic()
+
+
+class LatencyEstimator:
+    """Running (exponentially weighted) average duration of every pipeline stage"""
+
+    def __init__(self, alpha: float = LATENCY_EWMA_ALPHA):
+        self.alpha = alpha
+        self._estimates: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float):
+        with self._lock:
+            previous = self._estimates.get(stage)
+            self._estimates[stage] = seconds if previous is None else self.alpha * seconds + (1 - self.alpha) * previous
+
+    def estimate(self, stage: str) -> Optional[float]:
+        """None until the stage was observed at least once"""
+        with self._lock:
+            return self._estimates.get(stage)
+
+    @contextmanager
+    def measure(self, stage: str) -> Iterator[None]:
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.monotonic() - start)
+
+
+class Scheduler:
+    """Decides whether there is enough time left before the deadline to start one more unit of work"""
+
+    def __init__(self, deadline: Deadline, estimator: Optional[LatencyEstimator] = None):
+        self.deadline = deadline
+        self.estimator = estimator or LatencyEstimator()
+
+    def can_start(self, stage: str) -> bool:
+        remaining = self.deadline.remaining()
+        estimate = self.estimator.estimate(stage)
+        if estimate is None:
+            # nothing is known yet, the first unit is started while any time is left
+            return remaining > 0
+        return remaining >= estimate * DEADLINE_SAFETY_MARGIN
+
+    def measure(self, stage: str):
+        return self.estimator.measure(stage)
+
+    def describe(self, stage: str) -> str:
+        estimate = self.estimator.estimate(stage)
+        estimate = f"{estimate:.0f}s" if estimate is not None else "unknown"
+        return f"{self.deadline.remaining():.0f}s left, {stage} takes {estimate}"
@@ -0,0 +1,181 @@
+import hashlib
+import logging
+from typing import Dict, List, Optional, Set
+
+import sqlglot
+from sqlglot import exp
+
+from core.optimizer_service.compaction import compact_statement
+from core.optimizer_service.pydantic_models import ExceptionDuringQuery
+from core.optimizer_service.trino_manager import (
+    TrinoClustersManager,
+    check_batch_in_trino,
+    execute_statement_in_trino,
+    validate_statement_in_trino,
+)
+from core.optimizer_service.workload import DIALECT, table_name
+
+logger = logging.getLogger(__name__)
+
+
+def statement_hash(statement: str) -> str:
+    """Hash of the statement in canonical form, so formatting changes do not count as changes"""
+    return hashlib.sha1(compact_statement(statement).encode()).hexdigest()
+
+
+def _parse(statement: str) -> Optional[exp.Expression]:
+    try:
+        return sqlglot.parse_one(statement, read=DIALECT)
+    except Exception:
+        return None
+
+
+def _tables(tree: exp.Expression) -> Set[str]:
+    return {table_name(table) for table in tree.find_all(exp.Table) if table.name}
+
+
+def _created_table(tree: Optional[exp.Expression]) -> Optional[str]:
+    if isinstance(tree, exp.Create) and tree.kind == "TABLE":
+        return table_name(tree.this.this if isinstance(tree.this, exp.Schema) else tree.this)
+    return None
+
+
+def independent_table(statement: str) -> Optional[str]:
+    """Name of the table of a CREATE TABLE that reads no other table, None for any other statement"""
+    tree = _parse(statement)
+    name = _created_table(tree)
+    if name is None or _tables(tree) - {name}:
+        return None
+    return name
+
+
+class SchemaValidator:
+    """
+    Keeps the new schema in the local Trino between DDL retry iterations.
+    A CREATE TABLE is run again only if its definition or a table it reads from (CREATE TABLE AS SELECT) changed.
+    Tables that are not declared anymore are dropped. A migration is validated again only if it changed
+    or reads / writes a table that was recreated in this iteration.
+    Statements that can not be tracked (ALTER, DROP, unparsable) make the next iteration start from an empty schema.
+    """
+
+    def __init__(self, trino: TrinoClustersManager):
+        self.trino = trino
+        self._schemas: Set[str] = set()
+        self._tables: Dict[str, str] = {}  # table -> hash of its CREATE statement
+        self._migrations: Dict[str, Set[str]] = {}  # hash of a valid migration -> tables it uses
+        self._reset_needed = False
+        self.begin_iteration()
+
+    def begin_iteration(self):
+        if self._reset_needed:
+            logger.info("Schema has untracked changes, recreating it from scratch")
+            for schema in self._schemas:
+                execute_statement_in_trino(self.trino, f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+            self._schemas.clear()
+            self._tables.clear()
+            self._migrations.clear()
+            self._reset_needed = False
+
+        self._declared: Set[str] = set()
+        self._changed: Set[str] = set()
+        self._stale_dropped = False
+        self.validated = 0
+        self.reused = 0
+
+    def validate_ddl(self, statement: str) -> Optional[ExceptionDuringQuery]:
+        tree = _parse(statement)
+        if isinstance(tree, exp.Create) and tree.kind == "SCHEMA":
+            return self._create_schema(table_name(tree.this), statement)
+        name = _created_table(tree)
+        if name is not None:
+            return self._create_table(name, _tables(tree) - {name}, statement)
+
+        self._reset_needed = True
+        return self._validate(statement)
+
+    def validate_independent_ddls(self, statements: List[str]) -> List[Optional[ExceptionDuringQuery]]:
+        """
+        Validate CREATE TABLE statements of different tables that read no other table (see independent_table).
+        Tables that changed are created in Trino concurrently. Returns error (or None) for every statement
+        """
+        created = []  # (index, table, hash) of the tables that are created again
+        for i, statement in enumerate(statements):
+            name, key = independent_table(statement), statement_hash(statement)
+            if self._prepare_table(name, set(), key):
+                created.append((i, name, key))
+
+        self.validated += len(created)
+        errors = [None] * len(statements)
+        results = check_batch_in_trino(self.trino, [statements[i] for i, _, _ in created])
+        for (i, name, key), error in zip(created, results):
+            errors[i] = error
+            if error is None:
+                self._tables[name] = key
+        return errors
+
+    def validate_migration(self, statement: str) -> Optional[ExceptionDuringQuery]:
+        # all DDLs of the answer are known when migrations start
+        self.drop_stale_tables()
+
+        tree = _parse(statement)
+        if tree is None:
+            return self._validate(statement)
+
+        key = statement_hash(statement)
+        if key in self._migrations:
+            self.reused += 1
+            return None
+        error = self._validate(statement)
+        if error is None:
+            self._migrations[key] = _tables(tree)
+        return error
+
+    def drop_stale_tables(self):
+        """Drop tables created by previous iterations that the current answer does not declare"""
+        if self._stale_dropped:
+            return
+        self._stale_dropped = True
+        for name in [name for name in self._tables if name not in self._declared]:
+            execute_statement_in_trino(self.trino, f"DROP TABLE IF EXISTS {name}")
+            self._tables.pop(name)
+            self._mark_changed(name)
+
+    def _create_schema(self, name: str, statement: str) -> Optional[ExceptionDuringQuery]:
+        if name in self._schemas:
+            self.reused += 1
+            return None
+        error = self._validate(statement)
+        if error is None:
+            self._schemas.add(name)
+        return error
+
+    def _create_table(self, name: str, dependencies: Set[str], statement: str) -> Optional[ExceptionDuringQuery]:
+        key = statement_hash(statement)
+        if not self._prepare_table(name, dependencies, key):
+            return None
+
+        error = self._validate(statement)
+        if error is None:
+            self._tables[name] = key
+        return error
+
+    def _prepare_table(self, name: str, dependencies: Set[str], key: str) -> bool:
+        """Drops the previous version of a changed table. False if the table is unchanged and is kept"""
+        self._declared.add(name)
+        if self._tables.get(name) == key and not dependencies & self._changed:
+            self.reused += 1
+            return False
+
+        if self._tables.pop(name, None) is not None:
+            execute_statement_in_trino(self.trino, f"DROP TABLE IF EXISTS {name}")
+        self._mark_changed(name)
+        return True
+
+    def _mark_changed(self, name: str):
+        """Table is recreated or dropped, migrations that use it must be validated again"""
+        self._changed.add(name)
+        self._migrations = {key: tables for key, tables in self._migrations.items() if name not in tables}
+
+    def _validate(self, statement: str) -> Optional[ExceptionDuringQuery]:
+        self.validated += 1
+        return validate_statement_in_trino(self.trino, statement)
@@ -0,0 +1,295 @@
+import logging
+import re
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+from langchain_core.caches import BaseCache
+from langchain_core.language_models import BaseChatModel
+from langchain_core.load import dumps
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration
+
+from core.optimizer_service.pydantic_models import DDL, ExceptionDuringQuery, Migration
+from core.optimizer_service.rate_limit import rate_limited_stream
+from core.optimizer_service.scheduling import Deadline
+from core.optimizer_service.schema_validator import SchemaValidator, independent_table
+
+logger = logging.getLogger(__name__)
+
+SECTIONS = {"DDLS:": "ddls", "MIGRATIONS:": "migrations"}
+END_TOKEN = "#END#"
+NUMBERING_PATTERN = re.compile(r"^\s*\d+\s*[.)]\s*")
+STATEMENT_PATTERNS = {
+    "ddls": re.compile(r"^(CREATE|ALTER|DROP)\b", re.IGNORECASE),
+    "migrations": re.compile(r"^(INSERT|CREATE|WITH|SELECT|UPDATE|DELETE|MERGE|ALTER)\b", re.IGNORECASE),
+}
+
+
+class OutputFormatError(ValueError):
+    def __init__(self, statement: str, msg: str):
+        super().__init__(msg)
+        self.statement = statement
+
+
+class StatementStreamParser:
+    """
+    Incremental parser of the DDLS / MIGRATIONS answer format.
+    Text is fed as it is generated, statements are returned as soon as their terminating ';' arrives.
+    Raises OutputFormatError when the text breaks the format.
+    """
+
+    def __init__(self):
+        self.section = None
+        self.finished = False
+        self._pending = ""
+        self._in_quote = False
+
+    def feed(self, text: str) -> List[Tuple[str, str]]:
+        """Returns (section, statement) pairs completed by this text"""
+        statements = []
+        for char in text:
+            if self.finished:
+                break
+            if char == ";" and not self._in_quote:
+                statement = self._statement(self._pending)
+                if statement is not None:
+                    statements.append(statement)
+                self._pending = ""
+                continue
+
+            self._pending += char
+            if char == "'":
+                self._in_quote = not self._in_quote
+            elif char == "\n" and not self._in_quote:
+                self._check_last_line()
+        return statements
+
+    def close(self):
+        """Called when the generation is over. Checks the text after the last statement"""
+        if not self.finished:
+            self._check_last_line()
+
+    def _check_last_line(self):
+        lines = self._pending.rstrip().split("\n")
+        last_line = lines[-1].strip()
+        if last_line not in SECTIONS and not last_line.endswith(END_TOKEN):
+            return
+
+        if last_line.endswith(END_TOKEN):
+            lines[-1] = last_line[: -len(END_TOKEN)]
+        else:
+            lines.pop()
+        # text before the header or the END token. Before the first section it is a preamble and is ignored
+        before = "\n".join(lines).strip()
+        if self.section is not None and before:
+            raise OutputFormatError(before, "Statement is not terminated with ';'")
+
+        self._pending = ""
+        if last_line in SECTIONS:
+            self.section = SECTIONS[last_line]
+        else:
+            self.finished = True
+
+    def _statement(self, text: str) -> Optional[Tuple[str, str]]:
+        statement = NUMBERING_PATTERN.sub("", text.replace("\n", " ").strip()).strip()
+        if not statement:
+            return None
+        if self.section is None:
+            raise OutputFormatError(statement, "Statement is written before the DDLS: section")
+        if not STATEMENT_PATTERNS[self.section].match(statement):
+            raise OutputFormatError(statement, f"This is not a valid statement for the {self.section.upper()} section")
+        return self.section, statement + ";"
+
+
+class TextStream:
+    """
+    Completion of the model as text chunks. Closing the stream aborts the generation.
+    Streaming bypasses the langchain cache, so the model cache is looked up and updated here.
+    A stream that is closed before its end (aborted generation) and an empty completion are not cached.
+    Requests go through the shared rate limiter, see rate_limited_stream.
+    """
+
+    def __init__(self, model: BaseChatModel, messages: List[BaseMessage]):
+        self.model = model
+        self.messages = messages
+        self.cached = False  # the answer is read from the cache, the provider was not called
+        self._cache = model.cache if isinstance(model.cache, BaseCache) else None
+        self._chunks: Optional[Iterator[str]] = None
+        self._text: List[str] = []
+
+    def __iter__(self) -> Iterator[str]:
+        return self
+
+    def __next__(self) -> str:
+        if self._chunks is None:
+            self._chunks = self._start()
+        try:
+            chunk = next(self._chunks)
+        except StopIteration:
+            self.cache_answer("".join(self._text))
+            raise
+        self._text.append(chunk)
+        return chunk
+
+    def cache_answer(self, text: str):
+        """Cache the given text as the answer, e.g. a complete part of a generation that is aborted after it"""
+        if self._cache is not None and not self.cached and text:
+            self._cache.update(*self._cache_key(), [ChatGeneration(message=AIMessage(content=text))])
+
+    def close(self):
+        if self._chunks is not None and hasattr(self._chunks, "close"):
+            self._chunks.close()
+
+    def _start(self) -> Iterator[str]:
+        if self._cache is not None:
+            cached = self._cache.lookup(*self._cache_key())
+            if cached:
+                self.cached = True
+                return iter([cached[0].text])
+        return rate_limited_stream(self.model, self.messages)
+
+    def _cache_key(self) -> Tuple[str, str]:
+        return dumps(self.messages), self.model._get_llm_string()
+
+
+def stream_text(model: BaseChatModel, messages: List[BaseMessage]) -> TextStream:
+    """Stream the completion of the model as text, see TextStream"""
+    return TextStream(model, messages)
+
+
+class StreamingValidator:
+    """
+    Validates statements in a background thread in the order they were generated.
+    CREATE TABLE statements that read no other table are independent, the ones that arrive while the thread
+    is busy are validated together as one concurrent batch when it is free.
+    """
+
+    def __init__(self, schema: SchemaValidator):
+        self.schema = schema
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._futures: List[Future] = []  # every future returns the errors of its statements
+        self._batch: List[str] = []
+        self._batch_tables: Set[str] = set()
+
+    def submit_ddl(self, statement: str):
+        table = independent_table(statement)
+        if table is None or table in self._batch_tables:
+            self._flush()
+        if table is None:
+            self._submit(lambda: [self.schema.validate_ddl(statement)])
+            return
+        self._batch.append(statement)
+        self._batch_tables.add(table)
+        if self._idle():
+            self._flush()
+
+    def submit_migration(self, statement: str):
+        self._flush()
+        self._submit(lambda: [self.schema.validate_migration(statement)])
+
+    def error(self) -> Optional[ExceptionDuringQuery]:
+        """First error among statements validated so far. Does not wait"""
+        if self._idle():
+            self._flush()
+        for future in self._futures:
+            if not future.done():
+                return None
+            error = next((error for error in future.result() if error is not None), None)
+            if error is not None:
+                return error
+        return None
+
+    def wait(self) -> Optional[ExceptionDuringQuery]:
+        """Wait for all submitted statements. Returns the first error"""
+        self._flush()
+        for future in self._futures:
+            error = next((error for error in future.result() if error is not None), None)
+            if error is not None:
+                return error
+        return None
+
+    def close(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def _submit(self, validate: Callable[[], List[Optional[ExceptionDuringQuery]]]):
+        self._futures.append(self._executor.submit(validate))
+
+    def _idle(self) -> bool:
+        return all(future.done() for future in self._futures)
+
+    def _flush(self):
+        if self._batch:
+            batch = self._batch
+            self._submit(lambda: self.schema.validate_independent_ddls(batch))
+            self._batch, self._batch_tables = [], set()
+
+
+class GenerationResult(NamedTuple):
+    content: str  # text generated before the end or the abort
+    ddls: List[DDL]
+    migrations: List[Migration]
+    errors: List[ExceptionDuringQuery]
+    finished: bool  # the answer was complete (END token received)
+
+
+def generate_ddls_and_migrations(
+    model: BaseChatModel, schema: SchemaValidator, messages: List[BaseMessage], deadline: Optional[Deadline] = None
+) -> GenerationResult:
+    """
+    Stream the answer with DDLs and migrations and validate every statement as soon as it is generated.
+    Generation is aborted on the first invalid statement or format error, and at the deadline.
+    """
+    parser = StatementStreamParser()
+    validator = StreamingValidator(schema)
+    stream = stream_text(model, messages)
+    content, ddls, migrations, errors = "", [], [], []
+    expired = False
+    try:
+        for text in stream:
+            content += text
+            if deadline is not None and deadline.expired():
+                expired = True
+                break
+            try:
+                statements = parser.feed(text)
+            except OutputFormatError as e:
+                errors = [ExceptionDuringQuery(statement=e.statement, msg=str(e))]
+                break
+
+            for section, statement in statements:
+                if section == "ddls":
+                    ddls.append(DDL(ddl_script=statement))
+                    validator.submit_ddl(statement)
+                else:
+                    migrations.append(Migration(statement=statement))
+                    validator.submit_migration(statement)
+
+            error = validator.error()
+            if error is not None:
+                errors = [error]
+                break
+            if parser.finished:
+                # the text after the END token is not needed, the generation is aborted
+                content = content[: content.find(END_TOKEN) + len(END_TOKEN)]
+                break
+
+        if not errors and not expired:
+            try:
+                parser.close()
+            except OutputFormatError as e:
+                errors = [ExceptionDuringQuery(statement=e.statement, msg=str(e))]
+        if not errors and not expired:
+            error = validator.wait()
+            errors = [error] if error is not None else []
+        if not errors and parser.finished:
+            # an answer without migrations still replaces the tables of the previous one
+            schema.drop_stale_tables()
+            # the stream is closed before its end, so the complete answer is cached here
+            stream.cache_answer(content)
+    finally:
+        stream.close()
+        validator.close()
+
+    if (errors or expired) and not parser.finished:
+        logger.info(f"Generation aborted after {len(content)} characters" + (" at the deadline" if expired else ""))
+    return GenerationResult(content, ddls, migrations, errors, parser.finished)
@@ -1,54 +1,339 @@
 from trino.auth import BasicAuthentication
+from trino.exceptions import TrinoQueryError
 import trino
+import json
+import logging
+import math
 import os
-from typing import Optional
+import queue
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional
 
+import sqlglot
 from dotenv import load_dotenv
+from sqlglot import exp
+
+from core.optimizer_service.instrumentation import stage
+from core.optimizer_service.pydantic_models import ExceptionDuringQuery, QueryRun
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# "explain" - SELECT and INSERT statements are only analyzed with EXPLAIN and never run on the cluster.
+# "execute" - every statement is really executed
+TRINO_VALIDATION_MODE = os.getenv("TRINO_VALIDATION_MODE", "explain")
+# VALIDATE only analyzes the statement, LOGICAL also plans it
+TRINO_EXPLAIN_TYPE = os.getenv("TRINO_EXPLAIN_TYPE", "VALIDATE")
+# how many independent statements are validated at the same time
+TRINO_VALIDATION_CONCURRENCY = int(os.getenv("TRINO_VALIDATION_CONCURRENCY", "4"))
+# connections to the local cluster are shared by all pipelines of the process
+TRINO_POOL_SIZE = int(os.getenv("TRINO_POOL_SIZE", "16"))
+TRINO_POOL_TIMEOUT = float(os.getenv("TRINO_POOL_TIMEOUT", "300"))
+
+DIALECT = "trino"
+QUERY_STATEMENT_PATTERN = re.compile(r"^[\s(]*(SELECT|WITH|INSERT|VALUES|TABLE)\b", re.IGNORECASE)
+EXPLAIN_PREFIX_PATTERN = re.compile(r"^(EXPLAIN\b\s*(\([^)]*\))?\s*)?", re.IGNORECASE)
+
+
+class TrinoConnectionPool:
+    """
+    Bounded pool of reusable connections to a Trino cluster.
+    At most max_size connections are in use at the same time, other callers wait for a free one.
+    """
+
+    def __init__(self, connect: Callable[[], trino.dbapi.Connection], max_size: int, timeout: float):
+        self._connect = connect
+        self._timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+
+    @contextmanager
+    def connection(self) -> Iterator[trino.dbapi.Connection]:
+        if not self._slots.acquire(timeout=self._timeout):
+            raise TimeoutError(f"No free Trino connection in {self._timeout}s")
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+            try:
+                yield conn
+            finally:
+                # a failed query does not break the connection, so it is reused as well
+                self._idle.put(conn)
+        finally:
+            self._slots.release()
+
 
 class TrinoClustersManager:
     def __init__(
         self,
-        local_trino_connection: trino.dbapi.Connection,
+        local_pool: TrinoConnectionPool,
         server_trino_connection: Optional[trino.dbapi.Connection],
         local_catalog_name: Optional[str],
         server_catalog_name: Optional[str],
+        schema_mapping: Optional[Dict[str, str]] = None,
     ):
-        self.local_trino_connection = local_trino_connection
+        self.local_pool = local_pool
         self.server_trino_connection = server_trino_connection
         self.server_catalog_name = server_catalog_name
         self.local_catalog_name = local_catalog_name
+        # server schema name -> schema name in the local cluster
+        self.schema_mapping = schema_mapping or {}
 
-    def get_local_conn(self) -> trino.dbapi.Connection:
-        return self.local_trino_connection
+    def local_conn(self):
+        """Borrow a connection to the local cluster from the pool"""
+        return self.local_pool.connection()
 
     def get_server_conn(self) -> trino.dbapi.Connection:
         return self.server_trino_connection
 
 
-def get_trino(server_catalog_name, local_catalog_name):
+_local_pools = {}
+_local_pools_lock = threading.Lock()
+
+
+def get_local_pool(local_catalog_name) -> TrinoConnectionPool:
+    """Process-wide connection pool to the local cluster, one per catalog"""
     local_host_name = os.getenv("TRINO_HOST", "trino")
     local_port_name = int(os.getenv("TRINO_PORT", "8081"))
-    local_catalog_name = local_catalog_name
 
-    conn = trino.dbapi.trino.dbapi.connect(
-        host=local_host_name,
-        port=local_port_name,
-        catalog=local_catalog_name,
-        auth=BasicAuthentication("user", ""),
+    def connect():
+        return trino.dbapi.connect(
+            host=local_host_name,
+            port=local_port_name,
+            catalog=local_catalog_name,
+            auth=BasicAuthentication("user", ""),
+        )
+
+    with _local_pools_lock:
+        if local_catalog_name not in _local_pools:
+            _local_pools[local_catalog_name] = TrinoConnectionPool(connect, TRINO_POOL_SIZE, TRINO_POOL_TIMEOUT)
+        return _local_pools[local_catalog_name]
+
+
+def register_local_pool(local_catalog_name, pool: TrinoConnectionPool):
+    """Use the given pool for a catalog instead of connecting to TRINO_HOST, e.g. a stand-in cluster in benchmarks"""
+    with _local_pools_lock:
+        _local_pools[local_catalog_name] = pool
+
+
+def get_trino(server_catalog_name, local_catalog_name, schema_mapping: Optional[Dict[str, str]] = None):
+    return TrinoClustersManager(
+        get_local_pool(local_catalog_name), None, local_catalog_name, server_catalog_name, schema_mapping
     )
-    return TrinoClustersManager(conn, None, local_catalog_name, server_catalog_name)
+
+
+def _same_name(identifier, name: Optional[str]) -> bool:
+    # Trino names are case-insensitive
+    return name is not None and identifier.name.lower() == name.lower()
+
+
+def _local_schema(trino: TrinoClustersManager, schema: str) -> Optional[str]:
+    return next(
+        (local for server, local in trino.schema_mapping.items() if server.lower() == schema.lower()), None
+    )
+
+
+def _local_names_in_text(trino: TrinoClustersManager, text: str) -> str:
+    """Mapping of qualified names in a statement that sqlglot cannot parse, by their text"""
+    local_catalog, catalog = trino.local_catalog_name, trino.server_catalog_name
+    for server_schema, local_schema in trino.schema_mapping.items():
+        schema = re.escape(server_schema)
+        names = rf"{re.escape(catalog)}\.{schema}\b|{schema}\." if catalog else rf"{schema}\."
+        text = re.sub(
+            rf"(?<![\w.\"])({names})",
+            lambda match: f"{local_catalog}.{local_schema}" + ("." if match.group(1).endswith(".") else ""),
+            text,
+            flags=re.IGNORECASE,
+        )
+    if catalog:
+        text = re.sub(rf"(?<![\w.\"]){re.escape(catalog)}\.", f"{local_catalog}.", text, flags=re.IGNORECASE)
+    return text
+
+
+def to_local_statement(trino: TrinoClustersManager, statement: str) -> str:
+    """
+    Statement for the local cluster. Server schemas of both catalog.schema.table and schema.table names
+    are replaced with the task schemas, and the server catalog with the local one.
+    Only table names are changed in the original text, so error locations still point into the statement.
+    """
+    statement = statement.strip().rstrip(";")
+    explain = EXPLAIN_PREFIX_PATTERN.match(statement)
+    prefix, body = statement[: explain.end()], statement[explain.end() :]
+    try:
+        tree = sqlglot.parse_one(body, read=DIALECT)
+    except Exception:
+        tree = None
+    if tree is None or isinstance(tree, exp.Command):
+        return prefix + _local_names_in_text(trino, body)
+
+    replacements = []
+    # columns may be qualified with the full table name as well
+    for table in tree.find_all(exp.Table, exp.Column):
+        catalog, schema = table.args.get("catalog"), table.args.get("db")
+        if schema is None or (catalog is not None and not _same_name(catalog, trino.server_catalog_name)):
+            continue
+        local_schema = _local_schema(trino, schema.name)
+        if local_schema is not None:
+            start = (catalog or schema).meta["start"]
+            replacements.append((start, schema.meta["end"] + 1, f"{trino.local_catalog_name}.{local_schema}"))
+        elif catalog is not None:
+            replacements.append((catalog.meta["start"], catalog.meta["end"] + 1, trino.local_catalog_name))
+    for start, end, name in sorted(replacements, reverse=True):
+        body = body[:start] + name + body[end:]
+    return prefix + body
+
+
+def to_server_text(trino: TrinoClustersManager, text: str) -> str:
+    """Reverse of to_local_statement for error messages, so they mention the names from the original statement"""
+    for server_schema, local_schema in trino.schema_mapping.items():
+        text = re.sub(
+            rf"\b{re.escape(trino.local_catalog_name)}\.{re.escape(local_schema)}\b",
+            qualified_name(trino.server_catalog_name, server_schema),
+            text,
+            flags=re.IGNORECASE,
+        )
+    return text
+
+
+def qualified_name(*parts: Optional[str]) -> str:
+    """Dotted name of the given parts, a missing catalog is left out"""
+    return ".".join(part for part in parts if part)
 
 
 def execute_statement_in_trino(trino: TrinoClustersManager, statement: str):
-    # replace server catalog name with local name
-    exec_statement = statement.replace(f"{trino.server_catalog_name}.", f"{trino.local_catalog_name}.")
-    cursor = trino.get_local_conn().cursor()
     try:
-        cursor.execute(exec_statement.replace(";", ""))
+        with trino.local_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute(to_local_statement(trino, statement))
+            # results are fetched till the end, otherwise errors raised during execution are not seen
+            cursor.fetchall()
         return (0, "")
     except Exception as e:
         print(e)
         return (-1, e)
+
+
+def benchmark_statement_in_trino(trino: TrinoClustersManager, statement: str) -> QueryRun:
+    """Run a statement in the local cluster and collect its timings and scan statistics"""
+    start = time.perf_counter()
+    try:
+        with trino.local_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute(to_local_statement(trino, statement))
+            rows = cursor.fetchall()
+            stats = cursor.stats or {}
+    except Exception as e:
+        return QueryRun(error=to_server_text(trino, str(e)))
+
+    return QueryRun(
+        elapsed_ms=(time.perf_counter() - start) * 1000,
+        wall_time_ms=stats.get("wallTimeMillis"),
+        cpu_time_ms=stats.get("cpuTimeMillis"),
+        processed_rows=stats.get("processedRows"),
+        processed_bytes=stats.get("processedBytes"),
+        physical_input_bytes=stats.get("physicalInputBytes"),
+        peak_memory_bytes=stats.get("peakMemoryBytes"),
+        output_rows=len(rows),
+    )
+
+
+def _finite(value) -> Optional[float]:
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return None if math.isnan(value) or math.isinf(value) else value
+
+
+class PlanCost(NamedTuple):
+    """Plan cost estimate. Only estimates of the same kind can be compared"""
+
+    kind: str  # "cpu_network" - CPU + network cost of the plan, "input_bytes" - size of data read from the inputs
+    value: float
+
+    def comparable(self, other: Optional["PlanCost"]) -> bool:
+        return other is not None and other.kind == self.kind
+
+
+def plan_cost_from_io_plan(io_plan: dict) -> Optional[PlanCost]:
+    """
+    Cost of a query from the output of EXPLAIN (TYPE IO, FORMAT JSON).
+    It is the CPU + network cost of the whole plan. If Trino has no cost estimate (no table statistics),
+    it falls back to the estimated size of data read from all input tables. None if nothing is known.
+    A zero estimate (e.g. empty tables of the local cluster) says nothing about the query, it is None as well.
+    """
+    estimate = io_plan.get("estimate") or {}
+    cpu_cost, network_cost = _finite(estimate.get("cpuCost")), _finite(estimate.get("networkCost"))
+    if cpu_cost is not None:
+        cost = PlanCost("cpu_network", cpu_cost + (network_cost or 0.0))
+    else:
+        input_sizes = [
+            _finite((table_info.get("estimate") or {}).get("outputSizeInBytes"))
+            for table_info in io_plan.get("inputTableColumnInfos", [])
+        ]
+        if not input_sizes or any(size is None for size in input_sizes):
+            return None
+        cost = PlanCost("input_bytes", sum(input_sizes))
+    return cost if cost.value > 0 else None
+
+
+def estimate_cost_in_trino(trino: TrinoClustersManager, statement: str) -> Optional[PlanCost]:
+    """Estimated cost of a query by the Trino planner. The query itself is not run"""
+    try:
+        with stage("trino_cost"), trino.local_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"EXPLAIN (TYPE IO, FORMAT JSON) {to_local_statement(trino, statement)}")
+            rows = cursor.fetchall()
+        return plan_cost_from_io_plan(json.loads(rows[0][0]))
+    except Exception as e:
+        logger.warning(f"Could not estimate the cost of a statement: {e}")
+        return None
+
+
+def is_query_statement(statement: str) -> bool:
+    """SELECT / INSERT and other statements that can be checked with EXPLAIN"""
+    return QUERY_STATEMENT_PATTERN.match(statement) is not None
+
+
+def to_validation_error(statement: str, error) -> ExceptionDuringQuery:
+    if isinstance(error, TrinoQueryError):
+        line, column = error.error_location or (None, None)
+        return ExceptionDuringQuery(
+            statement=statement, msg=error.message, error_name=error.error_name, line=line, column=column
+        )
+    return ExceptionDuringQuery(statement=statement, msg=str(error))
+
+
+def validate_statement_in_trino(trino: TrinoClustersManager, statement: str) -> Optional[ExceptionDuringQuery]:
+    """
+    Check that a statement is valid for the local cluster.
+    In explain mode queries are only analyzed by EXPLAIN, so nothing is run on the cluster.
+    Returns None if the statement is valid.
+    """
+    prefix = ""
+    if TRINO_VALIDATION_MODE == "explain" and is_query_statement(statement):
+        prefix = f"EXPLAIN (TYPE {TRINO_EXPLAIN_TYPE}) "
+
+    with stage("trino_validation"):
+        validate_check, error = execute_statement_in_trino(trino, prefix + statement.lstrip())
+    if validate_check == -1:
+        validation_error = to_validation_error(statement, error)
+        validation_error.msg = to_server_text(trino, validation_error.msg)
+        # error location must point into the original statement, not into the EXPLAIN prefix
+        if validation_error.line == 1 and validation_error.column is not None:
+            validation_error.column -= len(prefix)
+        return validation_error
+    return None
+
+
+def check_batch_in_trino(trino: TrinoClustersManager, statements: List[str]) -> List[Optional[ExceptionDuringQuery]]:
+    """Validate independent statements concurrently. Returns error (or None) for every statement"""
+    with ThreadPoolExecutor(max_workers=TRINO_VALIDATION_CONCURRENCY) as executor:
+        return list(executor.map(lambda statement: validate_statement_in_trino(trino, statement), statements))
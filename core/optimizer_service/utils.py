@@ -120,7 +120,7 @@ def raw_input_to_model(input_json: dict) -> DataInput:
     sqls = [i for i in sorted(sqls_w_priority_and_id, key=lambda k: -k[2])]
 
     ddls = [DDL(ddl_script=i) for i in ddls]
-    sqls = [SQL(query_id=i[0], query=i[1]) for i in sqls]
+    sqls = [SQL(query_id=i[0], query=i[1], weight=i[2]) for i in sqls]
 
     catalog, schema = get_catalog_and_schema_from_ddl(ddls[0].ddl_script)
     return DataInput(catalog=catalog, catalog_schema=schema, ddls=ddls, sqls=sqls)
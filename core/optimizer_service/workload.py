@@ -0,0 +1,302 @@
+import logging
+from collections import defaultdict
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import sqlglot
+from sqlglot import exp
+from sqlglot.optimizer.qualify import qualify
+from sqlglot.optimizer.scope import Scope, traverse_scope
+
+from core.optimizer_service.pydantic_models import (
+    DDL,
+    SQL,
+    ColumnUsage,
+    DataInput,
+    LayoutCandidate,
+    WorkloadProfile,
+)
+
+logger = logging.getLogger(__name__)
+
+DIALECT = "trino"
+# how many candidates of every kind are kept in the profile
+MAX_CANDIDATES_PER_KIND = 10
+# how many columns are suggested for partitioning / sorting of a single table
+MAX_COLUMNS_PER_TABLE = 3
+
+POINT_PREDICATES = (exp.EQ, exp.In, exp.Is)
+RANGE_PREDICATES = (exp.GT, exp.GTE, exp.LT, exp.LTE, exp.Between)
+
+
+class TableDefinition(NamedTuple):
+    name: str  # catalog.schema.table
+    columns: List[Tuple[str, str]]  # (column name, Trino type)
+    properties: Tuple[str, ...] = ()  # WITH (...) properties, e.g. "partitioning=ARRAY['c1']"
+
+
+def table_name(table: exp.Table) -> str:
+    return ".".join(part for part in (table.catalog, table.db, table.name) if part).lower()
+
+
+def parse_table_ddl(ddl: str) -> Optional[TableDefinition]:
+    """Table name and columns of a CREATE TABLE statement. None for other statements"""
+    try:
+        tree = sqlglot.parse_one(ddl, read=DIALECT)
+    except Exception as e:
+        logger.info(f"Could not parse DDL: {e}")
+        return None
+
+    if not isinstance(tree, exp.Create) or tree.kind != "TABLE":
+        return None
+    if isinstance(tree.this, exp.Schema):
+        columns = [
+            (column.name.lower(), column.kind.sql(dialect=DIALECT) if column.kind else "")
+            for column in tree.this.expressions
+            if isinstance(column, exp.ColumnDef)
+        ]
+        properties = tree.args.get("properties")
+        properties = tuple(p.sql(dialect=DIALECT) for p in properties.expressions) if properties else ()
+        return TableDefinition(table_name(tree.this.this), columns, properties)
+    if isinstance(tree.this, exp.Table):
+        # CREATE TABLE ... AS SELECT, columns are not declared
+        return TableDefinition(table_name(tree.this), [])
+    return None
+
+
+def get_schema(ddls: List[DDL]) -> Dict[str, Dict[str, str]]:
+    """table name -> {column -> type}"""
+    schema = {}
+    for ddl in ddls:
+        definition = parse_table_ddl(ddl.ddl_script)
+        if definition is not None:
+            schema[definition.name] = dict(definition.columns)
+    return schema
+
+
+def _nested_schema(schema: Dict[str, Dict[str, str]]) -> dict:
+    """Schema in the nested {catalog: {db: {table: columns}}} form that sqlglot expects"""
+    nested = {}
+    for name, columns in schema.items():
+        parts = name.split(".")
+        node = nested
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = columns
+    return nested
+
+
+def parse_and_qualify(query: str, schema: Dict[str, Dict[str, str]]) -> Optional[exp.Expression]:
+    """Parse a query and qualify every column with its table, so columns can be traced to source tables"""
+    try:
+        tree = sqlglot.parse_one(query, read=DIALECT)
+        return qualify(tree, schema=_nested_schema(schema), dialect=DIALECT, validate_qualify_columns=False)
+    except Exception as e:
+        logger.info(f"Could not analyze query: {e}")
+        return None
+
+
+def resolve_column(scope: Scope, column: exp.Column) -> Optional[Tuple[str, str]]:
+    """(source table, column) that a column of the scope comes from. Traced through CTEs and subqueries"""
+    source = scope.sources.get(column.table)
+    if isinstance(source, exp.Table):
+        return table_name(source), column.name.lower()
+    if isinstance(source, Scope) and isinstance(source.expression, exp.Select):
+        for projection in source.expression.expressions:
+            if projection.alias_or_name.lower() != column.name.lower():
+                continue
+            inner = projection.unalias()
+            if isinstance(inner, exp.Column):
+                return resolve_column(source, inner)
+            return None
+    return None
+
+
+def _own_columns(scope: Scope, node: Optional[exp.Expression]) -> List[exp.Column]:
+    """Columns of a clause that belong to the scope itself, not to its subqueries"""
+    if node is None:
+        return []
+    return [column for column in node.find_all(exp.Column) if column.find_ancestor(exp.Select) is scope.expression]
+
+
+class _Usage:
+    def __init__(self):
+        self.columns = defaultdict(lambda: defaultdict(float))
+        self.column_queries = defaultdict(set)
+        self.preaggregations = defaultdict(lambda: [0.0, set()])
+
+    def add(self, source: Optional[Tuple[str, str]], role: str, weight: float, query_id: str):
+        if source is None:
+            return
+        self.columns[source][role] += weight
+        self.column_queries[source].add(query_id)
+
+
+def _analyze_scope(scope: Scope, weight: float, query_id: str, usage: _Usage):
+    select = scope.expression
+    if not isinstance(select, exp.Select):
+        return
+
+    # join conditions, including equi-joins written in WHERE
+    join_columns = set()
+    for join in select.args.get("joins") or []:
+        for column in _own_columns(scope, join.args.get("on")):
+            join_columns.add(id(column))
+            usage.add(resolve_column(scope, column), "joined", weight, query_id)
+
+    where = select.args.get("where")
+    for eq in where.find_all(exp.EQ) if where else []:
+        if isinstance(eq.left, exp.Column) and isinstance(eq.right, exp.Column) and eq.left.table != eq.right.table:
+            for column in (eq.left, eq.right):
+                join_columns.add(id(column))
+                usage.add(resolve_column(scope, column), "joined", weight, query_id)
+
+    for column in _own_columns(scope, where):
+        if id(column) in join_columns:
+            continue
+        source = resolve_column(scope, column)
+        usage.add(source, "filtered", weight, query_id)
+        if isinstance(column.find_ancestor(*POINT_PREDICATES, *RANGE_PREDICATES), RANGE_PREDICATES):
+            usage.add(source, "range_filtered", weight, query_id)
+
+    for column in _own_columns(scope, select.args.get("order")):
+        usage.add(resolve_column(scope, column), "ordered", weight, query_id)
+
+    group = select.args.get("group")
+    if group is None:
+        return
+
+    group_columns = _own_columns(scope, group)
+    sources = [resolve_column(scope, column) for column in group_columns]
+    for source in sources:
+        usage.add(source, "grouped", weight, query_id)
+
+    # GROUP BY over source columns only is a candidate for a pre-aggregated table
+    if sources and all(source is not None for source in sources):
+        def to_source_column(node: exp.Expression) -> exp.Expression:
+            source = resolve_column(scope, node) if isinstance(node, exp.Column) else None
+            if source is None:
+                return node
+            return exp.column(source[1], table=source[0].split(".")[-1])
+
+        expressions = [
+            expression.transform(to_source_column).sql(dialect=DIALECT) for expression in group.expressions
+        ]
+        key = (tuple(sorted({source[0] for source in sources})), tuple(sorted(expressions)))
+        usage.preaggregations[key][0] += weight
+        usage.preaggregations[key][1].add(query_id)
+
+
+def _partition_column(column: str, data_type: str) -> Optional[str]:
+    """Partition transform for a column, None if the type is a bad fit for partitioning"""
+    data_type = data_type.lower()
+    if data_type.startswith("date"):
+        return f"month({column})"
+    if data_type.startswith("timestamp"):
+        return f"day({column})"
+    if data_type.startswith(("double", "real", "decimal", "boolean")):
+        return None
+    return column
+
+
+def extract_workload_profile(data_input: DataInput) -> WorkloadProfile:
+    """
+    Analyze all input queries and collect, per source table, the columns they filter, join, group and order by,
+    weighted by query weight (runquantity * executiontime). Based on that, rank candidates for
+    partitioning, sorting and pre-aggregated tables.
+    """
+    schema = get_schema(data_input.ddls)
+    usage = _Usage()
+    total_weight = sum(sql.weight for sql in data_input.sqls) or 1.0
+
+    for sql in data_input.sqls:
+        tree = parse_and_qualify(sql.query, schema)
+        if tree is None:
+            continue
+        for scope in traverse_scope(tree):
+            _analyze_scope(scope, sql.weight, sql.query_id, usage)
+
+    columns = [
+        ColumnUsage(table=table, column=column, data_type=schema.get(table, {}).get(column), **roles)
+        for (table, column), roles in usage.columns.items()
+    ]
+
+    partition_candidates, sort_candidates = [], []
+    for table in sorted({column.table for column in columns}):
+        table_columns = [column for column in columns if column.table == table]
+
+        partitions = []
+        for column in sorted(table_columns, key=lambda c: -c.filtered):
+            transform = _partition_column(column.column, column.data_type or "")
+            if column.filtered > 0 and transform is not None:
+                partitions.append((transform, column))
+        partitions = partitions[:MAX_COLUMNS_PER_TABLE]
+        if partitions:
+            queries = set().union(*(usage.column_queries[(table, column.column)] for _, column in partitions))
+            partition_candidates.append(
+                LayoutCandidate(
+                    kind="partition",
+                    table=table,
+                    columns=[transform for transform, _ in partitions],
+                    score=max(column.filtered for _, column in partitions) / total_weight,
+                    queries=len(queries),
+                )
+            )
+
+        def sort_score(column: ColumnUsage) -> float:
+            # sorting by a boolean does not help to skip data
+            if (column.data_type or "").lower() == "boolean":
+                return 0.0
+            return column.range_filtered + column.filtered + column.joined + column.ordered
+
+        sort_columns = [c for c in sorted(table_columns, key=lambda c: -sort_score(c)) if sort_score(c) > 0]
+        sort_columns = sort_columns[:MAX_COLUMNS_PER_TABLE]
+        if sort_columns:
+            queries = set().union(*(usage.column_queries[(table, column.column)] for column in sort_columns))
+            sort_candidates.append(
+                LayoutCandidate(
+                    kind="sort",
+                    table=table,
+                    columns=[column.column for column in sort_columns],
+                    score=min(1.0, max(sort_score(column) for column in sort_columns) / total_weight),
+                    queries=len(queries),
+                )
+            )
+
+    preaggregation_candidates = [
+        LayoutCandidate(
+            kind="preaggregation",
+            table=", ".join(tables),
+            columns=list(expressions),
+            score=weight / total_weight,
+            queries=len(query_ids),
+        )
+        for (tables, expressions), (weight, query_ids) in usage.preaggregations.items()
+    ]
+
+    candidates = []
+    for kind_candidates in (partition_candidates, sort_candidates, preaggregation_candidates):
+        candidates += sorted(kind_candidates, key=lambda c: -c.score)[:MAX_CANDIDATES_PER_KIND]
+
+    return WorkloadProfile(columns=columns, candidates=candidates)
+
+
+def render_layout_hints(profile: WorkloadProfile) -> str:
+    """Compact text form of the layout candidates for the LLM prompt"""
+    titles = {
+        "partition": "Partitioning candidates (columns filtered by heavy queries)",
+        "sort": "sorted_by candidates (columns used in filters, joins and ORDER BY)",
+        "preaggregation": "Pre-aggregation candidates (GROUP BY keys of heavy queries)",
+    }
+    lines = []
+    for kind, title in titles.items():
+        kind_candidates = [c for c in profile.candidates if c.kind == kind]
+        if not kind_candidates:
+            continue
+        lines.append(f"{title}:")
+        for candidate in kind_candidates:
+            lines.append(
+                f"  - {candidate.table}: {', '.join(candidate.columns)} "
+                f"({candidate.score:.0%} of workload weight, {candidate.queries} queries)"
+            )
+
+    return "\n".join(lines) if lines else "No candidates found"
@@ -1,11 +1,20 @@
 drop table public.tasks;
 
+-- status: RUNNING (queued), CLAIMED (taken by an optimizer worker), DONE, FAILED
 create table public.tasks(
 	taskid text primary key,
 	url text,
-	status text
+	status text,
+	worker_id text,
+	lease_expires_at timestamptz,
+	submitted_at timestamptz default now(),
+	priority double precision default 0, -- queue delay in seconds, see core/app/priority.py
+	dequeue_at timestamptz default now() -- submitted_at + priority, queued tasks are claimed in this order
 );
 
+-- only queued tasks are indexed, the index stays small however many tasks are done
+create index tasks_queue_idx on public.tasks (dequeue_at) where status = 'RUNNING';
+
 drop table public.ddls;
 
 create table public.ddls(
@@ -47,5 +56,74 @@ create table public.result_queries(
 	taskid text,
 	queryid text,
 	query text,
+	original_cost double precision, -- Trino plan cost estimate of the original query
+	estimated_cost double precision, -- Trino plan cost estimate of the shipped query
 	CONSTRAINT result_queries_pkey PRIMARY KEY (taskid, queryid)
-);
\ No newline at end of file
+);
+
+drop table public.task_workload_profiles;
+
+create table public.task_workload_profiles(
+	taskid text primary key,
+	profile jsonb -- column usage of the input queries and layout candidates, see core/optimizer_service/workload.py
+);
+
+drop table public.benchmark_results;
+
+create table public.benchmark_results(
+	taskid text,
+	queryid text,
+	variant text, -- original / optimized
+	elapsed_ms double precision, -- wall clock time measured by the client
+	wall_time_ms bigint,
+	cpu_time_ms bigint,
+	processed_rows bigint,
+	processed_bytes bigint,
+	physical_input_bytes bigint,
+	peak_memory_bytes bigint,
+	output_rows bigint,
+	error text,
+	CONSTRAINT benchmark_results_pkey PRIMARY KEY (taskid, queryid, variant)
+);
+
+drop table public.stage_metrics;
+
+-- timing spans of the optimizer pipeline stages, see core/optimizer_service/instrumentation.py
+create table public.stage_metrics(
+	id bigserial primary key,
+	taskid text,
+	stage text, -- pipeline, schema_recreation, parsing, llm, ddl_generation, rule_rewrite, trino_validation, trino_cost, benchmark, saving
+	iteration int4, -- retry loop iteration
+	queryid text,
+	started_at timestamptz,
+	duration_ms double precision,
+	prompt_tokens int4,
+	completion_tokens int4,
+	error text -- exception type if the stage failed
+);
+
+create index stage_metrics_taskid_idx on public.stage_metrics (taskid);
+
+drop table public.stage_metric_totals;
+
+-- running totals of stage_metrics per stage, read by GET /metrics. See core/app/metrics.py
+create table public.stage_metric_totals(
+	stage text primary key,
+	spans int8,
+	duration_ms double precision,
+	buckets int8[], -- spans with duration_ms <= every bound of LATENCY_BUCKETS
+	errors int8, -- spans that failed, except throttled LLM calls
+	retries int8, -- spans of retry iterations (iteration > 1)
+	prompt_tokens int8,
+	completion_tokens int8,
+	throttled int8 -- LLM calls that stayed throttled after all retries
+);
+
+drop table public.llm_rate_limits;
+
+-- shared LLM provider limits, see core/optimizer_service/rate_limit.py
+create table public.llm_rate_limits(
+	name text primary key, -- llm_requests or llm_tokens
+	tokens double precision, -- tokens in the bucket at updated_at, refilled at limit / 60 per second
+	updated_at timestamptz
+);
@@ -18,17 +18,19 @@ API_URL="http://localhost:8000/status"
 
 # Check if task ID is provided
 if [ -z "$1" ]; then
-    echo "Usage: $0 <task_id>"
+    echo "Usage: $0 <task_id> [wait_seconds]"
     echo "Please provide a task ID as an argument"
     exit 1
 fi
 
 TASK_ID="$1"
+# with a wait the request returns as soon as the status changes (long polling)
+WAIT="${2:-0}"
 
 # Send GET request
 echo "Checking status for task ID: $TASK_ID"
 
-response=$(curl -s -w "%{http_code}" -X GET "$API_URL?task_id=$TASK_ID")
+response=$(curl -s -w "%{http_code}" -X GET "$API_URL?task_id=$TASK_ID&wait=$WAIT")
 
 http_code="${response: -3}"
 response_body="${response%???}"